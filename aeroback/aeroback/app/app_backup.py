@@ -262,40 +262,52 @@ def _execute_config(state):
     return 0, None
 
 
+#-----------------------------------------------------------------------
+# Import feeder of backup type
+#-----------------------------------------------------------------------
+def _feeder(atype):
+    '''
+    Returns feeder module, err, msg
+    '''
+    modname = {
+        'db_mongo': 'feedr_db',
+        'db_mysql': 'feedr_db',
+        'dir_compress': 'feedr_dir_compress',
+        'dir_increment': 'feedr_dir_increment'
+    }.get(atype, None)
+
+    if not modname:
+        return None, 1, "Feeder not found for type:{}".format(atype)
+
+    backupr = importlib.import_module(
+                ".{}".format(modname),
+                'aeroback.app')
+
+    return backupr, 0, None
+
+
 #-----------------------------------------------------------------------
 # Execute backup type
 #-----------------------------------------------------------------------
-def _exec_backup_type(state, storstate, params, dir_temp):
+def _exec_backup_type(state, backupr, storage, params, dir_temp):
+    '''
+    storage is list of storager states if feeder fans out
+    to all storages, otherwise single storager state
+    '''
     _D.DEBUG(
             __name__,
             "Backup",
             'params', params
             )
 
-    # Import and execute corresponding backupr type
+    # Execute corresponding backupr type
     try:
-        t = params['type']
-        if t == 'db_mongo' or t == 'db_mysql':
-            modname = 'feedr_db'
-        elif t == 'dir_compress':
-            modname = 'feedr_dir_compress'
-        elif t == 'dir_increment':
-            modname = 'feedr_dir_increment'
-
-        if not modname:
-            return 1, "Feeder not found for type:{}".format(t)
-
-        # Import module
-        backupr = importlib.import_module(
-                    ".{}".format(modname),
-                    'aeroback.app')
-
         # Backuper init
         backrstate, err, msg = backupr.init(
                 state.model.date_str,
                 state.model.date_int,
                 dir_temp,
-                storstate,
+                storage,
                 params)
         if err:
             backrstate.add_msg_error("Error in init")
@@ -341,6 +353,11 @@ def _exec_backup_type(state, storstate, params, dir_temp):
                 backrstate.get_msgs_warning(),
                 backrstate.get_msgs_error()
                 )
+
+    # Feeder finished, but some of its storages failed
+    if backrstate.get_msgs_error():
+        return 1, "Errors in feeder: {}".format('; '.join(backrstate.get_msgs_error()))
+
     return 0, None
 
 
@@ -490,13 +507,24 @@ def _exec_job(state, job, job_n, jobs_count):
                     section_name,
                     {'last_run<time>': state.model.date, 'running<bool>': True})
 
-            # Run backup on each storage
+            backupr, err, msg = _feeder(backup['type'])
+            if err:
+                state.add_msg_error(msg)
+                _runlog_update_finish(state, section_name, err_bool = True)
+                continue
+
+            # Run backup once for all storages, or on each storage
+            if getattr(backupr, 'FANOUT', False):
+                storages = [job['storstates']]
+            else:
+                storages = job['storstates']
+
             errs = False
-            for storstate in job['storstates']:
+            for storage in storages:
                 # Create unique temp directory inside dir_temp
                 dir_temp = tempfile.mkdtemp(dir = state.model.dir_temp)
                 # Execute
-                err, msg = _exec_backup_type(state, storstate, backup, dir_temp)
+                err, msg = _exec_backup_type(state, backupr, storage, backup, dir_temp)
                 # Delete temp directory
                 fsutil.remove_dir_tree(dir_temp)
 
@@ -1,4 +1,5 @@
 import os
+import collections
 
 #-----------------------------------------------------------------------
 from aeroback.abstractions.a_model import A_Model
@@ -20,6 +21,15 @@ Children modules:
     -
 '''
 
+# Files per diff lookup, below SQLite's limit of 999 parameters
+DIFF_BATCH_SIZE = 500
+
+# Files per page read from files_upload
+UPLOAD_PAGE_SIZE = 1000
+
+# File to be uploaded
+UploadFile = collections.namedtuple('UploadFile', 'filepath modified size')
+
 
 #-----------------------------------------------------------------------
 # Model
@@ -55,9 +65,17 @@ class State(A_State):
 
         self.db_conn = None
 
-        self.db_conn_upload = None
-        self.db_curs_upload = None
-        self.db_count_upload = None
+        # Storage files added since last commit
+        self.db_count_upload = 0
+
+        # Hash cache entries added since last commit
+        self.db_count_hash = 0
+
+        # Selection of files to upload
+        self.diff_max_size = 0
+        self.diff_count = 0
+        self.diff_size = 0
+        self.diff_storage_empty = False
 
     def debug_vars(self):
         return [
@@ -93,6 +111,7 @@ def _connect(state):
                 )
         '''
 
+        state.db_conn.begin()
         c = state.db_conn.cursor()
 
         # Table files: list of files in storage
@@ -141,6 +160,126 @@ def _connect(state):
 
         state.db_conn.commit()
 
+    # Tables added since first release
+    _upgrade(state)
+
+
+#-----------------------------------------------------------------------
+# Upgrade DB created by older version
+#-----------------------------------------------------------------------
+def _upgrade(state):
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    # Table dirs_cache: directories found on local disk by last scan
+    sql = "CREATE TABLE IF NOT EXISTS dirs_cache \
+            ( \
+            name TEXT PRIMARY KEY, \
+            modified REAL, \
+            count INTEGER, \
+            size INTEGER, \
+            seen INTEGER \
+            )"
+    c.execute(sql)
+
+    # Table files_cache: files found on local disk by last scan
+    sql = "CREATE TABLE IF NOT EXISTS files_cache \
+            ( \
+            dir TEXT, \
+            name TEXT, \
+            modified INTEGER, \
+            size INTEGER \
+            )"
+    c.execute(sql)
+
+    sql = "CREATE INDEX IF NOT EXISTS files_cache_dir ON files_cache (dir)"
+    c.execute(sql)
+
+    # Covering index: diff reads storage's modified/size without
+    # touching table rows
+    sql = "CREATE INDEX IF NOT EXISTS files_storage_diff \
+            ON files_storage (name, modified, size)"
+    c.execute(sql)
+
+    # Table scan_cache: when cache was last rebuilt by full scan
+    sql = "CREATE TABLE IF NOT EXISTS scan_cache \
+            ( \
+            id INTEGER PRIMARY KEY, \
+            last_full INTEGER, \
+            signature TEXT \
+            )"
+    c.execute(sql)
+
+    # Table files_hash: content hash of local file, valid while
+    # file's stat key is the same
+    sql = "CREATE TABLE IF NOT EXISTS files_hash \
+            ( \
+            name TEXT PRIMARY KEY, \
+            inode INTEGER, \
+            dev INTEGER, \
+            size INTEGER, \
+            mtime_ns INTEGER, \
+            ctime_ns INTEGER, \
+            hash TEXT \
+            )"
+    c.execute(sql)
+
+    # Content hash of stored files, NULL if not known
+    c.execute("PRAGMA table_info(files_storage)")
+    columns = [row[1] for row in c.fetchall()]
+    if 'hash' not in columns:
+        c.execute("ALTER TABLE files_storage ADD COLUMN hash TEXT")
+
+    # Stored files by content, for moved files
+    sql = "CREATE INDEX IF NOT EXISTS files_storage_hash \
+            ON files_storage (hash)"
+    c.execute(sql)
+
+    # Cached hashes by inode, for moved files
+    sql = "CREATE INDEX IF NOT EXISTS files_hash_inode \
+            ON files_hash (inode, dev)"
+    c.execute(sql)
+
+    # Table chunks: content-defined chunks in storage
+    sql = "CREATE TABLE IF NOT EXISTS chunks \
+            ( \
+            hash TEXT PRIMARY KEY, \
+            size INTEGER \
+            )"
+    c.execute(sql)
+
+    # Table files_chunks: chunks of files stored in chunks, in order
+    sql = "CREATE TABLE IF NOT EXISTS files_chunks \
+            ( \
+            name TEXT PRIMARY KEY, \
+            chunks TEXT \
+            )"
+    c.execute(sql)
+
+    # Table packs: pack objects in storage
+    sql = "CREATE TABLE IF NOT EXISTS packs \
+            ( \
+            name TEXT PRIMARY KEY, \
+            size INTEGER \
+            )"
+    c.execute(sql)
+
+    # Table files_packed: where in packs files are stored
+    sql = "CREATE TABLE IF NOT EXISTS files_packed \
+            ( \
+            name TEXT PRIMARY KEY, \
+            pack TEXT, \
+            offset INTEGER, \
+            length INTEGER \
+            )"
+    c.execute(sql)
+
+    sql = "CREATE INDEX IF NOT EXISTS files_packed_pack \
+            ON files_packed (pack)"
+    c.execute(sql)
+
+    state.db_conn.commit()
+
 
 #-----------------------------------------------------------------------
 # Disconnect DB
@@ -166,10 +305,9 @@ def update_params(state, dir_local, url_storage):
         return
 
     sql = "INSERT OR REPLACE INTO params \
-          (id, dir_local, url_storage) VALUES('{}','{}','{}') \
-          ".format(0, dir_local, url_storage)
+          (id, dir_local, url_storage) VALUES (0, ?, ?)"
 
-    c.execute(sql)
+    c.execute(sql, (dir_local, url_storage))
     state.db_conn.commit()
 
 
@@ -181,6 +319,8 @@ def clear_locals_uploads(state):
     if not c:
         return
 
+    state.db_conn.begin()
+
     # Clear list of local files
     sql = "DELETE FROM files_local"
     c.execute(sql)
@@ -202,13 +342,22 @@ def add_local_file(state, filepath, modified, size):
         - modified - integer stamp
         - size - integer
     """
-    c = state.db_conn.cursor()
+    add_local_files(state, ((filepath, modified, size),))
 
-    sql = "INSERT INTO files_local \
-            VALUES ('{}','{}','{}') \
-            ".format(filepath, modified, size)
 
-    c.execute(sql)
+#-----------------------------------------------------------------------
+# Add local files
+#-----------------------------------------------------------------------
+def add_local_files(state, files):
+    """
+    Add items to table files_local, not committed:
+        - files - list or iterator of (filepath, modified, size)
+    """
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    sql = "INSERT INTO files_local (name, modified, size) VALUES (?, ?, ?)"
+    c.executemany(sql, files)
 
 
 #-----------------------------------------------------------------------
@@ -219,80 +368,316 @@ def commit_added_local_files(state):
 
 
 #-----------------------------------------------------------------------
-# Find differences between storage and local files
+# Get directory cache params
 #-----------------------------------------------------------------------
-def find_local_storage_diff(state, max_total_size):
+def get_scan_cache(state):
     """
-    Finds files that new/modified compared to files already in storage.
-    maxSize (if > 0) specifies max total size of files.
+    Returns:
+        - date of last full scan, integer stamp or None
+        - signature of scan settings the cache was built with
+    """
+    c = state.db_conn.cursor()
+
+    sql = "SELECT last_full, signature FROM scan_cache WHERE id = 0"
+    c.execute(sql)
+    row = c.fetchone()
+    if row:
+        return row[0], row[1]
+    else:
+        return None, None
+
+
+#-----------------------------------------------------------------------
+# Set directory cache params
+#-----------------------------------------------------------------------
+def set_scan_cache(state, last_full, signature):
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    sql = "INSERT OR REPLACE INTO scan_cache \
+            (id, last_full, signature) VALUES (0, ?, ?)"
+    c.execute(sql, (last_full, signature))
+
+
+#-----------------------------------------------------------------------
+# Get cached directories
+#-----------------------------------------------------------------------
+def get_dirs_cache(state):
+    """
+    Returns dictionary of cached directories:
+        { relpath: modified }
+    """
+    c = state.db_conn.cursor()
+
+    sql = "SELECT name, modified FROM dirs_cache"
+    c.execute(sql)
+
+    result = {}
+    for row in c:
+        result[row[0]] = row[1]
+
+    return result
+
+
+#-----------------------------------------------------------------------
+# Keep cached directory
+#-----------------------------------------------------------------------
+def keep_cached_dir(state, dirpath):
+    """
+    Marks unchanged cached directory as seen by this scan
+    """
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    sql = "UPDATE dirs_cache SET seen = ? WHERE name = ?"
+    c.execute(sql, (state.model.date_int, dirpath))
+
+
+#-----------------------------------------------------------------------
+# Replace cached directory
+#-----------------------------------------------------------------------
+def replace_cached_dir(state, dirpath, modified, files):
+    """
+    Replaces cached directory and its files:
+        - dirpath - relative path
+        - modified - directory's mtime
+        - files - list of (filepath, modified, size)
+    """
+    c = state.db_conn.cursor()
+
+    # Directory and its files change together
+    with state.db_conn.savepoint('replace_cached_dir'):
+        sql = "DELETE FROM files_cache WHERE dir = ?"
+        c.execute(sql, (dirpath,))
+
+        sql = "INSERT INTO files_cache (dir, name, modified, size) VALUES (?, ?, ?, ?)"
+        c.executemany(sql, ((dirpath, f[0], f[1], f[2]) for f in files))
+
+        sql = "INSERT OR REPLACE INTO dirs_cache \
+                (name, modified, count, size, seen) VALUES (?, ?, ?, ?, ?)"
+        c.execute(sql, (
+                dirpath,
+                modified,
+                len(files),
+                sum(f[2] for f in files),
+                state.model.date_int))
+
+
+#-----------------------------------------------------------------------
+# Remove cached directory tree
+#-----------------------------------------------------------------------
+def remove_cached_tree(state, dirpath):
+    """
+    Removes cached directory, all its subdirectories and their files
+    """
+    c = state.db_conn.cursor()
+
+    # Subdirectories: names in range [dirpath/, dirpath0)
+    low = dirpath + os.sep
+    high = dirpath + chr(ord(os.sep) + 1)
+
+    with state.db_conn.savepoint('remove_cached_tree'):
+        sql = "DELETE FROM files_cache WHERE dir = ? OR (dir >= ? AND dir < ?)"
+        c.execute(sql, (dirpath, low, high))
+
+        sql = "DELETE FROM dirs_cache WHERE name = ? OR (name >= ? AND name < ?)"
+        c.execute(sql, (dirpath, low, high))
+
+
+#-----------------------------------------------------------------------
+# Finish directory cache update
+#-----------------------------------------------------------------------
+def finish_dirs_cache(state, drop_unseen = True):
+    """
+    Drops cached directories not seen by this scan (if drop_unseen),
+    copies cached files to local files.
+    Returns:
+        - count of local files
+        - total size of local files in bytes
+    """
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    if drop_unseen:
+        sql = "DELETE FROM files_cache WHERE dir IN \
+                (SELECT name FROM dirs_cache WHERE seen != ?)"
+        c.execute(sql, (state.model.date_int,))
+
+        sql = "DELETE FROM dirs_cache WHERE seen != ?"
+        c.execute(sql, (state.model.date_int,))
+
+    sql = "INSERT INTO files_local (name, modified, size) \
+            SELECT name, modified, size FROM files_cache"
+    c.execute(sql)
+
+    state.db_conn.commit()
+
+    sql = "SELECT SUM(count), SUM(size) FROM dirs_cache"
+    c.execute(sql)
+    row = c.fetchone()
+
+    return row[0] or 0, row[1] or 0
+
+
+#-----------------------------------------------------------------------
+# Clear directory cache
+#-----------------------------------------------------------------------
+def clear_dirs_cache(state):
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    sql = "DELETE FROM files_cache"
+    c.execute(sql)
+
+    sql = "DELETE FROM dirs_cache"
+    c.execute(sql)
+
+    sql = "DELETE FROM scan_cache"
+    c.execute(sql)
+
+    state.db_conn.commit()
+
+
+#-----------------------------------------------------------------------
+# Start selecting files to upload
+#-----------------------------------------------------------------------
+def start_local_storage_diff(state, max_total_size):
+    """
+    max_total_size (if > 0) specifies max total size of files.
+    Files to upload are committed by finish_local_storage_diff().
     """
+    state.db_conn.begin()
     c = state.db_conn.cursor()
 
-    # Open second temporary connection
-    conn_temp = db_iface.db_open(state.model.filepath)
-    cursor_temp = conn_temp.cursor()
+    state.diff_max_size = max_total_size
+    state.diff_count = 0
+    state.diff_size = 0
 
-    # How many files are already in storage
+    # Storage is empty ? All local files are new
     sql = "SELECT COUNT(*) FROM files_storage"
     c.execute(sql)
     row = c.fetchone()
+    state.diff_storage_empty = not row or row[0] == 0
 
-    # Storage is empty ?
-    if not row or row[0] == 0:
-        # Use all local files
-        sql = "SELECT DISTINCT * FROM files_local"
 
+#-----------------------------------------------------------------------
+# Add new/modified files to upload
+#-----------------------------------------------------------------------
+def _add_uploads(state, c, rows):
+    """
+    Adds files to files_upload while they fit into max total size.
+    First file can bypass max total size.
+    """
+    uploads = []
+    for row in rows:
+        size = row[2]
+        if state.diff_max_size <= 0 \
+                or state.diff_size + size < state.diff_max_size \
+                or state.diff_count == 0:
+            uploads.append(row)
+            state.diff_count += 1
+            state.diff_size += size
+
+    if uploads:
+        sql = "INSERT INTO files_upload (name, modified, size) VALUES (?, ?, ?)"
+        c.executemany(sql, uploads)
+
+
+#-----------------------------------------------------------------------
+# Diff batch of local files against storage
+#-----------------------------------------------------------------------
+def diff_local_files(state, files):
+    """
+    Streaming counterpart of files_local + find_local_storage_diff:
+    looks up batch of local files in files_storage and adds
+    new/modified ones straight to files_upload.
+        - files - list of (filepath, modified, size),
+                  at most DIFF_BATCH_SIZE
+    """
+    c = state.db_conn.cursor()
+
+    if state.diff_storage_empty:
+        _add_uploads(state, c, files)
+        return
+
+    # One lookup per batch using files_storage's unique name index
+    sql = "SELECT name, modified, size FROM files_storage WHERE name IN ({})".format(
+            ','.join('?' * len(files)))
+    c.execute(sql, [f[0] for f in files])
+
+    stored = {}
+    for row in c:
+        stored[row[0]] = row
+
+    changed = []
+    for f in files:
+        row = stored.get(f[0], None)
+        if row is None or row[1] != f[1] or row[2] != f[2]:
+            changed.append(f)
+
+    _add_uploads(state, c, changed)
+
+
+#-----------------------------------------------------------------------
+# Finish selecting files to upload
+#-----------------------------------------------------------------------
+def finish_local_storage_diff(state):
+    state.db_conn.commit()
+
+
+#-----------------------------------------------------------------------
+# Find differences between storage and local files
+#-----------------------------------------------------------------------
+def find_local_storage_diff(state, max_total_size, snapshot = None):
+    """
+    Finds files that new/modified compared to files already in storage.
+    maxSize (if > 0) specifies max total size of files.
+    snapshot - filepath of another tracking DB to take local files from,
+    when one scan is shared by several storages.
+    """
+    c = state.db_conn.cursor()
+
+    # Attach before diff starts transaction
+    if snapshot:
+        c.execute("ATTACH DATABASE ? AS snapshot", (snapshot,))
+        source = "snapshot.files_local"
     else:
-        # Find difference
-        sql = "SELECT DISTINCT a.* \
-        FROM files_local a \
-        INNER JOIN files_storage b \
-        ON \
-        a.name NOT IN (SELECT name FROM files_storage) \
-        OR \
-        a.name=b.name AND (a.modified!=b.modified OR a.size!=b.size)"
+        source = "files_local"
+
+    start_local_storage_diff(state, max_total_size)
+
+    # Anti-join: local files missing in storage or differing from it.
+    # One index lookup per local file, names are unique in both tables
+    sql = "SELECT a.name, a.modified, a.size \
+            FROM {} a \
+            LEFT JOIN files_storage b ON a.name = b.name \
+            WHERE b.name IS NULL \
+            OR a.modified != b.modified \
+            OR a.size != b.size".format(source)
 
     c.execute(sql)
 
-    # For each found file...
-    i = 0
-    total_size = 0
-    for row in c:
-        total_size += row[2]
-        if max_total_size <= 0:
-            add = True
-        elif total_size < max_total_size or i == 0:
-            # To make sure first file can bypass max_total_size
-            add = True
-        else:
-            add = False
-        if add:
-            sql = "INSERT INTO files_upload \
-                   VALUES ('{}','{}','{}') \
-                   ".format(row[0], row[1], row[2])
-            cursor_temp.execute(sql)
-            i += 1
-        else:
-            # Deduct this file size from total if beyond max
-            total_size -= row[2]
-            if total_size < 0:
-                total_size = 0
-
-    # Commit and close temporary connection
-    if i > 0:
-        conn_temp.commit()
-    conn_temp.close()
+    # Second cursor inserts while first one reads
+    c_upload = state.db_conn.cursor()
+    while True:
+        rows = c.fetchmany(DIFF_BATCH_SIZE)
+        if not rows:
+            break
+        _add_uploads(state, c_upload, rows)
+
+    finish_local_storage_diff(state)
+
+    if snapshot:
+        c.execute("DETACH DATABASE snapshot")
 
     # Debug
     '''
     _D.DEBUG(
             __name__,
             "File Incremental Tracking DB found differences",
-            'TODO', 'Check count!',
-            'count', i,
-            'total_size', fmtutil.byte_size(total_size),
-            'max_total_size', fmtutil.byte_size(max_total_size),
-            '% of allowed', 100 * total_size / max_total_size
+            'count', state.diff_count,
+            'total_size', fmtutil.byte_size(state.diff_size),
+            'max_total_size', fmtutil.byte_size(max_total_size)
             )
     '''
 
@@ -300,94 +685,419 @@ def find_local_storage_diff(state, max_total_size):
 
 
 #-----------------------------------------------------------------------
-# Get next file to upload
+# Get files to upload
 #-----------------------------------------------------------------------
 def get_files_upload(state):
     """
-    Fetches next file to be uploaded
+    Generator of UploadFile(filepath, modified, size) to be uploaded.
+    Reads files_upload page by page in rowid order, so that memory
+    stays flat and no statement is left open over commits of
+    storage files made while iterating.
+    """
+    c = state.db_conn.cursor()
+
+    sql = "SELECT rowid, name, modified, size FROM files_upload \
+            WHERE rowid > ? ORDER BY rowid LIMIT ?"
+
+    last = 0
+    while True:
+        c.execute(sql, (last, UPLOAD_PAGE_SIZE))
+        rows = c.fetchall()
+        if not rows:
+            return
+
+        for row in rows:
+            yield UploadFile(row[1], row[2], row[3])
+
+        last = rows[-1][0]
+
+
+#-----------------------------------------------------------------------
+# Get content hash of stored file
+#-----------------------------------------------------------------------
+def get_storage_hash(state, filepath):
+    """
+    Returns hash of file in storage, None if not known
+    """
+    c = state.db_conn.cursor()
+
+    sql = "SELECT hash FROM files_storage WHERE name = ?"
+    c.execute(sql, (filepath,))
+
+    row = c.fetchone()
+    if row:
+        return row[0]
+    return None
+
+
+#-----------------------------------------------------------------------
+# Get cached content hash
+#-----------------------------------------------------------------------
+def get_cached_hash(state, filepath, key):
+    """
+    Returns hash of local file cached for the same stat key
+    (inode, dev, size, mtime_ns, ctime_ns), None if not cached
+    """
+    c = state.db_conn.cursor()
+
+    sql = "SELECT hash FROM files_hash \
+            WHERE name = ? AND inode = ? AND dev = ? AND size = ? \
+            AND mtime_ns = ? AND ctime_ns = ?"
+    c.execute(sql, (filepath,) + tuple(key))
+
+    row = c.fetchone()
+    if row:
+        return row[0]
+    return None
+
+
+#-----------------------------------------------------------------------
+# Get cached content hash of moved file
+#-----------------------------------------------------------------------
+def get_moved_cached_hash(state, key):
+    """
+    Returns hash cached for the same inode, dev, size and mtime_ns
+    under any name, None if not cached. Rename keeps these, only
+    ctime changes.
     """
     c = state.db_conn.cursor()
 
-    sql = "SELECT * FROM files_upload"
+    inode, dev, size, mtime_ns, ctime_ns = key
+
+    sql = "SELECT hash FROM files_hash \
+            WHERE inode = ? AND dev = ? AND size = ? AND mtime_ns = ? \
+            LIMIT 1"
+    c.execute(sql, (inode, dev, size, mtime_ns))
+
+    row = c.fetchone()
+    if row:
+        return row[0]
+    return None
+
+
+#-----------------------------------------------------------------------
+# Cache content hash
+#-----------------------------------------------------------------------
+def set_cached_hash(state, filepath, key, content_hash):
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    sql = "INSERT OR REPLACE INTO files_hash \
+            (name, inode, dev, size, mtime_ns, ctime_ns, hash) \
+            VALUES (?, ?, ?, ?, ?, ?, ?)"
+    c.execute(sql, (filepath,) + tuple(key) + (content_hash,))
+
+    # Commit after 50 queries
+    state.db_count_hash += 1
+    if state.db_count_hash > 50:
+        state.db_conn.commit()
+        state.db_count_hash = 0
+
+
+#-----------------------------------------------------------------------
+# Drop cached hashes of files not in storage
+#-----------------------------------------------------------------------
+def prune_hash_cache(state):
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    sql = "DELETE FROM files_hash \
+            WHERE name NOT IN (SELECT name FROM files_storage)"
     c.execute(sql)
 
-    result = []
-    for row in c:
-        #filepath = row[0]
-        #modified = row[1]
-        #size = row[2]
-        result.append({'filepath': row[0], 'modified': row[1], 'size': row[2]})
+    state.db_conn.commit()
+    state.db_count_hash = 0
 
-    return result
+
+#-----------------------------------------------------------------------
+# Find stored file by content
+#-----------------------------------------------------------------------
+def find_storage_file_by_hash(state, content_hash):
+    """
+    Returns name of a stored file with this content, None if none.
+    Files stored in packs are not separate objects, they are skipped.
+    """
+    c = state.db_conn.cursor()
+
+    sql = "SELECT name FROM files_storage WHERE hash = ? \
+            AND NOT EXISTS (SELECT 1 FROM files_packed \
+                WHERE files_packed.name = files_storage.name) \
+            LIMIT 1"
+    c.execute(sql, (content_hash,))
+
+    row = c.fetchone()
+    if row:
+        return row[0]
+    return None
 
 
 #-----------------------------------------------------------------------
-# Add file to storage files
+# Storage holds file ?
 #-----------------------------------------------------------------------
-def add_update_storage_file(state, filepath, modified, size):
+def is_storage_file(state, filepath, modified, size):
     """
-    Adds or updates existing storage file with new date/size
+    True if storage has this very version of file
     """
-    # Open second temporary connection, if not opened yet
-    if not state.db_conn_upload or not state.db_curs_upload:
-        state.db_conn_upload = db_iface.db_open(state.model.filepath)
-        state.db_curs_upload = state.db_conn_upload.cursor()
-        state.db_count_upload = 0
+    c = state.db_conn.cursor()
 
-    sql = "INSERT OR REPLACE INTO files_storage \
-          (name, modified, size) VALUES('{}','{}','{}') \
-          ".format(filepath, modified, size)
+    sql = "SELECT 1 FROM files_storage \
+            WHERE name = ? AND modified = ? AND size = ?"
+    c.execute(sql, (filepath, modified, size))
+
+    return c.fetchone() is not None
+
+
+#-----------------------------------------------------------------------
+# Storage holds chunk ?
+#-----------------------------------------------------------------------
+def has_chunk(state, content_hash):
+    c = state.db_conn.cursor()
+
+    sql = "SELECT 1 FROM chunks WHERE hash = ?"
+    c.execute(sql, (content_hash,))
+
+    return c.fetchone() is not None
+
+
+#-----------------------------------------------------------------------
+# Add chunk to storage chunks
+#-----------------------------------------------------------------------
+def add_chunk(state, content_hash, size):
+    """
+    Committed with storage files, by finish_adding_storage_files()
+    """
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    sql = "INSERT OR REPLACE INTO chunks (hash, size) VALUES (?, ?)"
+    c.execute(sql, (content_hash, size))
+
+
+#-----------------------------------------------------------------------
+# Get chunks of stored file
+#-----------------------------------------------------------------------
+def get_file_chunks(state, filepath):
+    """
+    Returns list of (hash, size) of file stored in chunks,
+    None if file is stored whole
+    """
+    c = state.db_conn.cursor()
+
+    sql = "SELECT chunks FROM files_chunks WHERE name = ?"
+    c.execute(sql, (filepath,))
+
+    row = c.fetchone()
+    if not row:
+        return None
+
+    chunks = []
+    for item in row[0].split():
+        content_hash, size = item.split(':')
+        chunks.append((content_hash, int(size)))
+    return chunks
+
+
+#-----------------------------------------------------------------------
+# Add file stored in chunks to storage files
+#-----------------------------------------------------------------------
+def add_chunked_storage_file(state, filepath, modified, size, chunks):
+    """
+    Adds or updates storage file stored in chunks:
+        - chunks - list of (hash, size) in order of file content
+    File and its chunks are committed together, so that crash never
+    leaves file recorded as stored whole.
+    """
+    c = state.db_conn.cursor()
+
+    with state.db_conn.savepoint('add_chunked_storage_file'):
+        sql = "INSERT OR REPLACE INTO files_storage \
+              (name, modified, size, hash) VALUES (?, ?, ?, ?)"
+        c.execute(sql, (filepath, modified, size, None))
+
+        sql = "DELETE FROM files_packed WHERE name = ?"
+        c.execute(sql, (filepath,))
+
+        sql = "INSERT OR REPLACE INTO files_chunks (name, chunks) VALUES (?, ?)"
+        c.execute(sql, (filepath, ' '.join(
+                "{}:{}".format(content_hash, size) for content_hash, size in chunks)))
 
-    state.db_curs_upload.execute(sql)
+    state.db_conn.commit()
+    state.db_count_upload = 0
+
+
+#-----------------------------------------------------------------------
+# Remove pack from storage packs
+#-----------------------------------------------------------------------
+def remove_pack(state, name):
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    sql = "DELETE FROM packs WHERE name = ?"
+    c.execute(sql, (name,))
+
+    state.db_conn.commit()
+
+
+#-----------------------------------------------------------------------
+# Get packs to repack
+#-----------------------------------------------------------------------
+def get_obsolete_packs(state, live_ratio):
+    """
+    Returns list of (name, size, live size) of packs with less than
+    live_ratio of their size still holding current versions of files
+    """
+    c = state.db_conn.cursor()
+
+    sql = "SELECT packs.name, packs.size, \
+                COALESCE(SUM(files_packed.length), 0) AS live \
+            FROM packs LEFT JOIN files_packed \
+                ON files_packed.pack = packs.name \
+            GROUP BY packs.name \
+            HAVING live < packs.size * ?"
+    c.execute(sql, (live_ratio,))
+
+    return c.fetchall()
+
+
+#-----------------------------------------------------------------------
+# Get files of pack
+#-----------------------------------------------------------------------
+def get_pack_files(state, pack):
+    """
+    Returns list of (filepath, modified, size, hash, offset) of files
+    whose current version is in pack
+    """
+    c = state.db_conn.cursor()
+
+    sql = "SELECT files_storage.name, files_storage.modified, \
+                files_storage.size, files_storage.hash, files_packed.offset \
+            FROM files_packed JOIN files_storage \
+                ON files_storage.name = files_packed.name \
+            WHERE files_packed.pack = ? \
+            ORDER BY files_packed.offset"
+    c.execute(sql, (pack,))
+
+    return c.fetchall()
+
+
+#-----------------------------------------------------------------------
+# Get pack location of stored file
+#-----------------------------------------------------------------------
+def get_file_packed(state, filepath):
+    """
+    Returns (pack, offset, length) of file stored in pack,
+    None if file is not in pack
+    """
+    c = state.db_conn.cursor()
+
+    sql = "SELECT pack, offset, length FROM files_packed WHERE name = ?"
+    c.execute(sql, (filepath,))
+
+    return c.fetchone()
+
+
+#-----------------------------------------------------------------------
+# Add stored pack and its files
+#-----------------------------------------------------------------------
+def add_packed_storage_files(state, pack, pack_size, files):
+    """
+    Adds pack stored to storage, and adds or updates its files:
+        - files - list of (filepath, modified, size, hash, offset)
+    Pack and places of all its files are committed together, so that
+    crash never leaves file recorded as stored whole.
+    """
+    c = state.db_conn.cursor()
+
+    with state.db_conn.savepoint('add_packed_storage_files'):
+        sql = "INSERT OR REPLACE INTO packs (name, size) VALUES (?, ?)"
+        c.execute(sql, (pack, pack_size))
+
+        sql = "INSERT OR REPLACE INTO files_storage \
+              (name, modified, size, hash) VALUES (?, ?, ?, ?)"
+        c.executemany(sql, (f[:4] for f in files))
+
+        sql = "DELETE FROM files_chunks WHERE name = ?"
+        c.executemany(sql, ((f[0],) for f in files))
+
+        sql = "INSERT OR REPLACE INTO files_packed \
+                (name, pack, offset, length) VALUES (?, ?, ?, ?)"
+        c.executemany(sql, ((f[0], pack, f[4], f[2]) for f in files))
+
+    state.db_conn.commit()
+    state.db_count_upload = 0
+
+
+#-----------------------------------------------------------------------
+# Update date of stored file
+#-----------------------------------------------------------------------
+def update_storage_file_date(state, filepath, modified, size):
+    """
+    Updates date/size of storage file whose content did not change.
+    Where it is stored, whole, in chunks or in pack, is kept.
+    """
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    sql = "UPDATE files_storage SET modified = ?, size = ? WHERE name = ?"
+    c.execute(sql, (modified, size, filepath))
 
     # Commit after 50 queries
     state.db_count_upload += 1
     if state.db_count_upload > 50:
-        try:
-            state.db_conn_upload.commit()
-            _D.DEBUG(
-                    __name__,
-                    "SQLite3 Commited (groups of 50)",
-                    'last file', filepath
-                    )
-        except Exception as e:
-            import sys
-            (exc_type, exc_value, exc_traceback) = sys.exc_info()
-            _D.WARNING(
-                    __name__,
-                    "SQLite3 Error",
-                    'msg', exc_value,
-                    'file', filepath
-                    )
-            raise e
-
+        state.db_conn.commit()
         state.db_count_upload = 0
 
 
 #-----------------------------------------------------------------------
-# Commit all storage files adds
+# Add file to storage files
 #-----------------------------------------------------------------------
-def finish_adding_storage_files(state):
+def add_update_storage_file(state, filepath, modified, size, content_hash = None):
     """
+    Adds or updates existing storage file with new date/size/hash
     """
-    # Secondary connection must be open
-    if not state.db_conn_upload or not state.db_curs_upload:
-        _D.ERROR(
-                __name__,
-                "Temporary connection for adding storage files must be open"
-                )
-        return
+    add_update_storage_files(state, [(filepath, modified, size, content_hash)])
 
-    _D.DEBUG(
-            __name__,
-            "SQLite3 Commited less than 50 files"
-            )
 
-    state.db_conn_upload.commit()
-    state.db_conn_upload.close()
+#-----------------------------------------------------------------------
+# Add files to storage files
+#-----------------------------------------------------------------------
+def add_update_storage_files(state, files):
+    """
+    Adds or updates existing storage files with new date/size:
+        - files - list of (filepath, modified, size, hash),
+          hash is None if not known
+    Committed in groups, so that crash keeps record of stored files.
+    """
+    state.db_conn.begin()
+    c = state.db_conn.cursor()
+
+    sql = "INSERT OR REPLACE INTO files_storage \
+          (name, modified, size, hash) VALUES (?, ?, ?, ?)"
+
+    c.executemany(sql, files)
+
+    # New version is stored whole
+    sql = "DELETE FROM files_chunks WHERE name = ?"
+
+    c.executemany(sql, ((f[0],) for f in files))
 
-    state.db_conn_upload = None
-    state.db_curs_upload = None
+    sql = "DELETE FROM files_packed WHERE name = ?"
+
+    c.executemany(sql, ((f[0],) for f in files))
+
+    # Commit after 50 queries
+    state.db_count_upload += len(files)
+    if state.db_count_upload > 50:
+        state.db_conn.commit()
+        state.db_count_upload = 0
+
+
+#-----------------------------------------------------------------------
+# Commit all storage files adds
+#-----------------------------------------------------------------------
+def finish_adding_storage_files(state):
+    state.db_conn.commit()
+    state.db_count_upload = 0
 
 
 #-----------------------------------------------------------------------
@@ -399,18 +1109,12 @@ def add_stats(state, date, size):
         - date as plain text
         - size in bytes, integer
     """
-    # Open second temporary connection
-    conn_temp = db_iface.db_open(state.model.filepath)
-    cursor_temp = conn_temp.cursor()
+    c = state.db_conn.cursor()
 
-    sql = "INSERT INTO stats \
-            VALUES ('{}','{}') \
-            ".format(date, size)
-    cursor_temp.execute(sql)
+    sql = "INSERT INTO stats (date, size) VALUES (?, ?)"
+    c.execute(sql, (date, size))
 
-    # Commit and close temporary connection
-    conn_temp.commit()
-    conn_temp.close()
+    state.db_conn.commit()
 
 
 #-----------------------------------------------------------------------
@@ -583,12 +1287,12 @@ def execute(state):
 def cleanup(state):
     '''Cleanup state'''
 
-    # Vacuum DB to minimize size
+    # Vacuum DB to minimize size, not possible inside transaction
+    state.db_conn.commit()
     c = state.db_conn.cursor()
     if c:
         sql = "VACUUM"
         c.execute(sql)
-        state.db_conn.commit()
 
     # Disconnect DB
     _disconnect(state)
@@ -88,17 +88,35 @@ def _connect(state):
                 )
         '''
 
+        state.db_conn.begin()
         c = state.db_conn.cursor()
         sql = "CREATE TABLE versions \
                 ( \
                 id INTEGER PRIMARY KEY, \
                 date INTEGER UNIQUE, \
                 file TEXT, \
-                size INTEGER \
+                size INTEGER, \
+                md5 TEXT \
                 )"
         c.execute(sql)
         state.db_conn.commit()
 
+    _upgrade(state)
+
+
+#-----------------------------------------------------------------------
+# Upgrade DB created by older version
+#-----------------------------------------------------------------------
+def _upgrade(state):
+    c = state.db_conn.cursor()
+    c.execute("PRAGMA table_info(versions)")
+    columns = [row[1] for row in c.fetchall()]
+
+    if 'md5' not in columns:
+        state.db_conn.begin()
+        c.execute("ALTER TABLE versions ADD COLUMN md5 TEXT")
+        state.db_conn.commit()
+
 
 #-----------------------------------------------------------------------
 # Disconnect DB
@@ -118,14 +136,16 @@ def get_db_file_size(state):
 #-----------------------------------------------------------------------
 # Add file to DB
 #-----------------------------------------------------------------------
-def add_version(state, filename, size):
+def add_version(state, filename, size, md5 = None):
+    '''
+    md5 - hex digest of stored file, None if not computed
+    '''
     c = state.db_conn.cursor()
 
     sql = "INSERT OR REPLACE \
-            INTO versions (date, file, size) \
-            VALUES ('{}', '{}', '{}')\
-            ".format(state.model.date_int, filename, size)
-    c.execute(sql)
+            INTO versions (date, file, size, md5) \
+            VALUES (?, ?, ?, ?)"
+    c.execute(sql, (state.model.date_int, filename, size, md5))
     state.db_conn.commit()
 
 
@@ -146,6 +166,7 @@ def remove_versions_older_than(state, count):
 
     count += 1
 
+    state.db_conn.begin()
     c = state.db_conn.cursor()
     sql = "SELECT * FROM versions ORDER BY date DESC"
     c.execute(sql)
@@ -160,13 +181,11 @@ def remove_versions_older_than(state, count):
             continue
 
         files.append(row[2])
-        ids.append(str(row[0]))
+        ids.append((row[0],))
 
     # Remove rows with ids
-    sql = "DELETE FROM versions \
-            WHERE id IN ({}) \
-            ".format(', '.join(ids))
-    c.execute(sql)
+    sql = "DELETE FROM versions WHERE id = ?"
+    c.executemany(sql, ids)
     state.db_conn.commit()
 
     return files
@@ -261,12 +280,12 @@ def execute(state):
 def cleanup(state):
     '''Cleanup state'''
 
-    # Vacuum DB to minimize size
+    # Vacuum DB to minimize size, not possible inside transaction
+    state.db_conn.commit()
     c = state.db_conn.cursor()
     if c:
         sql = "VACUUM"
         c.execute(sql)
-        state.db_conn.commit()
 
     # Disconnect DB
     _disconnect(state)
@@ -82,6 +82,7 @@ def _connect(state):
                 )
         '''
 
+        state.db_conn.begin()
         c = state.db_conn.cursor()
         sql = "CREATE TABLE sessions_store \
                 ( \
@@ -112,28 +113,26 @@ def get_db_file_size(state):
 # Update Stats DB - store type
 #-----------------------------------------------------------------------
 def update_stored(state, atype, size):
+        state.db_conn.begin()
         c = state.db_conn.cursor()
 
         # Check for pre-existing
         sql = "SELECT * FROM sessions_store \
-                WHERE date='{}' AND backup_type='{}'\
-                ".format(state.model.date_int, atype)
+                WHERE date = ? AND backup_type = ?"
 
-        c.execute(sql)
+        c.execute(sql, (state.model.date_int, atype))
         row = c.fetchone()
 
         if row:
             # Pre-existing
-            sql = "UPDATE sessions_store \
-                    SET size='{}' WHERE id='{}'\
-                    ".format(row[3] + size, row[0])
+            sql = "UPDATE sessions_store SET size = ? WHERE id = ?"
+            c.execute(sql, (row[3] + size, row[0]))
         else:
             # New row
             sql = "INSERT INTO sessions_store (date, backup_type, size) \
-                VALUES ('{}', '{}', '{}') \
-                ".format(state.model.date_int, atype, size)
+                VALUES (?, ?, ?)"
+            c.execute(sql, (state.model.date_int, atype, size))
 
-        c.execute(sql)
         state.db_conn.commit()
 
 
@@ -141,28 +140,25 @@ def update_stored(state, atype, size):
 # Update Stats DB - store total
 #-----------------------------------------------------------------------
 def update_stored_total(state, size):
+        state.db_conn.begin()
         c = state.db_conn.cursor()
 
         # Check for pre-existing
         sql = "SELECT * FROM sessions_store \
-                WHERE date='{}' AND backup_type IS NULL\
-                ".format(state.model.date_int)
+                WHERE date = ? AND backup_type IS NULL"
 
-        c.execute(sql)
+        c.execute(sql, (state.model.date_int,))
         row = c.fetchone()
 
         if row:
             # Pre-existing
-            sql = "UPDATE sessions_store \
-                    SET size='{}' WHERE id='{}'\
-                    ".format(row[3] + size, row[0])
+            sql = "UPDATE sessions_store SET size = ? WHERE id = ?"
+            c.execute(sql, (row[3] + size, row[0]))
         else:
             # New row
-            sql = "INSERT INTO sessions_store (date, size) \
-                VALUES ('{}', '{}') \
-                ".format(state.model.date_int, size)
+            sql = "INSERT INTO sessions_store (date, size) VALUES (?, ?)"
+            c.execute(sql, (state.model.date_int, size))
 
-        c.execute(sql)
         state.db_conn.commit()
 
 
@@ -202,10 +198,8 @@ def update(state, stored_stats, restored_stats):
 #-----------------------------------------------------------------------
 def dump(state):
         c = state.db_conn.cursor()
-        sql = "SELECT * FROM sessions_store \
-                WHERE date='{}' \
-                ".format(state.model.date_int)
-        c.execute(sql)
+        sql = "SELECT * FROM sessions_store WHERE date = ?"
+        c.execute(sql, (state.model.date_int,))
 
         entries = {}
         for row in c:
@@ -289,12 +283,12 @@ def execute(state):
 def cleanup(state):
     '''Cleanup state'''
 
-    # Vacuum DB to minimize size
+    # Vacuum DB to minimize size, not possible inside transaction
+    state.db_conn.commit()
     c = state.db_conn.cursor()
     if c:
         sql = "VACUUM"
         c.execute(sql)
-        state.db_conn.commit()
 
     # Disconnect DB
     _disconnect(state)
@@ -15,10 +15,10 @@ import aeroback.util.fmt as fmtutil
 
 '''
 Mongo feeder module:
-    - dumps Mongo DB
+    - dumps Mongo DB, once for all storages
     - compresses into TAR
-    - stores to storage
-    - updates tracking DB
+    - stores to all storages at the same time
+    - updates tracking DB of each storage
 
 Required modules:
     - storager
@@ -27,6 +27,9 @@ Children modules:
     - dbr_filevers
 '''
 
+# Feeder is executed once with states of all storages
+FANOUT = True
+
 
 #-----------------------------------------------------------------------
 # States for other modules
@@ -34,13 +37,14 @@ Children modules:
 class States(object):
 
     def __init__(self):
-        self.storager = None
-        self.dbr = None
+        # Storager and its tracking DB, per storage
+        self.storagers = []
+        self.dbrs = []
 
     def debug_vars(self):
         return [
-                'storager', self.storager,
-                'dbr', self.dbr
+                'storagers', self.storagers,
+                'dbrs', self.dbrs
                 ]
 
 
@@ -153,25 +157,29 @@ def _init_model(date_str, date_int, dir_temp, params):
 #-----------------------------------------------------------------------
 # Initialize state
 #-----------------------------------------------------------------------
-def _init_state(model, storstate):
-    if not storstate:
-        return 1, "storstate must be provided"
+def _init_state(model, storstates):
+    if not storstates:
+        return None, 1, "storstates must be provided"
 
     state = State(model)
 
-    # Storager state
-    state.states.storager = storstate
+    # Storager states
+    state.states.storagers = storstates
 
-    # Init storage stats manager
-    dbrstate, err, msg = dbr.init(
-            model.date_str,
-            model.date_int,
-            model.dir_temp,
-            "_aeroback_{}.db".format(model.atype))
-    if err:
-        return None, err, msg
+    # Init tracking DB of each storage, in own directory
+    for i, storstate in enumerate(storstates):
+        dir_db = os.path.join(model.dir_temp, "storage_{}".format(i))
+        os.makedirs(dir_db)
+
+        dbrstate, err, msg = dbr.init(
+                model.date_str,
+                model.date_int,
+                dir_db,
+                "_aeroback_{}.db".format(model.atype))
+        if err:
+            return None, err, msg
 
-    state.states.dbr = dbrstate
+        state.states.dbrs.append(dbrstate)
 
     return state, 0, None
 
@@ -179,7 +187,7 @@ def _init_state(model, storstate):
 #-----------------------------------------------------------------------
 # Initialize module
 #-----------------------------------------------------------------------
-def init(date_str, date_int, dir_temp, storstate, params):
+def init(date_str, date_int, dir_temp, storstates, params):
     ''' Initialize model and state'''
 
     # Model
@@ -196,7 +204,7 @@ def init(date_str, date_int, dir_temp, storstate, params):
     '''
 
     # State
-    state, err, msg = _init_state(model, storstate)
+    state, err, msg = _init_state(model, storstates)
     if err:
         return State(None), err, msg
 
@@ -206,6 +214,7 @@ def init(date_str, date_int, dir_temp, storstate, params):
     # Descriptors for reporting
     state.set_descriptor('Tables', 'All')
     state.set_descriptor('History size', state.model.history_size)
+    state.set_descriptor('Storages', [s.model.atype for s in storstates])
 
     # Stats for reporting
     state.set_stats('Stats:', '&nbsp')
@@ -303,35 +312,45 @@ def _archive_dump(state):
 # Store archived DB dump
 #-----------------------------------------------------------------------
 def _store_archive(state):
-    err, msg = storager.store(
-            state.states.storager,
+    results = storager.store_all(
+            state.states.storagers,
             state.archive_filepath,
             state.model.dirstorage,
             state.model.atype)
-    if err:
-        return 1, "Error storing DB archive: {}".format(msg)
 
-    state.total_stored_files += 1
     size = os.stat(state.archive_filepath).st_size
-    state.set_stats('Uploaded', fmtutil.byte_size(size))
 
-    # Add file to DB
-    dbr.add_version(
-            state.states.dbr,
-            state.archive_filename,
-            size)
-
-    # Get list of older versions to remove
-    filenames = dbr.remove_versions_older_than(
-            state.states.dbr,
-            state.model.history_size)
-
-    # Remove files from storage
-    for filename in filenames:
-        storager.unstore(
-                state.states.storager,
+    # Storage failing is only reported: others have already removed
+    # old versions, their tracking DBs must still be stored by cleanup
+    for storstate, dbrstate, (err, msg) in zip(state.states.storagers, state.states.dbrs, results):
+        if err:
+            state.add_msg_error("Error storing DB archive to {}: {}".format(
+                    storstate.model.atype, msg))
+            continue
+
+        state.total_stored_files += 1
+
+        # Add file to DB
+        dbr.add_version(
+                dbrstate,
+                state.archive_filename,
+                size)
+
+        # Get list of older versions to remove
+        filenames = dbr.remove_versions_older_than(
+                dbrstate,
+                state.model.history_size)
+
+        # Remove files from storage
+        storager.unstore_many(
+                storstate,
                 state.model.dirstorage,
-                filename)
+                filenames)
+
+    if not state.total_stored_files:
+        return 1, "Error storing {}: no storage succeeded".format(what)
+
+    state.set_stats('Uploaded', fmtutil.byte_size(size))
 
     return 0, None
 
@@ -340,26 +359,27 @@ def _store_archive(state):
 # Execute module
 #-----------------------------------------------------------------------
 def execute(state):
-    # Restore tracking DB from storage, ignore possible error
-    err, msg = storager.restore(
-            state.states.storager,
-            state.model.dirstorage,
-            state.states.dbr.model.dir_db,
-            state.states.dbr.model.filename,
-            None)
-    if err:
-        warn = "Backup {}: Tracking DB not found in storage. Ignore if that's the first run".format(state.model.atype)
-        state.add_msg_warning(warn)
-        _D.WARNING(
-                __name__,
-                warn,
-                'msg', msg
-                )
-
-    # Tracking DBr execute
-    err, msg = dbr.execute(state.states.dbr)
-    if err:
-        return 1, msg
+    # Restore tracking DBs from storages, ignore possible error
+    for storstate, dbrstate in zip(state.states.storagers, state.states.dbrs):
+        err, msg = storager.restore(
+                storstate,
+                state.model.dirstorage,
+                dbrstate.model.dir_db,
+                dbrstate.model.filename,
+                None)
+        if err:
+            warn = "Backup {}: Tracking DB not found in storage {}. Ignore if that's the first run".format(state.model.atype, storstate.model.atype)
+            state.add_msg_warning(warn)
+            _D.WARNING(
+                    __name__,
+                    warn,
+                    'msg', msg
+                    )
+
+        # Tracking DBr execute
+        err, msg = dbr.execute(dbrstate)
+        if err:
+            return 1, msg
 
     # Dump DB
     if state.model.atype == 'db_mongo':
@@ -391,28 +411,29 @@ def execute(state):
 def cleanup(state):
     '''Cleanup state'''
 
-    # Dump DBr
-    '''
-    dbr.dump(state.states.dbr)
-    '''
+    for storstate, dbrstate in zip(state.states.storagers, state.states.dbrs):
+        # Dump DBr
+        '''
+        dbr.dump(dbrstate)
+        '''
 
-    # Disconnect DBr
-    dbr.cleanup(state.states.dbr)
+        # Disconnect DBr
+        dbr.cleanup(dbrstate)
 
-    # Get DB file size for statistics
-    db_size = fmtutil.byte_size(dbr.get_db_file_size(state.states.dbr))
-    state.set_stats_category('Tracking DB', 'Size', db_size)
+        # Get DB file size for statistics
+        db_size = fmtutil.byte_size(dbr.get_db_file_size(dbrstate))
+        state.set_stats_category('Tracking DB', "Size {}".format(storstate.model.atype), db_size)
 
-    # Store DB (local --> storage)
-    err, msg = storager.store(
-            state.states.storager,
-            state.states.dbr.model.filepath,
-            state.model.dirstorage,
-            None)
-    if err:
-        _D.ERROR(
-                __name__,
-                "Error storing DB",
-                'file', state.states.dbr.model.filename,
-                'msg', msg
-                )
+        # Store DB (local --> storage)
+        err, msg = storager.store(
+                storstate,
+                dbrstate.model.filepath,
+                state.model.dirstorage,
+                None)
+        if err:
+            _D.ERROR(
+                    __name__,
+                    "Error storing DB",
+                    'file', dbrstate.model.filename,
+                    'msg', msg
+                    )
@@ -15,10 +15,11 @@ import aeroback.util.fmt as fmtutil
 
 '''
 Dir Compress feeder module:
-    - compresses directory into TAR
-    - stores to storage
-    - updates versioned file tracking DB
-    - stores DB
+    - compresses directory into TAR, once for all storages
+    - stores to all storages at the same time,
+      or streams TAR directly to them
+    - updates versioned file tracking DB of each storage
+    - stores DBs
 
 Required modules:
     - storager
@@ -27,6 +28,9 @@ Children modules:
     - dbr_filevers
 '''
 
+# Feeder is executed once with states of all storages
+FANOUT = True
+
 
 #-----------------------------------------------------------------------
 # States for other modules
@@ -34,13 +38,14 @@ Children modules:
 class States(object):
 
     def __init__(self):
-        self.storager = None
-        self.dbr = None
+        # Storager and its tracking DB, per storage
+        self.storagers = []
+        self.dbrs = []
 
     def debug_vars(self):
         return [
-                'storager', self.storager,
-                'dbr', self.dbr
+                'storagers', self.storagers,
+                'dbrs', self.dbrs
                 ]
 
 
@@ -49,7 +54,7 @@ class States(object):
 #-----------------------------------------------------------------------
 class Model(A_Model):
 
-    def __init__(self, atype, dirs, dirstorage, description, history_size, date_str, date_int, dir_temp):
+    def __init__(self, atype, dirs, dirstorage, description, history_size, stream, date_str, date_int, dir_temp):
         super(Model, self).__init__()
 
         self.atype = atype
@@ -57,6 +62,7 @@ class Model(A_Model):
         self.dirstorage = dirstorage
         self.description = description
         self.history_size = history_size
+        self.stream = stream
         self.date_str = date_str
         self.date_int = date_int
         self.dir_temp = dir_temp
@@ -68,6 +74,7 @@ class Model(A_Model):
                 'dirstorage', self.dirstorage,
                 'description', self.description,
                 'history_size', self.history_size,
+                'stream', self.stream,
                 'date_str', self.date_str,
                 'date_int', self.date_int,
                 'dir_temp', self.dir_temp
@@ -152,6 +159,7 @@ def _init_model(date_str, date_int, dir_temp, params):
                 dirstorage = params['dirstorage'],
                 description = params['description'],
                 history_size = params['history'],
+                stream = params.get('stream', False),
                 date_str = date_str,
                 date_int = date_int,
                 dir_temp = dir_temp
@@ -163,27 +171,31 @@ def _init_model(date_str, date_int, dir_temp, params):
 #-----------------------------------------------------------------------
 # Initialize state
 #-----------------------------------------------------------------------
-def _init_state(model, storstate):
-    if not storstate:
-        return 1, "storstate must be provided"
+def _init_state(model, storstates):
+    if not storstates:
+        return None, 1, "storstates must be provided"
 
     state = State(model)
 
-    # Storager state
-    state.states.storager = storstate
+    # Storager states
+    state.states.storagers = storstates
 
-    # Init storage stats manager
+    # Init tracking DB of each storage, in own directory
     #NOTE we save all dirs into one single archive file
     #NOTE archived name for now: _aeroback_dir_compress.db
-    dbrstate, err, msg = dbr.init(
-            model.date_str,
-            model.date_int,
-            model.dir_temp,
-            "_aeroback_{}.db".format(model.atype))
-    if err:
-        return None, err, msg
+    for i, storstate in enumerate(storstates):
+        dir_db = os.path.join(model.dir_temp, "storage_{}".format(i))
+        os.makedirs(dir_db)
+
+        dbrstate, err, msg = dbr.init(
+                model.date_str,
+                model.date_int,
+                dir_db,
+                "_aeroback_{}.db".format(model.atype))
+        if err:
+            return None, err, msg
 
-    state.states.dbr = dbrstate
+        state.states.dbrs.append(dbrstate)
 
     return state, 0, None
 
@@ -191,7 +203,7 @@ def _init_state(model, storstate):
 #-----------------------------------------------------------------------
 # Initialize module
 #-----------------------------------------------------------------------
-def init(date_str, date_int, dir_temp, storstate, params):
+def init(date_str, date_int, dir_temp, storstates, params):
     ''' Initialize model and state'''
 
     # Model
@@ -208,7 +220,7 @@ def init(date_str, date_int, dir_temp, storstate, params):
     '''
 
     # State
-    state, err, msg = _init_state(model, storstate)
+    state, err, msg = _init_state(model, storstates)
     if err:
         return State(None), err, msg
 
@@ -220,6 +232,8 @@ def init(date_str, date_int, dir_temp, storstate, params):
     state.set_descriptor('Storage dir', state.model.dirstorage)
     state.set_descriptor('Local dirs', state.model.dirs)
     state.set_descriptor('History size', state.model.history_size)
+    state.set_descriptor('Streaming', state.model.stream)
+    state.set_descriptor('Storages', [s.model.atype for s in storstates])
 
     # Stats for reporting
     state.set_stats('Stats:', '&nbsp')
@@ -228,9 +242,9 @@ def init(date_str, date_int, dir_temp, storstate, params):
 
 
 #-----------------------------------------------------------------------
-# Archive dirs
+# Archive name
 #-----------------------------------------------------------------------
-def _archive_dirs(state):
+def _archive_name(state):
     name = '-'.join(state.model.description.lower().split())
     if len(name) > 100:
         name = name[:99]
@@ -241,11 +255,19 @@ def _archive_dirs(state):
             state.archive_filename
             )
 
+
+#-----------------------------------------------------------------------
+# TAR invocation
+#-----------------------------------------------------------------------
+def _tar_invocation(state, flags, target):
+    '''
+    target is archive file path, or '-' for standard output
+    '''
     # Read TAR help on -C option:
     # http://www.gnu.org/software/tar/manual/html_section/one.html#SEC117
     invocation = ['tar',
-                '-czvf',
-                state.archive_filepath]
+                flags,
+                target]
 
     # Append each dir
     for d in state.model.dirs:
@@ -265,47 +287,115 @@ def _archive_dirs(state):
         invocation.append(parent)
         invocation.append(folder)
 
+    return invocation
+
+
+#-----------------------------------------------------------------------
+# Archive dirs
+#-----------------------------------------------------------------------
+def _archive_dirs(state):
+    _archive_name(state)
+
+    invocation = _tar_invocation(state, '-czvf', state.archive_filepath)
+
     res, err, msg = cmdutil.call_cmd(invocation)
     if err:
         return 1, "Error archiving dirs: {}".format(msg)
     else:
         return 0, None
-    pass
 
 
 #-----------------------------------------------------------------------
 # Store archived dirs
 #-----------------------------------------------------------------------
 def _store_archive(state):
-    err, msg = storager.store(
-            state.states.storager,
+    results = storager.store_all(
+            state.states.storagers,
             state.archive_filepath,
             state.model.dirstorage,
             state.model.atype)
-    if err:
-        return 1, "Error storing archive: {}".format(msg)
 
-    state.total_stored_files += 1
     size = os.stat(state.archive_filepath).st_size
-    state.set_stats('Uploaded', fmtutil.byte_size(size))
 
-    # Add file to DB
-    dbr.add_version(
-            state.states.dbr,
+    return _add_versions(state, results, size, None)
+
+
+#-----------------------------------------------------------------------
+# Stream archive of dirs directly to storages
+#-----------------------------------------------------------------------
+def _stream_archive(state):
+    _archive_name(state)
+
+    invocation = _tar_invocation(state, '-czf', '-')
+
+    proc, err, msg = cmdutil.open_cmd(invocation)
+    if err:
+        return 1, "Error archiving dirs: {}".format(msg)
+
+    (size, md5), results = storager.store_stream_all(
+            state.states.storagers,
+            proc.stdout,
+            state.model.dirstorage,
             state.archive_filename,
-            size)
+            state.model.atype)
+
+    failed = all(err for err, msg in results)
+    res, tar_err, tar_msg = cmdutil.close_cmd(proc, kill = failed)
+
+    if tar_err:
+        # Stored archives are incomplete
+        for storstate, (err, msg) in zip(state.states.storagers, results):
+            if not err:
+                storager.unstore(
+                        storstate,
+                        state.model.dirstorage,
+                        state.archive_filename)
+        return 1, "Error archiving dirs: {}".format(tar_msg)
 
-    # Get list of older versions to remove
-    filenames = dbr.remove_versions_older_than(
-            state.states.dbr,
-            state.model.history_size)
+    return _add_versions(state, results, size, md5)
 
-    # Remove files from storage
-    for filename in filenames:
-        storager.unstore(
-                state.states.storager,
+
+#-----------------------------------------------------------------------
+# Track stored archive, remove old versions
+#-----------------------------------------------------------------------
+def _add_versions(state, results, size, md5):
+    '''
+    Updates tracking DB of each storage the archive was stored to.
+    results - [(err, msg), ...] of storing, per storage
+    Storage failing is only reported: others have already removed
+    old versions, their tracking DBs must still be stored by cleanup.
+    Error only if no storage succeeded.
+    '''
+    for storstate, dbrstate, (err, msg) in zip(state.states.storagers, state.states.dbrs, results):
+        if err:
+            state.add_msg_error("Error storing archive to {}: {}".format(
+                    storstate.model.atype, msg))
+            continue
+
+        state.total_stored_files += 1
+
+        # Add file to DB
+        dbr.add_version(
+                dbrstate,
+                state.archive_filename,
+                size,
+                md5)
+
+        # Get list of older versions to remove
+        filenames = dbr.remove_versions_older_than(
+                dbrstate,
+                state.model.history_size)
+
+        # Remove files from storage
+        storager.unstore_many(
+                storstate,
                 state.model.dirstorage,
-                filename)
+                filenames)
+
+    if not state.total_stored_files:
+        return 1, "Error storing {}: no storage succeeded".format(what)
+
+    state.set_stats('Uploaded', fmtutil.byte_size(size))
 
     return 0, None
 
@@ -315,26 +405,35 @@ def _store_archive(state):
 #-----------------------------------------------------------------------
 def execute(state):
 
-    # Restore tracking DB from storage, ignore possible error
-    err, msg = storager.restore(
-            state.states.storager,
-            "{}/{}".format(state.model.dirstorage, '_aeroback'),
-            state.states.dbr.model.dir_db,
-            state.states.dbr.model.filename,
-            None)
-    if err:
-        warn = "Backup {}: File Versioned Tracking DB not found in storage. Ignore if that's the first run".format(state.model.atype)
-        state.add_msg_warning(warn)
-        _D.WARNING(
-                __name__,
-                warn,
-                'msg', msg
-                )
+    # Restore tracking DBs from storages, ignore possible error
+    for storstate, dbrstate in zip(state.states.storagers, state.states.dbrs):
+        err, msg = storager.restore(
+                storstate,
+                "{}/{}".format(state.model.dirstorage, '_aeroback'),
+                dbrstate.model.dir_db,
+                dbrstate.model.filename,
+                None)
+        if err:
+            warn = "Backup {}: File Versioned Tracking DB not found in storage {}. Ignore if that's the first run".format(state.model.atype, storstate.model.atype)
+            state.add_msg_warning(warn)
+            _D.WARNING(
+                    __name__,
+                    warn,
+                    'msg', msg
+                    )
 
-    # Tracking DBr execute
-    err, msg = dbr.execute(state.states.dbr)
-    if err:
-        return 1, msg
+        # Tracking DBr execute
+        err, msg = dbr.execute(dbrstate)
+        if err:
+            return 1, msg
+
+    # Compress directories straight into storages
+    if state.model.stream:
+        err, msg = _stream_archive(state)
+        if err:
+            return 1, msg
+
+        return 0, None
 
     # Compress directories
     err, msg = _archive_dirs(state)
@@ -355,28 +454,29 @@ def execute(state):
 def cleanup(state):
     '''Cleanup state'''
 
-    # Dump DBr
-    '''
-    dbr.dump(state.states.dbr)
-    '''
-
-    # Disconnect DBr
-    dbr.cleanup(state.states.dbr)
-
-    # Get DB file size for statistics
-    db_size = fmtutil.byte_size(dbr.get_db_file_size(state.states.dbr))
-    state.set_stats_category('Tracking DB', 'Size', db_size)
-
-    # Store DB (local --> storage)
-    err, msg = storager.store(
-            state.states.storager,
-            state.states.dbr.model.filepath,
-            "{}/{}".format(state.model.dirstorage, '_aeroback'),
-            None)
-    if err:
-        _D.ERROR(
-                __name__,
-                "Error storing File Versioned Tracking DB",
-                'file', state.states.dbr.model.filename,
-                'msg', msg
-                )
+    for storstate, dbrstate in zip(state.states.storagers, state.states.dbrs):
+        # Dump DBr
+        '''
+        dbr.dump(dbrstate)
+        '''
+
+        # Disconnect DBr
+        dbr.cleanup(dbrstate)
+
+        # Get DB file size for statistics
+        db_size = fmtutil.byte_size(dbr.get_db_file_size(dbrstate))
+        state.set_stats_category('Tracking DB', "Size {}".format(storstate.model.atype), db_size)
+
+        # Store DB (local --> storage)
+        err, msg = storager.store(
+                storstate,
+                dbrstate.model.filepath,
+                "{}/{}".format(state.model.dirstorage, '_aeroback'),
+                None)
+        if err:
+            _D.ERROR(
+                    __name__,
+                    "Error storing File Versioned Tracking DB",
+                    'file', dbrstate.model.filename,
+                    'msg', msg
+                    )
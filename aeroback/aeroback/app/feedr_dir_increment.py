@@ -1,5 +1,8 @@
 import os
 import re
+import shutil
+import hashlib
+import tempfile
 
 #-----------------------------------------------------------------------
 from aeroback.abstractions.a_model import A_Model
@@ -9,16 +12,23 @@ import aeroback.diagnostics.diagnostics as _D
 
 import storager
 import dbr_fileincr as dbr
+import iface.fs_scandir as fs_iface
+import iface.fs_inotify as inotify_iface
+import iface.fs_hash as hash_iface
+import iface.fs_chunk as chunk_iface
 
 import aeroback.util.fmt as fmtutil
 import aeroback.util.fs as fsutil
 
 '''
 Dir Increment feeder module:
+    - scans local files once for all storages
     - finds differences between local files and files in DB
-    - stores new/modified files to storage
-    - updates incremental file tracking DB
-    - stores DB
+      of each storage
+    - stores new/modified files to each storage, large files
+      in content-defined chunks, small files in packs
+    - updates incremental file tracking DB of each storage
+    - stores DBs
 
 Required modules:
     - storager
@@ -35,6 +45,21 @@ Status accumulates statistics:
         - bytes stored
 '''
 
+# Feeder is executed once with states of all storages
+FANOUT = True
+
+# Storage directory of chunks, inside dirstorage
+CHUNKS_DIR = '_chunks'
+
+# Storage directory of packs, inside dirstorage
+PACKS_DIR = '_packs'
+
+# Pack is stored once it reaches this size
+PACK_SIZE = 64 * 1024 * 1024
+
+# Packs with less than this part of content still current are repacked
+REPACK_LIVE_RATIO = 0.5
+
 
 #-----------------------------------------------------------------------
 # States for other modules
@@ -42,13 +67,18 @@ Status accumulates statistics:
 class States(object):
 
     def __init__(self):
-        self.storager = None
+        # Storager and its tracking DB, per storage
+        self.storagers = []
+        self.dbrs = []
+
+        # Tracking DB of first storage, keeps directory cache
+        # and local files of the scan shared by all storages
         self.dbr = None
 
     def debug_vars(self):
         return [
-                'storager', self.storager,
-                'dbr', self.dbr
+                'storagers', self.storagers,
+                'dbrs', self.dbrs
                 ]
 
 
@@ -57,7 +87,7 @@ class States(object):
 #-----------------------------------------------------------------------
 class Model(A_Model):
 
-    def __init__(self, atype, directory, dirstorage, maxupload, ignore_patterns, includes, excludes, description, date_str, date_int, dir_temp):
+    def __init__(self, atype, directory, dirstorage, maxupload, ignore_patterns, includes, excludes, threads, dircache, dircache_rescan, journal, content_hash, chunked, packed, description, date_str, date_int, dir_temp):
         super(Model, self).__init__()
 
         self.atype = atype
@@ -67,6 +97,13 @@ class Model(A_Model):
         self.ignore_patterns = ignore_patterns
         self.includes = includes
         self.excludes = excludes
+        self.threads = threads
+        self.dircache = dircache
+        self.dircache_rescan = dircache_rescan
+        self.journal = journal
+        self.content_hash = content_hash
+        self.chunked = chunked
+        self.packed = packed
         self.description = description
         self.date_str = date_str
         self.date_int = date_int
@@ -81,6 +118,13 @@ class Model(A_Model):
                 'ignore_patterns', self.ignore_patterns,
                 'includes', self.includes,
                 'excludes', self.excludes,
+                'threads', self.threads,
+                'dircache', self.dircache,
+                'dircache_rescan', self.dircache_rescan,
+                'journal', self.journal,
+                'content_hash', self.content_hash,
+                'chunked', self.chunked,
+                'packed', self.packed,
                 'description', self.description,
                 'date_str', self.date_str,
                 'date_int', self.date_int,
@@ -104,10 +148,49 @@ class State(A_State):
         self.total_stored_files = 0
         self.total_stored_size = 0
 
+        # Processes hashing content, while storing
+        self.hash_pool = None
+
+        # Chunks of files split this run, for other storages:
+        # filepath --> (stat key, [(hash, size), ...])
+        self.chunk_manifests = {}
+
     def debug_vars(self):
         return []
 
 
+#-----------------------------------------------------------------------
+# Pack being written
+#-----------------------------------------------------------------------
+class _Pack(object):
+    '''
+    Files appended one after another to temporary file.
+    Pack is named by hash of its content once closed.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'wb')
+        self.digest = hashlib.sha1()
+        self.size = 0
+
+        # (filepath, modified, size, hash, offset)
+        self.files = []
+
+    def add(self, filepath, modified, content_hash, data):
+        self.fp.write(data)
+        self.digest.update(data)
+        self.files.append((filepath, modified, len(data), content_hash, self.size))
+        self.size += len(data)
+
+    def close(self):
+        '''
+        Returns name of pack
+        '''
+        self.fp.close()
+        return self.digest.hexdigest()
+
+
 #-----------------------------------------------------------------------
 # Initialize model
 #-----------------------------------------------------------------------
@@ -201,9 +284,9 @@ def _init_model(date_str, date_int, dir_temp, params):
             r'^.*~$'   # ends with    ~   'hello.txt~'
             ]
 
-    ignore_patterns = []
-    for p in patterns:
-        ignore_patterns.append(re.compile(p))
+    # Single regex for all patterns, one search per name
+    ignore_patterns = re.compile('|'.join(
+            "(?:{})".format(p) for p in patterns))
 
     # Model
     model = Model(
@@ -214,6 +297,13 @@ def _init_model(date_str, date_int, dir_temp, params):
                 ignore_patterns = ignore_patterns,
                 includes = includes,
                 excludes = excludes,
+                threads = params.get('threads', 1),
+                dircache = params.get('dircache', False),
+                dircache_rescan = params.get('dircache_rescan', 7),
+                journal = params.get('journal', None),
+                content_hash = params.get('hash', False),
+                chunked = params.get('chunked', 0),
+                packed = params.get('packed', 0),
                 description = params['description'],
                 date_str = date_str,
                 date_int = date_int,
@@ -226,26 +316,32 @@ def _init_model(date_str, date_int, dir_temp, params):
 #-----------------------------------------------------------------------
 # Initialize state
 #-----------------------------------------------------------------------
-def _init_state(model, storstate):
-    if not storstate:
-        return 1, "storstate must be provided"
+def _init_state(model, storstates):
+    if not storstates:
+        return None, 1, "storstates must be provided"
 
     state = State(model)
 
-    # Storager state
-    state.states.storager = storstate
+    # Storager states
+    state.states.storagers = storstates
 
-    # Init storage stats manager
+    # Init tracking DB of each storage, in own directory
     #NOTE DB name for now: _aeroback_dir_increment.db
-    dbrstate, err, msg = dbr.init(
-            model.date_str,
-            model.date_int,
-            model.dir_temp,
-            "_aeroback_{}.db".format(model.atype))
-    if err:
-        return None, err, msg
+    for i, storstate in enumerate(storstates):
+        dir_db = os.path.join(model.dir_temp, "storage_{}".format(i))
+        os.makedirs(dir_db)
+
+        dbrstate, err, msg = dbr.init(
+                model.date_str,
+                model.date_int,
+                dir_db,
+                "_aeroback_{}.db".format(model.atype))
+        if err:
+            return None, err, msg
+
+        state.states.dbrs.append(dbrstate)
 
-    state.states.dbr = dbrstate
+    state.states.dbr = state.states.dbrs[0]
 
     return state, 0, None
 
@@ -253,7 +349,7 @@ def _init_state(model, storstate):
 #-----------------------------------------------------------------------
 # Initialize module
 #-----------------------------------------------------------------------
-def init(date_str, date_int, dir_temp, storstate, params):
+def init(date_str, date_int, dir_temp, storstates, params):
     ''' Initialize model and state'''
 
     # Model
@@ -270,7 +366,7 @@ def init(date_str, date_int, dir_temp, storstate, params):
     '''
 
     # State
-    state, err, msg = _init_state(model, storstate)
+    state, err, msg = _init_state(model, storstates)
     if err:
         return State(None), err, msg
 
@@ -283,167 +379,404 @@ def init(date_str, date_int, dir_temp, storstate, params):
     state.set_descriptor('Local dir', state.model.directory)
     state.set_descriptor('Includes', state.model.includes)
     state.set_descriptor('Excludes', state.model.excludes)
+    state.set_descriptor('Scan threads', state.model.threads)
+    if state.model.journal:
+        state.set_descriptor('Changes journal', state.model.journal)
+    if state.model.dircache or state.model.journal:
+        state.set_descriptor('Full rescan days', state.model.dircache_rescan)
+    if state.model.content_hash:
+        state.set_descriptor('Content hash', hash_iface.ALGORITHM)
+    if state.model.chunked:
+        state.set_descriptor('Chunked from', fmtutil.byte_size(state.model.chunked))
+    if state.model.packed:
+        state.set_descriptor('Packed below', fmtutil.byte_size(state.model.packed))
     state.set_descriptor('Max session upload', fmtutil.byte_size(state.model.maxupload))
+    state.set_descriptor('Storages', [s.model.atype for s in storstates])
 
     # Stats for reporting
     state.set_stats('Stats:', '&nbsp')
 
     #OK
-    state.set_stats_category('Storage Total', 'Progress', 0)
-    state.set_stats_category('Storage Total', 'Files count', 0)
-    state.set_stats_category('Storage Total', 'Files size', 0)
-
-    state.set_stats_category('Session Uploaded', 'Files count', 0)
-    state.set_stats_category('Session Uploaded', 'Files size', 0)
+    for storstate in storstates:
+        category = _stats_category('Storage Total', storstate)
+        state.set_stats_category(category, 'Progress', 0)
+        state.set_stats_category(category, 'Files count', 0)
+        state.set_stats_category(category, 'Files size', 0)
+
+        category = _stats_category('Session Uploaded', storstate)
+        state.set_stats_category(category, 'Files count', 0)
+        state.set_stats_category(category, 'Files size', 0)
+        if state.model.content_hash:
+            state.set_stats_category(category, 'Files unchanged', 0)
+            state.set_stats_category(category, 'Files moved', 0)
+        if state.model.chunked:
+            state.set_stats_category(category, 'Files chunked', 0)
+        if state.model.packed:
+            state.set_stats_category(category, 'Files packed', 0)
+            state.set_stats_category(category, 'Packs stored', 0)
+            state.set_stats_category(category, 'Packs repacked', 0)
 
     #OK
     state.set_stats_category('Local Total', 'Files count', 0)
     state.set_stats_category('Local Total', 'Files size', 0)
 
     #OK
-    state.set_stats_category('Tracking DB', 'DB size', 0)
+    for storstate in storstates:
+        state.set_stats_category('Tracking DB', "Size {}".format(storstate.model.atype), 0)
 
     return state, err, msg
 
 
 #-----------------------------------------------------------------------
-# Check if directory needs to be backed up
+# Stats category of storage
+#-----------------------------------------------------------------------
+def _stats_category(name, storstate):
+    return "{} {}".format(name, storstate.model.atype)
+
+
 #-----------------------------------------------------------------------
-def _is_dir_child(directory, dir_src, dirs):
+# Name matches one of patterns
+#-----------------------------------------------------------------------
+def _relative_path(filepath, dir_base):
+    # Extract path that is in between directory and filename
+    pass
+    '''
+    filedir, filename = fsutil.path_to_body_tail(filepath)
+    if len(filedir) > dir_str_len:
+        # Case of file in subdirectory of directory
+        dirstorage = os.path.join(
+                state.model.dirstorage,
+                filedir[dir_str_len + 1:])
+    else:
+        # Case of file located in directory itself
+        dirstorage = state.model.dirstorage
+    '''
+
+
+#-----------------------------------------------------------------------
+# Directory filter for walker
+#-----------------------------------------------------------------------
+def _dir_filter(state):
     """
-    Check if directory matches beginning of any dir in dirs.
-    directory = a/b/c ; d = a ---> True
-    directory = a/b/c ; d = f/g ---> False
+    Builds walker's directory filter:
+        - directories matching ignore patterns are not entered
+        - included dirs have highest precedence:
+            if empty - means ignore included and check excluded
+            if not empty - ignore excluded, enter only included
+              dirs and their parents
     """
+    includes = fsutil.PathTrie(state.model.includes)
+    excludes = fsutil.PathTrie(state.model.excludes)
+    ignore_patterns = state.model.ignore_patterns
 
-    for d in dirs:
-        if directory.startswith(os.path.join(dir_src, d)):
-            return True
+    def dir_filter(relpath, name):
+        if ignore_patterns.search(name):
+            return fs_iface.DIR_PRUNE
 
-    return False
+        # Included not empty? Only check included, ignore excluded
+        if includes:
+            included, parent = includes.lookup(relpath)
+            if included:
+                return fs_iface.DIR_COLLECT
+            if parent:
+                # Leads to included dir, look for it but skip files
+                return fs_iface.DIR_TRAVERSE
+            return fs_iface.DIR_PRUNE
+
+        # Included empty, check excluded
+        excluded, parent = excludes.lookup(relpath)
+        if excluded:
+            return fs_iface.DIR_PRUNE
+
+        return fs_iface.DIR_COLLECT
+
+    return dir_filter
 
 
 #-----------------------------------------------------------------------
-# Check if directory needs to be backed up
+# File filter for walker
 #-----------------------------------------------------------------------
-def _is_dir_valid_for_backup(directory, dir_src, dir_incl, dir_excl):
+def _file_filter(state):
+    ignore_patterns = state.model.ignore_patterns
+
+    def file_filter(name):
+        return not ignore_patterns.search(name)
+
+    return file_filter
+
+
+#-----------------------------------------------------------------------
+# Walk local files, diff against storages on the fly
+#-----------------------------------------------------------------------
+def _walk_local_files_diff(state):
     """
-    Included dirs - highest precedence.
-        If empty - means ignore included and check excluded
-        If not empty - ignore excluded
+    Walks whole directory, looks up files in each storage batch by batch
+    and adds new/modified ones to upload. Local files are not kept in DB.
+    Returns count and total size of files
     """
+    count = 0
+    total_size = 0
+
+    walker = fs_iface.walk_files_parallel(
+            state.model.directory,
+            state.model.threads,
+            _dir_filter(state),
+            _file_filter(state))
 
-    # Source dir itself always valid
-    if directory == dir_src:
-        return True
+    for dbrstate in state.states.dbrs:
+        dbr.start_local_storage_diff(dbrstate, state.model.maxupload)
 
-    # Included not empty? Only check included, ignore excluded
-    if dir_incl:
-        return _is_dir_child(directory, dir_src, dir_incl)
+    batch = []
+    for f in walker:
+        total_size += f[2]
+        count += 1
+        batch.append(f)
+        if len(batch) == dbr.DIFF_BATCH_SIZE:
+            for dbrstate in state.states.dbrs:
+                dbr.diff_local_files(dbrstate, batch)
+            batch = []
 
-    # Included empty, check excluded
-    if _is_dir_child(directory, dir_src, dir_excl):
-        return False
+    if batch:
+        for dbrstate in state.states.dbrs:
+            dbr.diff_local_files(dbrstate, batch)
 
-    return True
+    for dbrstate in state.states.dbrs:
+        dbr.finish_local_storage_diff(dbrstate)
+
+    return count, total_size
 
 
 #-----------------------------------------------------------------------
-# Name matches one of patterns
+# Scan settings signature
 #-----------------------------------------------------------------------
-def _matches(name, patterns):
-    for p in patterns:
-        if p.search(name):
-            #print "\t\t\tmatches = {}".format(p.pattern)
-            return True
-    return False
+def _scan_signature(state):
+    """
+    Directory cache is only valid for the same scan settings
+    """
+    signature = [state.model.directory, state.model.ignore_patterns.pattern]
+    signature.append('includes')
+    signature.extend(state.model.includes)
+    signature.append('excludes')
+    signature.extend(state.model.excludes)
+    return hashlib.md5('\n'.join(signature)).hexdigest()
 
 
 #-----------------------------------------------------------------------
-# Name matches one of patterns
+# Full scan needed ?
 #-----------------------------------------------------------------------
-def _relative_path(filepath, dir_base):
-    # Extract path that is in between directory and filename
-    pass
-    '''
-    filedir, filename = fsutil.path_to_body_tail(filepath)
-    if len(filedir) > dir_str_len:
-        # Case of file in subdirectory of directory
-        dirstorage = os.path.join(
-                state.model.dirstorage,
-                filedir[dir_str_len + 1:])
+def _full_scan_due(state):
+    """
+    Cached directories are only good for the same scan settings
+    and for dircache_rescan days after last full scan.
+    Returns reason for full scan or None
+    """
+    last_full, last_signature = dbr.get_scan_cache(state.states.dbr)
+
+    if last_full is None:
+        return "no directory cache yet"
+    if last_signature != _scan_signature(state):
+        return "scan settings changed"
+    if state.model.date_int - last_full >= state.model.dircache_rescan * 24 * 60 * 60:
+        return "{} days passed since last full scan".format(state.model.dircache_rescan)
+
+    return None
+
+
+#-----------------------------------------------------------------------
+# Walk local files, reuse unchanged directories
+#-----------------------------------------------------------------------
+def _walk_local_files_cached(state, full):
+    """
+    Lists only directories with changed mtime, files of unchanged
+    directories are copied from directory cache in DB.
+    Full walk lists every directory and rebuilds the cache.
+    Returns count and total size of files
+    """
+    if full:
+        dir_cache = {}
+        dbr.set_scan_cache(state.states.dbr, state.model.date_int, _scan_signature(state))
     else:
-        # Case of file located in directory itself
-        dirstorage = state.model.dirstorage
-    '''
+        dir_cache = dbr.get_dirs_cache(state.states.dbr)
+
+    walker = fs_iface.walk_dirs_cached(
+            state.model.directory,
+            dir_cache,
+            _dir_filter(state),
+            _file_filter(state))
+
+    listed = 0
+    for dirpath, modified, files in walker:
+        if files is None:
+            dbr.keep_cached_dir(state.states.dbr, dirpath)
+        else:
+            dbr.replace_cached_dir(state.states.dbr, dirpath, modified, files)
+            listed += 1
+
+    state.set_stats_category('Local Total', 'Dirs listed', listed)
+
+    return dbr.finish_dirs_cache(state.states.dbr)
 
 
 #-----------------------------------------------------------------------
-# Scan local files
+# Directory filter applied to every parent of path
 #-----------------------------------------------------------------------
-def _scan_local_files(state):
-    # List of directories to ignore
-    # Usually those that are hidden (start with '.')
-    ignored = []
+def _dir_action(dir_filter, dirpath):
+    action = fs_iface.DIR_COLLECT
+    relpath = ''
+    for name in dirpath.split(os.sep):
+        relpath = os.path.join(relpath, name)
+        action = dir_filter(relpath, name)
+        if action == fs_iface.DIR_PRUNE:
+            break
+    return action
 
-    # Scan directory
-    count = 0
-    total_size = 0
+
+#-----------------------------------------------------------------------
+# Apply journal of changed paths to directory cache
+#-----------------------------------------------------------------------
+def _apply_journal(state, paths):
+    """
+    For every changed path:
+        - its cached subtree is dropped, in case it was a directory
+        - if it is a directory now, its subtree is walked
+        - its parent directory is listed again
+    Returns count and total size of files
+    """
     directory = state.model.directory
-    includes = state.model.includes
-    excludes = state.model.excludes
-    ignore_patterns = state.model.ignore_patterns
+    dir_filter = _dir_filter(state)
+    file_filter = _file_filter(state)
+
+    relist = set()
+    rewalk = set()
+    for relpath in paths:
+        relpath = os.path.normpath(relpath)
+        if relpath == '.':
+            relist.add('')
+            continue
+
+        dbr.remove_cached_tree(state.states.dbr, relpath)
 
-    for root, subFolders, files in os.walk(directory):
+        path = os.path.join(directory, relpath)
+        if os.path.isdir(path) and not os.path.islink(path):
+            rewalk.add(relpath)
 
-        # Check this directory is not a child of ignored
-        skip = False
-        for ign in ignored:
-            if root.startswith(ign):
-                skip = True
-                break
+        relist.add(os.path.dirname(relpath))
 
-        if skip:
+    listed = 0
+
+    # Walk new subtrees, skipping ones inside another walked one.
+    # Sorted: parent comes before its subdirectories, but not always
+    # right before them ('a', 'a b', 'a/b'), so all parents are checked
+    walked = set()
+    for relpath in sorted(rewalk):
+        parent = os.path.dirname(relpath)
+        while parent and parent not in walked:
+            parent = os.path.dirname(parent)
+        if parent:
             continue
 
-        # Add root directory to ignored if basename matches one of ignore patterns
-        base = os.path.basename(root)
-        if _matches(base, ignore_patterns):
-            print "\t- {}".format(base)
-            ignored.append(root)
+        action = _dir_action(dir_filter, relpath)
+        if action == fs_iface.DIR_PRUNE:
+            continue
+        walked.add(relpath)
+
+        walker = fs_iface.walk_dirs_cached(
+                directory,
+                {},
+                dir_filter,
+                file_filter,
+                relpath,
+                action == fs_iface.DIR_COLLECT)
+
+        for dirpath, modified, files in walker:
+            dbr.replace_cached_dir(state.states.dbr, dirpath, modified, files)
+            listed += 1
+
+    # List changed directories
+    for dirpath in relist:
+        if dirpath in rewalk:
             continue
 
-        if not _is_dir_valid_for_backup(root, directory, includes, excludes):
+        if dirpath:
+            action = _dir_action(dir_filter, dirpath)
+            if action == fs_iface.DIR_PRUNE:
+                continue
+        else:
+            action = fs_iface.DIR_COLLECT
+
+        path = os.path.join(directory, dirpath)
+        try:
+            modified = os.stat(path).st_mtime
+        except OSError:
+            # Gone as well, its own entry in journal drops it
             continue
 
-        print "\t  {}".format(root)
+        if dirpath:
+            prefix = dirpath + os.sep
+        else:
+            prefix = ''
 
-        # Legitimate directory, process its files
-        for f in files:
+        if action == fs_iface.DIR_COLLECT:
+            files, dirs = fs_iface.scan_dir(path, prefix, file_filter)
+        else:
+            files = []
+
+        dbr.replace_cached_dir(state.states.dbr, dirpath, modified, files)
+        listed += 1
+
+    state.set_stats_category('Local Total', 'Dirs listed', listed)
+
+    return dbr.finish_dirs_cache(state.states.dbr, drop_unseen = False)
+
+
+#-----------------------------------------------------------------------
+# Get local files from journal of changes
+#-----------------------------------------------------------------------
+def _journal_local_files(state):
+    """
+    Consumes journal written by aerowatch.py, only changed paths
+    are checked. Falls back to full scan if journal has a gap.
+    Returns count and total size of files
+    """
+    paths, gap = inotify_iface.journal_consume(
+            state.model.journal,
+            3 * inotify_iface.HEARTBEAT_PERIOD)
+
+    if not gap:
+        gap = _full_scan_due(state)
+
+    if gap:
+        state.add_msg_info("Journal not used, full scan: {}".format(gap))
+        return _walk_local_files_cached(state, True)
+
+    state.set_stats_category('Local Total', 'Journal paths', len(paths))
+    return _apply_journal(state, paths)
 
-            # Skip files matching ignore patterns
-            if _matches(f, ignore_patterns):
-                print "\t\t- {}".format(f)
-                continue
 
-            print "\t\t  {}".format(f)
+#-----------------------------------------------------------------------
+# Scan local files
+#-----------------------------------------------------------------------
+def _scan_local_files(state):
+    """
+    Scans once for all storages. Cached scans keep directory cache
+    and local files in DB of first storage only.
+    """
+    for dbrstate in state.states.dbrs[1:]:
+        dbr.clear_dirs_cache(dbrstate)
 
-            # Process file
-            filepath = os.path.join(root, f)
-            modified = int(os.path.getmtime(filepath))
-            size = os.path.getsize(filepath)
-            total_size += size
+    if state.model.journal:
+        count, total_size = _journal_local_files(state)
 
-            #print "\t\t  = {}".format(filepath[len(directory) + 1:])
-            dbr.add_local_file(
-                    state.states.dbr,
-                    filepath[len(directory) + 1:],
-                    modified,
-                    size)
-            count += 1
+    elif state.model.dircache:
+        reason = _full_scan_due(state)
+        if reason:
+            state.add_msg_info("Directory cache rebuilt by full scan: {}".format(reason))
+        count, total_size = _walk_local_files_cached(state, reason is not None)
 
-    # Commit, one for all adds
-    dbr.commit_added_local_files(state.states.dbr)
+    else:
+        # Cache would only go stale
+        dbr.clear_dirs_cache(state.states.dbr)
+        count, total_size = _walk_local_files_diff(state)
 
     '''
     _D.DEBUG(
@@ -461,140 +794,828 @@ def _scan_local_files(state):
     state.set_stats_category('Local Total', 'Files count', count)
     state.set_stats_category('Local Total', 'Files size', fmtutil.byte_size(total_size))
 
+    # Cached scans leave local files in DB, diff them in one go,
+    # other storages read them from DB of first storage
+    if state.model.journal or state.model.dircache:
+        errors = []
+        snapshot = None
+        for dbrstate in state.states.dbrs:
+            err, msg = dbr.find_local_storage_diff(dbrstate, state.model.maxupload, snapshot)
+            if err:
+                errors.append(msg)
+            snapshot = state.states.dbr.model.filepath
+
+        if errors:
+            return 1, '\n'.join(errors)
+
+    return 0, None
+
+
+#-----------------------------------------------------------------------
+# Content hashes of files to upload
+#-----------------------------------------------------------------------
+def _content_hashes(state, rows):
+    """
+    Generator of (row, hash) in order of rows, hash is None if file
+    cannot be hashed or changed while hashed.
+    Hash is taken from hash cache while file's stat key is the same,
+    so each file is read only once after it changes. Other files are
+    hashed by pool of processes while earlier ones are stored.
+    """
+    directory = state.model.directory
+
+    def jobs():
+        for row in rows:
+            path = os.path.join(directory, row.filepath)
+            try:
+                key = hash_iface.stat_key(os.stat(path))
+            except OSError:
+                # Vanished, storing reports it
+                yield (row, None, None), None, None
+                continue
+
+            cached = dbr.get_cached_hash(state.states.dbr, row.filepath, key)
+            if not cached:
+                # Moved or renamed file keeps hash of its old name
+                cached = dbr.get_moved_cached_hash(state.states.dbr, key)
+                if cached:
+                    dbr.set_cached_hash(state.states.dbr, row.filepath, key, cached)
+
+            if cached:
+                yield (row, key, cached), None, None
+            else:
+                yield (row, key, None), path, key
+
+    for (row, key, cached), content_hash, msg in hash_iface.hash_many(state.hash_pool, jobs()):
+        if cached:
+            yield row, cached
+            continue
+
+        if msg:
+            _D.WARNING(
+                    __name__,
+                    "Error hashing file",
+                    'file', row.filepath,
+                    'msg', msg
+                    )
+        elif content_hash:
+            dbr.set_cached_hash(state.states.dbr, row.filepath, key, content_hash)
+
+        yield row, content_hash
+
+
+#-----------------------------------------------------------------------
+# Copy moved files inside storage
+#-----------------------------------------------------------------------
+def _move(state, storstate, dbrstate, moves):
+    """
+    Files moved or renamed locally are copied by storage from old
+    place to new one, nothing is uploaded. Old place is kept, as for
+    any file removed locally.
+        - moves - list of (row, hash, name of stored file)
+    Returns count of moved files, list of (row, hash) failed to copy
+    """
+    if not moves:
+        return 0, []
+
+    dirstorage = state.model.dirstorage
+
+    jobs = []
+    for row, content_hash, origin in moves:
+        fromdir, fromname = fsutil.path_to_body_tail(origin)
+        todir, toname = fsutil.path_to_body_tail(row.filepath)
+        jobs.append((
+                "{}/{}".format(dirstorage, fromdir),
+                fromname,
+                "{}/{}".format(dirstorage, todir),
+                toname,
+                (row, content_hash)))
+
+    moved = []
+    failed = []
+    for (row, content_hash), err, msg in storager.copy_many(storstate, jobs):
+        if err:
+            _D.WARNING(
+                    __name__,
+                    "Error copying moved file, uploading",
+                    'file', row.filepath,
+                    'msg', msg
+                    )
+            failed.append((row, content_hash))
+        else:
+            _D.DEBUG(
+                    __name__,
+                    "Moved file copied",
+                    'file', row.filepath
+                    )
+            moved.append((row.filepath, row.modified, row.size, content_hash))
+
+    # All moved files recorded in one transaction
+    if moved:
+        dbr.add_update_storage_files(dbrstate, moved)
+        dbr.finish_adding_storage_files(dbrstate)
+
+    return len(moved), failed
+
+
+#-----------------------------------------------------------------------
+# Chunks of file
+#-----------------------------------------------------------------------
+def _file_chunks(state, filepath, path, key, need):
+    """
+    Generator of (hash, size, data) of content-defined chunks of file,
+    data is None for chunks need(hash) returns False for.
+    File is split once per run: storages after first one read only
+    chunks they need, at offsets known from first split.
+    Raises IOError/OSError if file cannot be read or changed.
+    """
+    known = state.chunk_manifests.get(filepath)
+
+    with open(path, 'rb') as fp:
+        if known and known[0] == key:
+            offset = 0
+            for content_hash, size in known[1]:
+                data = None
+                if need(content_hash):
+                    fp.seek(offset)
+                    data = fp.read(size)
+                    if chunk_iface.chunk_hash(data) != content_hash:
+                        raise IOError("File changed while stored: {}".format(path))
+                yield content_hash, size, data
+                offset += size
+            return
+
+        manifest = []
+        for content_hash, data in chunk_iface.chunks(fp):
+            manifest.append((content_hash, len(data)))
+            if not need(content_hash):
+                data = None
+            yield content_hash, manifest[-1][1], data
+
+    state.chunk_manifests[filepath] = (key, manifest)
+
+
+#-----------------------------------------------------------------------
+# Store files in chunks
+#-----------------------------------------------------------------------
+def _store_chunked(state, storstate, dbrstate, rows, max_fails):
+    """
+    Large files are split into content-defined chunks, stored by
+    hash in CHUNKS_DIR. Only chunks storage does not have yet are
+    uploaded, so that small change of large file uploads chunks
+    around it only. File is recorded with its list of chunks once
+    all of them are stored.
+    New chunks go through temporary files, each removed as soon as
+    it is stored.
+    Returns count of files stored, size of uploaded chunks,
+    count of failures
+    """
+    dirchunks = "{}/{}".format(state.model.dirstorage, CHUNKS_DIR)
+    dir_temp = os.path.join(state.model.dir_temp, CHUNKS_DIR)
+    if not os.path.exists(dir_temp):
+        os.makedirs(dir_temp)
+
+    count = 0
+    fails = 0
+    uploaded = {'size': 0, 'fails': 0}
+
+    def on_done(data, err, msg):
+        content_hash, size = data
+        os.remove(os.path.join(dir_temp, content_hash))
+        if err:
+            _D.ERROR(
+                    __name__,
+                    "Error storing chunk",
+                    'chunk', content_hash,
+                    'msg', msg
+                    )
+            uploaded['fails'] += 1
+            return
+
+        dbr.add_chunk(dbrstate, content_hash, size)
+        uploaded['size'] += size
+
+    for row in rows:
+        if fails >= max_fails:
+            break
+
+        path = os.path.join(state.model.directory, row.filepath)
+
+        # All chunks of file in order, and new ones being stored:
+        # file may repeat some
+        chunks = []
+        pending = set()
+
+        # Error reading file, chunks already started still finish
+        errors = []
+
+        def need(content_hash):
+            return content_hash not in pending and not dbr.has_chunk(dbrstate, content_hash)
+
+        def jobs(key):
+            try:
+                for content_hash, size, data in _file_chunks(state, row.filepath, path, key, need):
+                    chunks.append((content_hash, size))
+                    if data is None:
+                        continue
+
+                    pending.add(content_hash)
+                    chunkpath = os.path.join(dir_temp, content_hash)
+                    with open(chunkpath, 'wb') as fp:
+                        fp.write(data)
+                    yield chunkpath, dirchunks, (content_hash, size)
+            except (IOError, OSError) as e:
+                errors.append(str(e))
+
+        uploaded['fails'] = 0
+        try:
+            key = hash_iface.stat_key(os.stat(path))
+
+            # File cannot be completed after first failure
+            storager.store_many(
+                    storstate,
+                    jobs(key),
+                    state.model.atype,
+                    on_done,
+                    1)
+
+            changed = hash_iface.stat_key(os.stat(path)) != key
+        except OSError as e:
+            errors.append(str(e))
+
+        if errors:
+            _D.ERROR(
+                    __name__,
+                    "Error reading file to store in chunks",
+                    'file', row.filepath,
+                    'msg', errors[0]
+                    )
+            fails += 1
+            continue
+
+        if uploaded['fails']:
+            fails += 1
+            continue
+
+        if changed:
+            _D.WARNING(
+                    __name__,
+                    "File changed while stored in chunks, stored next run",
+                    'file', row.filepath
+                    )
+            continue
+
+        _D.DEBUG(
+                __name__,
+                "File stored in chunks",
+                'file', row.filepath,
+                'chunks', len(chunks)
+                )
+        dbr.add_chunked_storage_file(dbrstate, row.filepath, row.modified, row.size, chunks)
+        count += 1
+
+    return count, uploaded['size'], fails
+
+
+#-----------------------------------------------------------------------
+# Store pack
+#-----------------------------------------------------------------------
+def _store_pack(state, storstate, dbrstate, pack):
+    """
+    Stores pack as single object, its files are recorded as stored
+    in it once it is stored. Temporary file is removed.
+    Returns err, msg
+    """
+    name = pack.close()
+    path = os.path.join(os.path.dirname(pack.path), name)
+    os.rename(pack.path, path)
+
+    err, msg = storager.store(
+            storstate,
+            path,
+            "{}/{}".format(state.model.dirstorage, PACKS_DIR),
+            state.model.atype)
+    os.remove(path)
+    if err:
+        return err, msg
+
+    dbr.add_packed_storage_files(dbrstate, name, pack.size, pack.files)
+
     return 0, None
 
 
+#-----------------------------------------------------------------------
+# Store files in packs
+#-----------------------------------------------------------------------
+def _store_packed(state, storstate, dbrstate, rows, max_fails):
+    """
+    Small files are appended to packs, each pack of PACK_SIZE is
+    stored as single object: one storage request per pack instead
+    of one per file. Place of each file in its pack is recorded.
+        - rows - list of (row, hash)
+    Returns count of files stored, size of stored packs,
+    count of packs stored, count of failures
+    """
+    dir_temp = os.path.join(state.model.dir_temp, PACKS_DIR)
+    if not os.path.exists(dir_temp):
+        os.makedirs(dir_temp)
+
+    stored = {'count': 0, 'size': 0, 'packs': 0, 'fails': 0}
+
+    def store(pack):
+        err, msg = _store_pack(state, storstate, dbrstate, pack)
+        if err:
+            _D.ERROR(
+                    __name__,
+                    "Error storing pack",
+                    'files', len(pack.files),
+                    'msg', msg
+                    )
+            stored['fails'] += 1
+            return
+
+        _D.DEBUG(
+                __name__,
+                "Files stored in pack",
+                'files', [f[0] for f in pack.files]
+                )
+        stored['count'] += len(pack.files)
+        stored['size'] += pack.size
+        stored['packs'] += 1
+
+    pack = None
+    for row, content_hash in rows:
+        if stored['fails'] >= max_fails:
+            break
+
+        path = os.path.join(state.model.directory, row.filepath)
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        except (IOError, OSError) as e:
+            _D.ERROR(
+                    __name__,
+                    "Error reading file to pack",
+                    'file', row.filepath,
+                    'msg', str(e)
+                    )
+            stored['fails'] += 1
+            continue
+
+        if len(data) != row.size:
+            _D.WARNING(
+                    __name__,
+                    "File changed while packed, stored next run",
+                    'file', row.filepath
+                    )
+            continue
+
+        if pack is None:
+            pack = _Pack(os.path.join(dir_temp, '_pack'))
+        pack.add(row.filepath, row.modified, content_hash, data)
+
+        if pack.size >= PACK_SIZE:
+            store(pack)
+            pack = None
+
+    # Last one, not full
+    if pack:
+        store(pack)
+
+    return stored['count'], stored['size'], stored['packs'], stored['fails']
+
+
+#-----------------------------------------------------------------------
+# Repack mostly obsolete packs
+#-----------------------------------------------------------------------
+def _repack(state, storstate, dbrstate, max_fails):
+    """
+    Pack keeps old versions of its files once they are stored again.
+    Packs with less than REPACK_LIVE_RATIO of their size still current
+    are downloaded, their current files appended to new packs, and
+    old packs removed from storage once none of their files is left
+    in them.
+    Returns count of packs removed, size of stored packs,
+    count of failures
+    """
+    obsolete = dbr.get_obsolete_packs(dbrstate, REPACK_LIVE_RATIO)
+    if not obsolete:
+        return 0, 0, 0
+
+    dirpacks = "{}/{}".format(state.model.dirstorage, PACKS_DIR)
+    dir_temp = os.path.join(state.model.dir_temp, PACKS_DIR)
+    if not os.path.exists(dir_temp):
+        os.makedirs(dir_temp)
+
+    stored = {'size': 0, 'fails': 0}
+
+    def store(pack):
+        err, msg = _store_pack(state, storstate, dbrstate, pack)
+        if err:
+            _D.ERROR(
+                    __name__,
+                    "Error storing repacked pack",
+                    'files', len(pack.files),
+                    'msg', msg
+                    )
+            stored['fails'] += 1
+            return
+
+        stored['size'] += pack.size
+
+    pack = None
+    for name, packsize, live in obsolete:
+        if stored['fails'] >= max_fails:
+            break
+
+        # Nothing current left: just removed
+        files = dbr.get_pack_files(dbrstate, name)
+        if not files:
+            continue
+
+        err, msg = storager.restore(storstate, dirpacks, dir_temp, name, None)
+        if err:
+            _D.ERROR(
+                    __name__,
+                    "Error restoring pack to repack",
+                    'pack', name,
+                    'msg', msg
+                    )
+            stored['fails'] += 1
+            continue
+
+        path = os.path.join(dir_temp, name)
+        with open(path, 'rb') as fp:
+            for filepath, modified, filesize, content_hash, offset in files:
+                fp.seek(offset)
+                if pack is None:
+                    pack = _Pack(os.path.join(dir_temp, '_pack'))
+                pack.add(filepath, modified, content_hash, fp.read(filesize))
+
+                if pack.size >= PACK_SIZE:
+                    store(pack)
+                    pack = None
+        os.remove(path)
+
+    if pack:
+        store(pack)
+
+    # Files of failed new packs still point to old ones
+    removed = 0
+    for name, packsize, live in obsolete:
+        if dbr.get_pack_files(dbrstate, name):
+            continue
+
+        # Kept for next run if it cannot be removed, error is logged
+        result, err, msg = storager.unstore(storstate, dirpacks, name)
+        if err:
+            continue
+
+        dbr.remove_pack(dbrstate, name)
+        removed += 1
+
+    return removed, stored['size'], stored['fails']
+
+
 #-----------------------------------------------------------------------
 # Store files
 #-----------------------------------------------------------------------
-def _store(state):
+def _store(state, storstate, dbrstate, source = None):
     """
-    Store each file.
+    Store each file to one storage, concurrently if storage allows.
     Only allows max_fails failures before stopping and returning error.
+    source - (storstate, dbrstate) of storage to copy from, files it
+    holds in the same version are copied by storage service.
+    With content hashing files whose content is already in storage
+    are not stored, only their date is updated. Files moved or
+    renamed are copied by storage from their old place.
+    Files from chunked size up are stored in chunks, files below
+    packed size in packs, after others.
     """
     max_fails = 5
-    fails = 0
+    unchanged = {'count': 0}
 
-    i = 0
-    total_size = 0
+    # (row, hash, name of stored file with the same content)
+    moves = []
+
+    # Files to store in chunks
+    chunked = []
 
-    # Get files to store
-    rows = dbr.get_files_upload(state.states.dbr)
+    # Files to store in packs: (row, hash)
+    packed = []
 
     directory = state.model.directory
     dirstorage = state.model.dirstorage
-    #dir_str_len = len(state.model.directory)
-    # Store each file
-    for row in rows:
-        #filepath = row[0]
-        #modified = row[1]
-        #size = row[2]
-        filepath = row['filepath']
-        modified = row['modified']
-        size = row['size']
 
+    # Files to upload, held or not by source
+    def rows(copied):
+        for row in dbr.get_files_upload(dbrstate):
+            if state.model.chunked and row.size >= state.model.chunked:
+                if not copied:
+                    chunked.append(row)
+                continue
+
+            held = source is not None and dbr.is_storage_file(
+                    source[1], row.filepath, row.modified, row.size)
+            if held == copied:
+                yield row
+
+    # Job for storager
+    def job(row, content_hash):
         # Extract path that is in between directory and filename
-        filedir, filename = fsutil.path_to_body_tail(filepath)
-        '''
-        if len(filedir) > dir_str_len:
-            # Case of file in subdirectory of directory
-            dirstorage = os.path.join(
-                    state.model.dirstorage,
-                    filedir[dir_str_len + 1:])
+        filedir, filename = fsutil.path_to_body_tail(row.filepath)
+        return (os.path.join(directory, row.filepath),
+                "{}/{}".format(dirstorage, filedir),
+                (row, content_hash))
+
+    # Jobs for storager, files to store are read lazily
+    def jobs(copied):
+        if state.model.content_hash:
+            hashed = _content_hashes(state, rows(copied))
         else:
-            # Case of file located in directory itself
-            dirstorage = state.model.dirstorage
-        '''
+            hashed = ((row, None) for row in rows(copied))
 
-        err, msg = storager.store(
-                state.states.storager,
-                os.path.join(directory, filepath),
-                "{}/{}".format(dirstorage, filedir),
-                state.model.atype)
+        for row, content_hash in hashed:
+            if content_hash and content_hash == dbr.get_storage_hash(dbrstate, row.filepath):
+                # Touched or rewritten with the same content
+                dbr.update_storage_file_date(dbrstate, row.filepath, row.modified, row.size)
+                unchanged['count'] += 1
+                continue
+
+            # Small: appended to packs
+            if state.model.packed and row.size < state.model.packed:
+                packed.append((row, content_hash))
+                continue
+
+            # Moved or renamed: content is in storage under other name
+            if content_hash and not copied:
+                origin = dbr.find_storage_file_by_hash(dbrstate, content_hash)
+                if origin:
+                    moves.append((row, content_hash, origin))
+                    continue
+
+            yield job(row, content_hash)
+
+    # Counters of stored files
+    stored = {'count': 0, 'size': 0}
+
+    def on_done(data, err, msg):
+        row, content_hash = data
         if err:
             # Log error
             _D.ERROR(
                     __name__,
                     "Error storing file",
-                    'file', filepath
+                    'file', row.filepath,
+                    'msg', msg
                     )
-            fails += 1
-            if fails == max_fails:
-                break
+            return
 
-        else:
-            # Update DB on file store success
-            print "\t+ ", filepath
-            dbr.add_update_storage_file(state.states.dbr, filepath, modified, size)
-            i += 1
-            total_size += size
+        # Update DB on file store success
+        print "\t+ ", row.filepath
+        dbr.add_update_storage_file(dbrstate, row.filepath, row.modified, row.size, content_hash)
+        stored['count'] += 1
+        stored['size'] += row.size
+
+    fails = 0
+    if source:
+        fails = storager.store_many(
+                storstate,
+                jobs(True),
+                state.model.atype,
+                on_done,
+                max_fails,
+                source[0])
+
+    if fails < max_fails:
+        fails += storager.store_many(
+                storstate,
+                jobs(False),
+                state.model.atype,
+                on_done,
+                max_fails - fails)
+
+    moved, failed = _move(state, storstate, dbrstate, moves)
+
+    # Not copied: upload
+    if failed and fails < max_fails:
+        fails += storager.store_many(
+                storstate,
+                (job(row, content_hash) for row, content_hash in failed),
+                state.model.atype,
+                on_done,
+                max_fails - fails)
+
+    # Large files: new chunks only
+    count = 0
+    if chunked and fails < max_fails:
+        count, size, chunk_fails = _store_chunked(
+                state, storstate, dbrstate, chunked, max_fails - fails)
+        fails += chunk_fails
+        stored['count'] += count
+        stored['size'] += size
+
+    # Small files: packs
+    packed_count = 0
+    packs = 0
+    if packed and fails < max_fails:
+        packed_count, size, packs, pack_fails = _store_packed(
+                state, storstate, dbrstate, packed, max_fails - fails)
+        fails += pack_fails
+        stored['count'] += packed_count
+        stored['size'] += size
+
+    # Packs left with mostly old versions, also after packing is off
+    repacked = 0
+    if fails < max_fails:
+        repacked, size, repack_fails = _repack(
+                state, storstate, dbrstate, max_fails - fails)
+        fails += repack_fails
+        stored['size'] += size
+
+    i = stored['count']
+    total_size = stored['size']
 
     # Commit all added storage files, if any stores happened
+    if i or unchanged['count']:
+        dbr.finish_adding_storage_files(dbrstate)
     if i:
-        dbr.finish_adding_storage_files(state.states.dbr)
-        dbr.add_stats(state.states.dbr, state.model.date_str, total_size)
+        dbr.add_stats(dbrstate, state.model.date_str, total_size)
 
     # Dump stats
-    #dbr.dump_stats(state.states.dbr)
-
-    state.total_stored_files = i
-    state.total_stored_size = total_size
-
-    state.set_stats_category('Session Uploaded', 'Files count', i)
-    state.set_stats_category('Session Uploaded', 'Files size', fmtutil.byte_size(total_size))
+    #dbr.dump_stats(dbrstate)
+
+    state.total_stored_files += i + moved
+    state.total_stored_size += total_size
+
+    category = _stats_category('Session Uploaded', storstate)
+    state.set_stats_category(category, 'Files count', i)
+    state.set_stats_category(category, 'Files size', fmtutil.byte_size(total_size))
+    if state.model.content_hash:
+        state.set_stats_category(category, 'Files unchanged', unchanged['count'])
+        state.set_stats_category(category, 'Files moved', moved)
+    if state.model.chunked:
+        state.set_stats_category(category, 'Files chunked', count)
+    if state.model.packed:
+        state.set_stats_category(category, 'Files packed', packed_count)
+        state.set_stats_category(category, 'Packs stored', packs)
+        state.set_stats_category(category, 'Packs repacked', repacked)
 
     if fails:
-        return 1, "Error storing files, aborted after {} failures".format(max_fails)
+        return 1, "Error storing files to {}, aborted after {} failures".format(
+                storstate.model.atype, max_fails)
 
     return 0, None
 
 
+#-----------------------------------------------------------------------
+# Restore file
+#-----------------------------------------------------------------------
+def restore_file(storstate, dbrstate, dirstorage, filepath, path):
+    """
+    Restores stored file to local path:
+        - storstate - initialized storager state
+        - dbrstate - executed tracking DB of that storage
+        - filepath - file relative to backup directory
+    File stored in chunks is reassembled from them, each chunk is
+    checked against its hash. File stored in pack is cut out of it.
+    Returns err, msg
+    """
+    dir_temp = tempfile.mkdtemp(dir = os.path.dirname(os.path.abspath(path)))
+    try:
+        chunks = dbr.get_file_chunks(dbrstate, filepath)
+        packed = dbr.get_file_packed(dbrstate, filepath)
+        partpath = os.path.join(dir_temp, '_restored')
+
+        # Stored in pack
+        if packed:
+            pack, offset, length = packed
+            err, msg = storager.restore(
+                    storstate,
+                    "{}/{}".format(dirstorage, PACKS_DIR),
+                    dir_temp,
+                    pack,
+                    None)
+            if err:
+                return err, msg
+
+            with open(os.path.join(dir_temp, pack), 'rb') as fp:
+                fp.seek(offset)
+                data = fp.read(length)
+            if len(data) != length:
+                return 1, "Pack {} of {} is truncated in storage".format(
+                        pack, filepath)
+
+            with open(partpath, 'wb') as fp:
+                fp.write(data)
+            os.rename(partpath, path)
+            return 0, None
+
+        # Stored whole
+        if chunks is None:
+            filedir, filename = fsutil.path_to_body_tail(filepath)
+            err, msg = storager.restore(
+                    storstate,
+                    "{}/{}".format(dirstorage, filedir),
+                    dir_temp,
+                    filename,
+                    None)
+            if err:
+                return err, msg
+            os.rename(os.path.join(dir_temp, filename), path)
+            return 0, None
+
+        dirchunks = "{}/{}".format(dirstorage, CHUNKS_DIR)
+        with open(partpath, 'wb') as fp:
+            for content_hash, size in chunks:
+                err, msg = storager.restore(
+                        storstate,
+                        dirchunks,
+                        dir_temp,
+                        content_hash,
+                        None)
+                if err:
+                    return err, msg
+
+                chunkpath = os.path.join(dir_temp, content_hash)
+                with open(chunkpath, 'rb') as chunk:
+                    data = chunk.read()
+                os.remove(chunkpath)
+
+                if len(data) != size or chunk_iface.chunk_hash(data) != content_hash:
+                    return 1, "Chunk {} of {} is corrupted in storage".format(
+                            content_hash, filepath)
+                fp.write(data)
+
+        os.rename(partpath, path)
+        return 0, None
+
+    except (IOError, OSError) as e:
+        return 1, "Error restoring {} to {}: {}".format(filepath, path, e)
+
+    finally:
+        shutil.rmtree(dir_temp, ignore_errors = True)
+
+
 #-----------------------------------------------------------------------
 # Execute module
 #-----------------------------------------------------------------------
 def execute(state):
 
-    # Restore tracking DB from storage, ignore possible error
-    err, msg = storager.restore(
-            state.states.storager,
-            "{}/{}".format(state.model.dirstorage, '_aeroback'),
-            state.states.dbr.model.dir_db,
-            state.states.dbr.model.filename,
-            None)
-    if err:
-        warn = "Backup {}: File Incremental Tracking DB not found in storage. Ignore if that's the first run".format(state.model.atype)
-        state.add_msg_warning(warn)
-        _D.WARNING(
-                __name__,
-                warn,
-                'msg', msg
-                )
+    for storstate, dbrstate in zip(state.states.storagers, state.states.dbrs):
+        # Restore tracking DB from storage, ignore possible error
+        err, msg = storager.restore(
+                storstate,
+                "{}/{}".format(state.model.dirstorage, '_aeroback'),
+                dbrstate.model.dir_db,
+                dbrstate.model.filename,
+                None)
+        if err:
+            warn = "Backup {}: File Incremental Tracking DB not found in storage {}. Ignore if that's the first run".format(state.model.atype, storstate.model.atype)
+            state.add_msg_warning(warn)
+            _D.WARNING(
+                    __name__,
+                    warn,
+                    'msg', msg
+                    )
 
-    # Tracking DBr execute
-    err, msg = dbr.execute(state.states.dbr)
-    if err:
-        return 1, msg
+        # Tracking DBr execute
+        err, msg = dbr.execute(dbrstate)
+        if err:
+            return 1, msg
 
-    # Update DB params
-    dbr.update_params(state.states.dbr, state.model.directory, state.model.dirstorage)
+        # Update DB params
+        dbr.update_params(dbrstate, state.model.directory, state.model.dirstorage)
 
-    # Clear DB list of local files and files to be uploaded
-    dbr.clear_locals_uploads(state.states.dbr)
+        # Clear DB list of local files and files to be uploaded
+        dbr.clear_locals_uploads(dbrstate)
 
-    # Scan local files and add them to DB
+    # Scan local files once, find differences to upload to each storage
     err, msg = _scan_local_files(state)
     if err:
         state.add_msg_error(msg)
 
-    # Find differences
-    err, msg = dbr.find_local_storage_diff(state.states.dbr, state.model.maxupload)
-    if err:
-        state.add_msg_error(msg)
-
-    # Store differences
-    err, msg = _store(state)
-    if err:
-        state.add_msg_error(msg)
+    # Hashing processes are forked before any storing threads start
+    if state.model.content_hash:
+        state.hash_pool = hash_iface.open_pool()
+
+    # Store differences, storages of the same service copy from
+    # the first one of them
+    try:
+        storages = zip(state.states.storagers, state.states.dbrs)
+        for i, (storstate, dbrstate) in enumerate(storages):
+            source = None
+            for other in storages[:i]:
+                if storager.can_replicate(other[0], storstate):
+                    source = other
+                    break
+
+            err, msg = _store(state, storstate, dbrstate, source)
+            if err:
+                state.add_msg_error(msg)
+    finally:
+        hash_iface.close_pool(state.hash_pool)
+        state.hash_pool = None
 
     return 0, None
 
@@ -605,42 +1626,54 @@ def execute(state):
 def cleanup(state):
     '''Cleanup state'''
 
-    # Clear DB list of local files and uploaded files to minimize DB size
-    dbr.clear_locals_uploads(state.states.dbr)
+    # Keep hashes of stored files only, commits cached ones
+    if state.model.content_hash:
+        dbr.prune_hash_cache(state.states.dbr)
 
-    # Dump DB
-    dbr.dump_params(state.states.dbr)
-    #dbr.dump_files_storage(state.states.dbr)
+    stored = True
+    for storstate, dbrstate in zip(state.states.storagers, state.states.dbrs):
+        # Clear DB list of local files and uploaded files to minimize DB size
+        dbr.clear_locals_uploads(dbrstate)
 
-    # Get statistics of what's in storage now
-    storfiles, storsize = dbr.stats_storage(state.states.dbr)
-    print '#### STOR FILES', storfiles
-    print '#### STOR SIZE', storsize
+        # Dump DB
+        dbr.dump_params(dbrstate)
+        #dbr.dump_files_storage(dbrstate)
 
-    progress = int(float(storsize) / float(state.total_local_size) * 100.0)
-    storsize = fmtutil.byte_size(storsize)
+        # Get statistics of what's in storage now
+        storfiles, storsize = dbr.stats_storage(dbrstate)
+        print '#### STOR FILES', storfiles
+        print '#### STOR SIZE', storsize
 
-    state.set_stats_category('Storage Total', 'Progress', '{}%'.format(progress))
-    state.set_stats_category('Storage Total', 'Files count', storfiles)
-    state.set_stats_category('Storage Total', 'Files size', storsize)
+        progress = int(float(storsize) / float(state.total_local_size) * 100.0)
+        storsize = fmtutil.byte_size(storsize)
 
-    # Disconnect DBr
-    dbr.cleanup(state.states.dbr)
+        category = _stats_category('Storage Total', storstate)
+        state.set_stats_category(category, 'Progress', '{}%'.format(progress))
+        state.set_stats_category(category, 'Files count', storfiles)
+        state.set_stats_category(category, 'Files size', storsize)
 
-    # Get DB file size for statistics
-    db_size = fmtutil.byte_size(dbr.get_db_file_size(state.states.dbr))
-    state.set_stats_category('Tracking DB', 'DB size', db_size)
+        # Disconnect DBr
+        dbr.cleanup(dbrstate)
 
-    # Store DB (local --> storage)
-    err, msg = storager.store(
-            state.states.storager,
-            state.states.dbr.model.filepath,
-            "{}/{}".format(state.model.dirstorage, '_aeroback'),
-            None)
-    if err:
-        _D.ERROR(
-                __name__,
-                "Error storing File Incremental Tracking DB",
-                'file', state.states.dbr.model.filename,
-                'msg', msg
-                )
+        # Get DB file size for statistics
+        db_size = fmtutil.byte_size(dbr.get_db_file_size(dbrstate))
+        state.set_stats_category('Tracking DB', "Size {}".format(storstate.model.atype), db_size)
+
+        # Store DB (local --> storage)
+        err, msg = storager.store(
+                storstate,
+                dbrstate.model.filepath,
+                "{}/{}".format(state.model.dirstorage, '_aeroback'),
+                None)
+        if err:
+            stored = False
+            _D.ERROR(
+                    __name__,
+                    "Error storing File Incremental Tracking DB",
+                    'file', dbrstate.model.filename,
+                    'msg', msg
+                    )
+
+    # Changes of consumed journal are safely in stored DBs
+    if state.model.journal and stored:
+        inotify_iface.journal_commit(state.model.journal)
@@ -1,21 +1,103 @@
 import os
 import sqlite3
+import contextlib
 
 #-----------------------------------------------------------------------
 import aeroback.diagnostics.diagnostics as _D
 
 
+#-----------------------------------------------------------------------
+# Pragmas applied to every connection, can be overridden per DB.
+# Tracking DBs are private to one process and can be rebuilt from
+# storage, so WAL with synchronous=NORMAL is safe enough: a crash
+# loses at most the last transactions, never consistency.
+#-----------------------------------------------------------------------
+PRAGMAS = [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -65536),         # KB, 64 MB
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', 268435456)        # 256 MB
+        ]
+
+
+#-----------------------------------------------------------------------
+# Connection with explicit transactions
+#-----------------------------------------------------------------------
+class Connection(sqlite3.Connection):
+    """
+    Opened in autocommit mode, transactions are started by begin().
+    Python 2.7 sqlite3 commits implicitly before SAVEPOINT, so
+    its implicit transactions cannot be used with savepoints.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Connection, self).__init__(*args, **kwargs)
+        self.in_batch = False
+
+    def begin(self):
+        '''Start transaction, unless already started'''
+        if not self.in_batch:
+            self.execute("BEGIN")
+            self.in_batch = True
+
+    def commit(self):
+        if self.in_batch:
+            self.execute("COMMIT")
+            self.in_batch = False
+
+    def rollback(self):
+        if self.in_batch:
+            self.execute("ROLLBACK")
+            self.in_batch = False
+
+    @contextlib.contextmanager
+    def savepoint(self, name):
+        '''
+        Statements in with-block are applied all or none.
+        Starts transaction if none is started, it stays open.
+        '''
+        self.begin()
+        self.execute("SAVEPOINT {}".format(name))
+        try:
+            yield
+        except:
+            self.execute("ROLLBACK TO {}".format(name))
+            self.execute("RELEASE {}".format(name))
+            raise
+        self.execute("RELEASE {}".format(name))
+
+
+#-----------------------------------------------------------------------
+# Connect and apply pragmas
+#-----------------------------------------------------------------------
+def _connect(filepath, pragmas):
+    conn = sqlite3.connect(
+            filepath,
+            isolation_level = None,
+            factory = Connection)
+
+    values = dict(PRAGMAS)
+    if pragmas:
+        values.update(pragmas)
+
+    for name, default in PRAGMAS:
+        conn.execute("PRAGMA {} = {}".format(name, values[name]))
+
+    return conn
+
+
 #-----------------------------------------------------------------------
 # Open DB
 #-----------------------------------------------------------------------
-def db_open(filepath):
+def db_open(filepath, pragmas = None):
     # If DB doesn't exist on disk, do not create new one
     if not os.path.exists(filepath):
         return None
 
     # Try connecting
     try:
-        conn = sqlite3.connect(filepath)
+        conn = _connect(filepath, pragmas)
         return conn
 
     except Exception as e:
@@ -29,13 +111,20 @@ def db_open(filepath):
 #-----------------------------------------------------------------------
 # Create DB
 #-----------------------------------------------------------------------
-def db_create(filepath):
-    return sqlite3.connect(filepath)
+def db_create(filepath, pragmas = None):
+    return _connect(filepath, pragmas)
 
 
 #-----------------------------------------------------------------------
 # Close DB
 #-----------------------------------------------------------------------
 def db_close(conn):
+    """
+    Commits and leaves DB as single self-contained file,
+    ready to be copied to storage.
+    """
     if conn:
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("PRAGMA journal_mode = DELETE")
         conn.close()
@@ -0,0 +1,104 @@
+import struct
+import hashlib
+
+'''
+Content-defined chunking:
+    - splits file into chunks at positions chosen by content,
+      so that insert or removal in the middle of file changes
+      only chunks around it, following ones are the same
+    - rolling Gear hash, boundary where its high bits are all zero
+'''
+
+#-----------------------------------------------------------------------
+# Chunk sizes. Bytes up to MIN_SIZE are not scanned, boundary is
+# found one in AVG_SIZE bytes after it on average, so chunks are
+# about 1 MB. Chunk is cut at MAX_SIZE if no boundary found
+MIN_SIZE = 512 * 1024
+AVG_SIZE = 512 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+
+# File read block
+BLOCK_SIZE = MAX_SIZE
+
+# Hash state is 32 bits wide: byte added 32 positions back is
+# shifted out, so hash depends on last 32 bytes only
+_WINDOW = 32
+_BITS = 0xFFFFFFFF
+
+# High bits tested for boundary, they mix all 32 bytes of window
+_MASK = ((AVG_SIZE - 1) << (32 - (AVG_SIZE - 1).bit_length())) & _BITS
+
+# Random value per byte. Derived from fixed seed: chunk boundaries,
+# and so names of stored chunks, must never change between runs
+_GEAR = tuple(
+        struct.unpack('>I', hashlib.md5(struct.pack('B', i)).digest()[:4])[0]
+        for i in range(256))
+
+
+#-----------------------------------------------------------------------
+# Find chunk boundary
+#-----------------------------------------------------------------------
+def _cut_point(buf, size):
+    '''
+    Returns length of chunk at start of buf, which holds size bytes
+    '''
+    if size <= MIN_SIZE:
+        return size
+
+    end = min(size, MAX_SIZE)
+    gear = _GEAR
+    mask = _MASK
+    bits = _BITS
+
+    # Hash of window before MIN_SIZE, bytes before it do not matter
+    h = 0
+    for i in xrange(MIN_SIZE - _WINDOW, MIN_SIZE):
+        h = ((h << 1) + gear[buf[i]]) & bits
+
+    for i in xrange(MIN_SIZE, end):
+        h = ((h << 1) + gear[buf[i]]) & bits
+        if not h & mask:
+            return i + 1
+
+    return end
+
+
+#-----------------------------------------------------------------------
+# Hash of chunk content
+#-----------------------------------------------------------------------
+def chunk_hash(data):
+    '''
+    Returns hex digest of chunk, used as name of stored chunk.
+    Always SHA-1, so that names do not depend on installed packages.
+    '''
+    return hashlib.sha1(data).hexdigest()
+
+
+#-----------------------------------------------------------------------
+# Split file into chunks
+#-----------------------------------------------------------------------
+def chunks(fp):
+    '''
+    Generator of (hash, data) of chunks of file object fp,
+    read from its current position to the end.
+    At most BLOCK_SIZE + MAX_SIZE bytes are held in memory.
+    '''
+    buf = bytearray()
+    eof = False
+
+    while True:
+        # Enough data for the longest chunk
+        while not eof and len(buf) < MAX_SIZE:
+            block = fp.read(BLOCK_SIZE)
+            if not block:
+                eof = True
+            buf.extend(block)
+
+        if not buf:
+            return
+
+        cut = _cut_point(buf, len(buf))
+        data = bytes(buf[:cut])
+        del buf[:cut]
+
+        yield chunk_hash(data), data
@@ -0,0 +1,223 @@
+import os
+import io
+import hashlib
+import collections
+import multiprocessing
+
+#-----------------------------------------------------------------------
+# BLAKE2b is built in since Python 3.6, on Python 2.7 it comes
+# from optional 'pyblake2' package. Without either fall back
+# to SHA-1, which hashlib always has and is still fast
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+#-----------------------------------------------------------------------
+# Hashes are prefixed with algorithm name, so that hashes made by
+# other algorithm never match
+#-----------------------------------------------------------------------
+if blake2b:
+    ALGORITHM = 'blake2b'
+else:
+    ALGORITHM = 'sha1'
+
+# Read buffer, reused for whole file
+BLOCK_SIZE = 1024 * 1024
+
+# Files from this size up are hashed one per pool task
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+# Small files per pool task, to amortize passing them to process
+BATCH_COUNT = 64
+BATCH_SIZE = 16 * 1024 * 1024
+
+# Tasks in flight per process
+TASKS_PER_PROCESS = 2
+
+
+#-----------------------------------------------------------------------
+# New hash object
+#-----------------------------------------------------------------------
+def _new():
+    if blake2b:
+        return blake2b(digest_size = 20)
+    return hashlib.sha1()
+
+
+#-----------------------------------------------------------------------
+# Stat key of file
+#-----------------------------------------------------------------------
+def stat_key(st):
+    '''
+    Returns (inode, device, size, mtime ns, ctime ns) of os.stat()
+    result. Hash made for the same key is still valid: content
+    cannot change without changing ctime.
+    '''
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+
+    ctime_ns = getattr(st, 'st_ctime_ns', None)
+    if ctime_ns is None:
+        ctime_ns = int(st.st_ctime * 1000000000)
+
+    return (st.st_ino, st.st_dev, st.st_size, mtime_ns, ctime_ns)
+
+
+#-----------------------------------------------------------------------
+# Hash file content
+#-----------------------------------------------------------------------
+def hash_file(path):
+    '''
+    Returns 'algorithm:hex digest' of file content.
+    Read in big blocks into one reused buffer.
+    Raises IOError/OSError if file cannot be read.
+    '''
+    digest = _new()
+    buf = bytearray(BLOCK_SIZE)
+    view = memoryview(buf)
+
+    with io.open(path, 'rb', buffering = 0) as fp:
+        while True:
+            n = fp.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+
+    return "{}:{}".format(ALGORITHM, digest.hexdigest())
+
+
+#-----------------------------------------------------------------------
+# CPUs available to this process
+#-----------------------------------------------------------------------
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Python 2.7 has no affinity, all CPUs then
+        return multiprocessing.cpu_count()
+
+
+#-----------------------------------------------------------------------
+# Open hashing pool
+#-----------------------------------------------------------------------
+def open_pool(processes = None):
+    '''
+    Returns pool of processes, one per available CPU by default.
+    None if there is single CPU only: hashing in calling process
+    is just as fast then.
+    Open before starting threads, processes are forked.
+    '''
+    if processes is None:
+        processes = cpu_count()
+    if processes <= 1:
+        return None
+    return multiprocessing.Pool(processes)
+
+
+#-----------------------------------------------------------------------
+# Close hashing pool
+#-----------------------------------------------------------------------
+def close_pool(pool):
+    if pool:
+        pool.close()
+        pool.join()
+
+
+#-----------------------------------------------------------------------
+# Hash batch of files, runs in pool process
+#-----------------------------------------------------------------------
+def _hash_batch(items):
+    '''
+    items - list of (path, stat key), None for nothing to hash
+    Returns list of (hash, msg), hash is None if file cannot be
+    hashed or its stat key changed while it was hashed
+    '''
+    out = []
+    for item in items:
+        if item is None:
+            out.append((None, None))
+            continue
+
+        path, key = item
+        try:
+            content_hash = hash_file(path)
+            if stat_key(os.stat(path)) != tuple(key):
+                content_hash = None
+            out.append((content_hash, None))
+        except (IOError, OSError) as e:
+            out.append((None, str(e)))
+
+    return out
+
+
+#-----------------------------------------------------------------------
+# Hash many files, in order
+#-----------------------------------------------------------------------
+def hash_many(pool, jobs):
+    '''
+    Hashes files in pool of processes, results stream in order of jobs
+    while later files are still hashed.
+        - pool - from open_pool(), None hashes in calling process
+        - jobs - iterable of (data, path, key), read lazily from
+          calling thread only. key is stat_key() of path, path is
+          None for jobs with nothing to hash
+    Large files are hashed one per task, small ones in batches.
+    Yields (data, hash, msg)
+    '''
+    if pool is None:
+        for data, path, key in jobs:
+            if path is None:
+                yield data, None, None
+            else:
+                (content_hash, msg), = _hash_batch([(path, key)])
+                yield data, content_hash, msg
+        return
+
+    window = pool._processes * TASKS_PER_PROCESS
+    pending = collections.deque()
+
+    def submit(batch):
+        items = [(path, key) if path else None for data, path, key in batch]
+        pending.append((batch, pool.apply_async(_hash_batch, (items,))))
+
+    def results():
+        batch, result = pending.popleft()
+        for (data, path, key), (content_hash, msg) in zip(batch, result.get()):
+            yield data, content_hash, msg
+
+    batch = []
+    size = 0
+    for job in jobs:
+        data, path, key = job
+        if path and key[2] >= LARGE_FILE_SIZE:
+            # Own task, batch before it keeps order
+            if batch:
+                submit(batch)
+            submit([job])
+            batch = []
+            size = 0
+        else:
+            batch.append(job)
+            if path:
+                size += key[2]
+            if len(batch) >= BATCH_COUNT or size >= BATCH_SIZE:
+                submit(batch)
+                batch = []
+                size = 0
+
+        # Hand over finished ones, wait only if window is full
+        while pending and (len(pending) >= window or pending[0][1].ready()):
+            for out in results():
+                yield out
+
+    if batch:
+        submit(batch)
+
+    while pending:
+        for out in results():
+            yield out
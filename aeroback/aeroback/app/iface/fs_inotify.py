@@ -0,0 +1,252 @@
+import os
+import time
+import struct
+import fcntl
+import ctypes
+import ctypes.util
+
+#-----------------------------------------------------------------------
+# Linux inotify through ctypes, plus change journal that a watcher
+# writes and dir_increment backup consumes.
+#
+# Journal is a text file, one record per line:
+#   START <tab> time        - watcher started, earlier changes unknown
+#   HEARTBEAT <tab> time    - watcher alive
+#   OVERFLOW <tab> time     - changes were lost
+#   <event> <tab> relpath   - path changed, event is one of:
+#                             C created, M modified, D deleted,
+#                             F moved from, T moved to
+#
+# Consumed records are moved to pending file next to journal and
+# read again by every consume until backup commits them, once its
+# tracking DB is stored.
+#-----------------------------------------------------------------------
+
+#-----------------------------------------------------------------------
+# inotify constants, see inotify(7)
+#-----------------------------------------------------------------------
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0x00080000
+
+# Events of interest for journal
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE \
+        | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+        | IN_DELETE_SELF | IN_MOVE_SELF \
+        | IN_ONLYDIR | IN_DONT_FOLLOW
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Watcher writes heartbeat record every that many seconds
+HEARTBEAT_PERIOD = 60
+
+# Journal records
+JOURNAL_START = 'START'
+JOURNAL_HEARTBEAT = 'HEARTBEAT'
+JOURNAL_OVERFLOW = 'OVERFLOW'
+
+JOURNAL_CREATED = 'C'
+JOURNAL_MODIFIED = 'M'
+JOURNAL_DELETED = 'D'
+JOURNAL_MOVED_FROM = 'F'
+JOURNAL_MOVED_TO = 'T'
+
+# Pending file of consumed, not yet committed records
+JOURNAL_PENDING_SUFFIX = '.pending'
+
+_libc = None
+
+
+#-----------------------------------------------------------------------
+# Load libc
+#-----------------------------------------------------------------------
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        if not hasattr(_libc, 'inotify_init1'):
+            raise OSError("inotify is not supported on this system")
+    return _libc
+
+
+#-----------------------------------------------------------------------
+def _raise_errno(what):
+    errno = ctypes.get_errno()
+    raise OSError(errno, "{}: {}".format(what, os.strerror(errno)))
+
+
+#-----------------------------------------------------------------------
+# Init inotify instance
+#-----------------------------------------------------------------------
+def inotify_init():
+    '''
+    Returns inotify file descriptor.
+    Raises OSError if inotify is not available.
+    '''
+    fd = _get_libc().inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        _raise_errno("inotify_init1")
+    return fd
+
+
+#-----------------------------------------------------------------------
+# Add watch
+#-----------------------------------------------------------------------
+def add_watch(fd, path, mask = WATCH_MASK):
+    '''
+    Returns watch descriptor.
+    Raises OSError, for example when fs.inotify.max_user_watches is reached.
+    '''
+    wd = _get_libc().inotify_add_watch(fd, path, mask)
+    if wd < 0:
+        _raise_errno("inotify_add_watch {}".format(path))
+    return wd
+
+
+#-----------------------------------------------------------------------
+# Read events
+#-----------------------------------------------------------------------
+def read_events(fd, bufsize = 65536):
+    '''
+    Blocks until events are available. Returns list of:
+        (wd, mask, cookie, name)
+    '''
+    data = os.read(fd, bufsize)
+
+    events = []
+    pos = 0
+    while pos + _EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+        pos += _EVENT_HEADER.size
+        name = data[pos:pos + length].rstrip('\0')
+        pos += length
+        events.append((wd, mask, cookie, name))
+
+    return events
+
+
+#-----------------------------------------------------------------------
+# Journal: append records
+#-----------------------------------------------------------------------
+def journal_write(filepath, records):
+    '''
+    Appends list of (record, value) to journal.
+    '''
+    lines = []
+    for record, value in records:
+        lines.append("{}\t{}\n".format(record, value.encode('string_escape')))
+
+    fp = open(filepath, 'a')
+    try:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        fp.write(''.join(lines))
+        fp.flush()
+    finally:
+        fp.close()
+
+
+#-----------------------------------------------------------------------
+# Journal: take over and read
+#-----------------------------------------------------------------------
+def journal_consume(filepath, max_silence):
+    '''
+    Reads and empties journal, keeping watcher's last heartbeat.
+    Records are moved to pending file, records left there by consume
+    not committed with journal_commit() are read again.
+    Returns:
+        paths - set of changed relative paths
+        gap - reason why changes may be missing, None if journal is complete:
+            - no journal, watcher never ran
+            - watcher (re)started since last consume
+            - watcher reported lost events
+            - no heartbeat for max_silence seconds
+    '''
+    try:
+        fp = open(filepath, 'r+')
+    except IOError:
+        return set(), "Journal not found: {}".format(filepath)
+
+    pending = filepath + JOURNAL_PENDING_SUFFIX
+
+    try:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        data = fp.read()
+
+        try:
+            with open(pending, 'r') as pp:
+                data = pp.read() + data
+        except IOError:
+            pass
+
+        paths = set()
+        gap = None
+        last_beat = 0
+        for line in data.splitlines():
+            record, sep, value = line.partition('\t')
+            if not sep:
+                # Partial line from watcher killed while writing
+                gap = "Journal is damaged"
+                continue
+
+            if record == JOURNAL_START:
+                gap = "Watcher restarted"
+                last_beat = float(value)
+            elif record == JOURNAL_HEARTBEAT:
+                last_beat = float(value)
+            elif record == JOURNAL_OVERFLOW:
+                gap = "Watcher lost events"
+            else:
+                paths.add(value.decode('string_escape'))
+
+        # Records are kept until committed, heartbeats are not needed
+        temp = pending + '.tmp'
+        with open(temp, 'w') as pp:
+            for line in data.splitlines():
+                if not line.startswith(JOURNAL_HEARTBEAT + '\t'):
+                    pp.write(line + '\n')
+            pp.flush()
+            os.fsync(pp.fileno())
+        os.rename(temp, pending)
+
+        # Next consume still knows when watcher was last alive
+        fp.seek(0)
+        fp.truncate()
+        if last_beat:
+            fp.write("{}\t{}\n".format(JOURNAL_HEARTBEAT, last_beat))
+        fp.flush()
+
+    finally:
+        fp.close()
+
+    if not gap and time.time() - last_beat > max_silence:
+        gap = "Watcher is silent for more than {} seconds".format(max_silence)
+
+    return paths, gap
+
+
+#-----------------------------------------------------------------------
+# Journal: drop consumed records
+#-----------------------------------------------------------------------
+def journal_commit(filepath):
+    '''
+    Removes records consumed by journal_consume(), changes they
+    name are safely recorded.
+    '''
+    try:
+        os.remove(filepath + JOURNAL_PENDING_SUFFIX)
+    except OSError:
+        pass
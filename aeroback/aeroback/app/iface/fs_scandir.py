@@ -0,0 +1,329 @@
+import os
+import stat
+import threading
+import Queue
+
+#-----------------------------------------------------------------------
+# scandir() is built in since Python 3.5, on Python 2.7 it comes
+# from optional 'scandir' package. Without either fall back
+# to listdir() + stat() which is what os.walk() does anyway
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+#-----------------------------------------------------------------------
+# Directory filter results
+#-----------------------------------------------------------------------
+DIR_PRUNE = 0
+DIR_TRAVERSE = 1
+DIR_COLLECT = 2
+
+
+#-----------------------------------------------------------------------
+# Fallback directory entry, mimics scandir's DirEntry
+#-----------------------------------------------------------------------
+class _Entry(object):
+
+    __slots__ = ('name', 'path', '_lstat', '_stat')
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._lstat = None
+        self._stat = None
+
+    def is_dir(self, follow_symlinks = True):
+        if follow_symlinks:
+            try:
+                return stat.S_ISDIR(self.stat().st_mode)
+            except OSError:
+                return False
+
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return stat.S_ISDIR(self._lstat.st_mode)
+
+    def stat(self):
+        if self._stat is None:
+            # Not a symlink: lstat already has it
+            if self._lstat is not None and not stat.S_ISLNK(self._lstat.st_mode):
+                self._stat = self._lstat
+            else:
+                self._stat = os.stat(self.path)
+        return self._stat
+
+
+#-----------------------------------------------------------------------
+# List directory entries
+#-----------------------------------------------------------------------
+def list_dir(directory):
+    '''
+    Returns list of DirEntry-like objects for directory.
+    Raises OSError if directory cannot be listed.
+    '''
+    if scandir:
+        return list(scandir(directory))
+
+    return [_Entry(directory, name) for name in os.listdir(directory)]
+
+
+#-----------------------------------------------------------------------
+# Scan single directory
+#-----------------------------------------------------------------------
+def scan_dir(directory, prefix, file_filter = None):
+    '''
+    Lists one directory. Returns:
+        files - list of (relpath, mtime, size)
+        dirs - list of (relpath, path, name) of subdirectories
+    Symlinks to directories are skipped, same as os.walk does.
+    Unreadable directory returns nothing, also as os.walk does.
+    '''
+    files = []
+    dirs = []
+
+    try:
+        entries = list_dir(directory)
+    except OSError:
+        return files, dirs
+
+    for entry in entries:
+        name = entry.name
+        try:
+            # Real directory: descend
+            if entry.is_dir(follow_symlinks = False):
+                dirs.append((prefix + name, entry.path, name))
+                continue
+
+            # Symlink to directory: not descended, not a file
+            if entry.is_dir():
+                continue
+
+            if file_filter and not file_filter(name):
+                continue
+
+            # Single stat per file, cached in entry
+            st = entry.stat()
+
+        except OSError:
+            # Vanished or dangling symlink
+            continue
+
+        files.append((prefix + name, int(st.st_mtime), st.st_size))
+
+    return files, dirs
+
+
+#-----------------------------------------------------------------------
+# Walk directory tree
+#-----------------------------------------------------------------------
+def walk_files(directory, dir_filter = None, file_filter = None):
+    '''
+    Generator of (relpath, mtime, size) for every file under directory.
+    Relative paths are built as walker descends.
+
+    dir_filter(relpath, name) returns one of:
+        DIR_PRUNE - do not enter directory
+        DIR_TRAVERSE - enter directory, but skip its files
+        DIR_COLLECT - enter directory and collect its files
+    Files in directory itself are always collected.
+
+    file_filter(name) returns True for files to be collected.
+    '''
+    # Stack of (prefix, path, collect)
+    stack = [('', directory, True)]
+
+    while stack:
+        prefix, path, collect = stack.pop()
+
+        if collect:
+            files, dirs = scan_dir(path, prefix, file_filter)
+            for f in files:
+                yield f
+        else:
+            # Skip files, only need subdirectories
+            files, dirs = scan_dir(path, prefix, _skip_files)
+
+        # Visit subdirectories in listing order
+        for relpath, subpath, name in reversed(dirs):
+            if dir_filter:
+                action = dir_filter(relpath, name)
+                if action == DIR_PRUNE:
+                    continue
+                sub_collect = action == DIR_COLLECT
+            else:
+                sub_collect = True
+
+            stack.append((relpath + os.sep, subpath, sub_collect))
+
+
+#-----------------------------------------------------------------------
+def _skip_files(name):
+    return False
+
+
+
+#-----------------------------------------------------------------------
+# Walk directory tree with several threads
+#-----------------------------------------------------------------------
+def walk_files_parallel(directory, threads, dir_filter = None, file_filter = None):
+    '''
+    Same as walk_files() but directories are listed by a pool of threads
+    taking them from shared work queue. Pays off where stat latency
+    dominates (NFS, big RAID volumes). Yields the same set of files
+    as walk_files(), order is not defined.
+    Filters are called from worker threads.
+    '''
+    if threads <= 1:
+        for f in walk_files(directory, dir_filter, file_filter):
+            yield f
+        return
+
+    work = Queue.Queue()
+    # Bounded, so that slow consumer holds back the workers
+    results = Queue.Queue(threads * 4)
+    stop = threading.Event()
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                work.task_done()
+                return
+
+            try:
+                if stop.is_set():
+                    continue
+
+                prefix, path, collect = item
+                if collect:
+                    files, dirs = scan_dir(path, prefix, file_filter)
+                else:
+                    files, dirs = scan_dir(path, prefix, _skip_files)
+
+                for relpath, subpath, name in dirs:
+                    if dir_filter:
+                        action = dir_filter(relpath, name)
+                        if action == DIR_PRUNE:
+                            continue
+                        sub_collect = action == DIR_COLLECT
+                    else:
+                        sub_collect = True
+
+                    work.put((relpath + os.sep, subpath, sub_collect))
+
+                if files:
+                    results.put(files)
+
+            except Exception as e:
+                # Hand over to consumer, stop walking
+                stop.set()
+                results.put(e)
+
+            finally:
+                work.task_done()
+
+    def finisher():
+        # All directories listed: release workers and consumer
+        work.join()
+        for i in range(threads):
+            work.put(None)
+        results.put(None)
+
+    # Queue root before finisher starts waiting for empty queue
+    work.put(('', directory, True))
+
+    pool = [threading.Thread(target = worker) for i in range(threads)]
+    pool.append(threading.Thread(target = finisher))
+    for t in pool:
+        t.daemon = True
+        t.start()
+
+    try:
+        while True:
+            files = results.get()
+            if files is None:
+                break
+            if isinstance(files, Exception):
+                raise files
+            for f in files:
+                yield f
+
+    finally:
+        # Consumer gone or failed: let workers run dry
+        stop.set()
+        while pool[-1].is_alive():
+            try:
+                results.get(timeout = 0.1)
+            except Queue.Empty:
+                pass
+
+
+#-----------------------------------------------------------------------
+# Walk directory tree, skip listing of unchanged directories
+#-----------------------------------------------------------------------
+def walk_dirs_cached(directory, dir_cache, dir_filter = None, file_filter = None, top = '', collect = True):
+    '''
+    Generator of (relpath, mtime, files) for every directory entered.
+    Walk starts from top, relative path of a subdirectory, and collect
+    tells whether top's own files are collected.
+    dir_cache is {relpath: mtime} of directories entered by previous walk.
+    Directory whose own mtime equals cached one is not listed, its files
+    are None and its subdirectories are taken from dir_cache.
+    Otherwise files is list of (relpath, mtime, size), empty if
+    directory's files are skipped by dir_filter.
+
+    NOTE: editing file in place does not change directory mtime,
+          such changes are only found by a walk with empty dir_cache.
+    '''
+    # Cached subdirectories of each cached directory
+    children = {}
+    for relpath in dir_cache:
+        if relpath:
+            children.setdefault(os.path.dirname(relpath), []).append(relpath)
+
+    # Stack of (relpath, path, collect)
+    stack = [(top, os.path.join(directory, top), collect)]
+
+    while stack:
+        relpath, path, collect = stack.pop()
+
+        # Directory's mtime is taken before listing it, so that
+        # changes made while listing show up next walk
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+
+        if dir_cache.get(relpath, None) == mtime:
+            files = None
+            dirs = [(sub, os.path.join(directory, sub), os.path.basename(sub))
+                    for sub in children.get(relpath, [])]
+
+        else:
+            if relpath:
+                prefix = relpath + os.sep
+            else:
+                prefix = ''
+
+            if collect:
+                files, dirs = scan_dir(path, prefix, file_filter)
+            else:
+                files, dirs = scan_dir(path, prefix, _skip_files)
+
+        yield relpath, mtime, files
+
+        for subrelpath, subpath, name in reversed(dirs):
+            if dir_filter:
+                action = dir_filter(subrelpath, name)
+                if action == DIR_PRUNE:
+                    continue
+                sub_collect = action == DIR_COLLECT
+            else:
+                sub_collect = True
+
+            stack.append((subrelpath, subpath, sub_collect))
@@ -0,0 +1,377 @@
+import os
+import errno
+import shutil
+
+#-----------------------------------------------------------------------
+import aeroback.diagnostics.diagnostics as _D
+
+import aeroback.context.context as context
+
+#-----------------------------------------------------------------------
+# Storage in local directory, e.g. NAS mount.
+#
+# Storage URLs look like file://path/to/dir/object and map to
+# absolute path /path/to/dir/object.
+# Objects are written to temporary name and renamed, so that
+# storage never holds partial files.
+#-----------------------------------------------------------------------
+
+# Copy buffer
+BLOCK_SIZE = 1024 * 1024
+
+# Reserved prefix of temporary names, never listed
+TEMP_PREFIX = '.~aeroback-part.'
+
+# Storage roots where files are hard linked instead of copied
+_links = set()
+
+
+#-----------------------------------------------------------------------
+# URL to local path
+#-----------------------------------------------------------------------
+def _path(url):
+    return '/' + url[len('file://'):].lstrip('/')
+
+
+#-----------------------------------------------------------------------
+# Configure storage
+#-----------------------------------------------------------------------
+def configure(url, params):
+    '''
+    params:link - hard link stored files where possible instead of
+    copying. Only safe when local files are replaced, never modified
+    in place: linked storage copy changes with the local file.
+    '''
+    root = _path(url)
+    if params.get('link', False):
+        _links.add(root)
+    else:
+        _links.discard(root)
+    return 0, None
+
+
+#-----------------------------------------------------------------------
+# Dry run ?
+#-----------------------------------------------------------------------
+def _dry_run(action, *args):
+    dry_run, err, msg = context.get_param('-dry')
+    if err or not dry_run:
+        return False
+
+    _D.WARNING(
+            __name__,
+            "file storage DRY RUN",
+            'action', action,
+            'args', args
+            )
+    return True
+
+
+#-----------------------------------------------------------------------
+# Temporary name of target
+#-----------------------------------------------------------------------
+def _temp(target):
+    directory, name = os.path.split(target)
+    return os.path.join(directory, "{}{}.{}".format(TEMP_PREFIX, os.getpid(), name))
+
+
+#-----------------------------------------------------------------------
+# Copy file to target via temporary name
+#-----------------------------------------------------------------------
+def _copy(source, target, link):
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # Made by concurrent transfer
+            if e.errno != errno.EEXIST:
+                raise
+
+    temp = _temp(target)
+    if os.path.exists(temp):
+        os.remove(temp)
+
+    try:
+        linked = False
+        if link:
+            try:
+                os.link(source, temp)
+                linked = True
+            except OSError:
+                # Other device or no link support: copy
+                pass
+
+        if not linked:
+            with open(source, 'rb') as src:
+                with open(temp, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, BLOCK_SIZE)
+            shutil.copystat(source, temp)
+
+        os.rename(temp, target)
+
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+#-----------------------------------------------------------------------
+# Link allowed for target ?
+#-----------------------------------------------------------------------
+def _link_allowed(target):
+    for root in _links:
+        if target.startswith(root.rstrip('/') + '/'):
+            return True
+    return False
+
+
+#-----------------------------------------------------------------------
+# Copy local ---> storage
+#-----------------------------------------------------------------------
+def copy_local_to_storage(path, url):
+    if _dry_run('copy_local_to_storage', path, url):
+        return "Dry run", 0, None
+
+    target = _path(url)
+    try:
+        _copy(path, target, _link_allowed(target))
+    except (IOError, OSError) as e:
+        return "Error", 1, str(e)
+
+    return "Stored", 0, None
+
+
+#-----------------------------------------------------------------------
+# Parallel copy local ---> storage
+#-----------------------------------------------------------------------
+def copy_local_to_storage_parallel(path, url, slices):
+    '''
+    Local disk gains nothing from concurrent slices, plain copy
+    '''
+    return copy_local_to_storage(path, url)
+
+
+#-----------------------------------------------------------------------
+# Copy stream ---> storage
+#-----------------------------------------------------------------------
+def copy_stream_to_storage(stream, url):
+    '''
+    Writes everything read from file object stream
+    '''
+    if _dry_run('copy_stream_to_storage', url):
+        return "Dry run", 0, None
+
+    target = _path(url)
+    temp = _temp(target)
+    try:
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+
+        with open(temp, 'wb') as dst:
+            shutil.copyfileobj(stream, dst, BLOCK_SIZE)
+        os.rename(temp, target)
+
+    except (IOError, OSError) as e:
+        if os.path.exists(temp):
+            os.remove(temp)
+        return "Error", 1, str(e)
+
+    return "Stored", 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy many local ---> storage
+#-----------------------------------------------------------------------
+def copy_local_to_storage_batch(paths, url, manifest):
+    """
+    Copies files into one storage directory.
+    manifest is not used, kept for same signature as gsutil.
+    Returns:
+        results - { path: (err, msg) } for every path
+        err, msg - error of the whole batch
+    """
+    results = {}
+    failed = 0
+    for path in paths:
+        result, err, msg = copy_local_to_storage(
+                path,
+                "{}/{}".format(url.rstrip('/'), os.path.basename(path)))
+        results[path] = (err, msg)
+        if err:
+            failed += 1
+
+    if failed:
+        return results, 1, "{} of {} files failed".format(failed, len(paths))
+    return results, 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy storage ---> storage
+#-----------------------------------------------------------------------
+def copy_storage_to_storage(source, url):
+    '''
+    Links within the same file system if allowed for target
+    '''
+    if _dry_run('copy_storage_to_storage', source, url):
+        return "Dry run", 0, None
+
+    target = _path(url)
+    try:
+        _copy(_path(source), target, _link_allowed(target))
+    except (IOError, OSError) as e:
+        return "Error", 1, str(e)
+
+    return "Copied", 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy many storage ---> storage
+#-----------------------------------------------------------------------
+def copy_storage_to_storage_batch(sources, url, manifest):
+    """
+    Copies objects into one storage directory.
+    manifest is not used, kept for same signature as gsutil.
+    Returns:
+        results - { source: (err, msg) } for every source URL
+        err, msg - error of the whole batch
+    """
+    results = {}
+    failed = 0
+    for source in sources:
+        result, err, msg = copy_storage_to_storage(
+                source,
+                "{}/{}".format(url.rstrip('/'), os.path.basename(_path(source))))
+        results[source] = (err, msg)
+        if err:
+            failed += 1
+
+    if failed:
+        return results, 1, "{} of {} files failed".format(failed, len(sources))
+    return results, 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy storage ---> local
+#-----------------------------------------------------------------------
+def copy_storage_to_local(url, path):
+    '''
+    path is a directory or target file
+    '''
+    if _dry_run('copy_storage_to_local', url, path):
+        return "Dry run", 0, None
+
+    source = _path(url)
+    if os.path.isdir(path):
+        path = os.path.join(path, os.path.basename(source))
+
+    try:
+        # Never link: restored file may be modified
+        _copy(source, path, False)
+    except (IOError, OSError) as e:
+        return "Error", 1, str(e)
+
+    return "Restored", 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy many storage ---> local
+#-----------------------------------------------------------------------
+def copy_storage_to_local_batch(urls, path, manifest):
+    """
+    Copies objects into local directory.
+    manifest is not used, kept for same signature as gsutil.
+    Returns:
+        results - { url: (err, msg) } for every URL
+        err, msg - error of the whole batch
+    """
+    results = {}
+    failed = 0
+    for url in urls:
+        result, err, msg = copy_storage_to_local(url, path)
+        results[url] = (err, msg)
+        if err:
+            failed += 1
+
+    if failed:
+        return results, 1, "{} of {} files failed".format(failed, len(urls))
+    return results, 0, None
+
+
+#-----------------------------------------------------------------------
+# Remove from storage
+#-----------------------------------------------------------------------
+def remove_from_storage(url):
+    if _dry_run('remove_from_storage', url):
+        return "Dry run", 0, None
+
+    try:
+        os.remove(_path(url))
+    except OSError as e:
+        return "Error", 1, str(e)
+
+    return "Removed", 0, None
+
+
+#-----------------------------------------------------------------------
+# Remove many from storage
+#-----------------------------------------------------------------------
+def remove_from_storage_batch(urls):
+    """
+    Returns:
+        results - { url: (err, msg) } for every URL
+        err, msg - error of the whole batch
+    """
+    results = {}
+    failed = 0
+    for url in urls:
+        result, err, msg = remove_from_storage(url)
+        results[url] = (err, msg)
+        if err:
+            failed += 1
+
+    if failed:
+        return results, 1, "{} of {} files failed".format(failed, len(urls))
+    return results, 0, None
+
+
+#-----------------------------------------------------------------------
+# List storage
+#-----------------------------------------------------------------------
+def list_storage(url):
+    """
+    Lists all objects under storage directory, recursively.
+    Returns [(url, size), ...], err, msg
+    """
+    root = _path(url).rstrip('/')
+    if not os.path.isdir(root):
+        return [], 0, None
+
+    base = url.rstrip('/')
+    objects = []
+    try:
+        for dirpath, dirnames, filenames in os.walk(root):
+            sub = dirpath[len(root):]
+            for filename in filenames:
+                # Skip transfers in progress
+                if filename.startswith(TEMP_PREFIX):
+                    continue
+                size = os.lstat(os.path.join(dirpath, filename)).st_size
+                objects.append(("{}{}/{}".format(base, sub, filename), size))
+    except OSError as e:
+        return objects, 1, str(e)
+
+    return objects, 0, None
+
+
+#-----------------------------------------------------------------------
+# Stat storage object
+#-----------------------------------------------------------------------
+def stat_storage(url):
+    """
+    Returns size of object, err, msg
+    """
+    try:
+        return os.stat(_path(url)).st_size, 0, None
+    except OSError as e:
+        return None, 1, str(e)
@@ -1,4 +1,5 @@
 import os
+import csv
 
 #-----------------------------------------------------------------------
 import aeroback.diagnostics.diagnostics as _D
@@ -7,10 +8,20 @@ import aeroback.context.context as context
 import aeroback.util.cmd as cmdutil
 
 
+#-----------------------------------------------------------------------
+# Configure storage
+#-----------------------------------------------------------------------
+def configure(url, params):
+    '''
+    Nothing to configure, gsutil uses its own boto config
+    '''
+    return 0, None
+
+
 #-----------------------------------------------------------------------
 # Execute storage command
 #-----------------------------------------------------------------------
-def exec_command(invocation):
+def exec_command(invocation, data = None):
     # Access app context to check for dry run parameter
     dry_run, err, msg = context.get_param('-dry')
     if err:
@@ -47,6 +58,10 @@ def exec_command(invocation):
         invocation[0] = os.path.join(filepath, invocation[0])
 
     # Call subprocess
+    if hasattr(data, 'read'):
+        return cmdutil.call_cmd_stream(invocation, data)
+    if data is not None:
+        return cmdutil.call_cmd_input(invocation, data)
     return cmdutil.call_cmd(invocation)
 
 
@@ -64,6 +79,160 @@ def copy_local_to_storage(path, url):
     return exec_command(invocation)
 
 
+#-----------------------------------------------------------------------
+# Parallel copy local ---> storage
+#-----------------------------------------------------------------------
+def copy_local_to_storage_parallel(path, url, slices):
+    '''
+    Uploads file as slices components concurrently, composed
+    into one object by storage. Storages without compose support
+    get regular upload from gsutil.
+    '''
+    try:
+        size = os.path.getsize(path)
+    except OSError as e:
+        return "Error", 1, str(e)
+
+    # Component size in MB, rounded up
+    mb = 1024 * 1024
+    component = max(1, -(-size // (max(slices, 1) * mb)))
+
+    invocation = ['gsutil',
+            '-o', 'GSUtil:parallel_composite_upload_threshold={}M'.format(component),
+            '-o', 'GSUtil:parallel_composite_upload_component_size={}M'.format(component),
+            '-o', 'GSUtil:parallel_process_count=1',
+            '-o', 'GSUtil:parallel_thread_count={}'.format(slices),
+            'cp',
+            path,
+            url]
+
+    return exec_command(invocation)
+
+
+#-----------------------------------------------------------------------
+# Copy stream ---> storage
+#-----------------------------------------------------------------------
+def copy_stream_to_storage(stream, url):
+    '''
+    Uploads everything read from file object stream
+    '''
+    invocation = ['gsutil',
+            'cp',
+            '-',
+            url]
+
+    return exec_command(invocation, stream)
+
+
+#-----------------------------------------------------------------------
+# Copy many local ---> storage
+#-----------------------------------------------------------------------
+def copy_local_to_storage_batch(paths, url, manifest):
+    """
+    Copies files into one storage directory with single gsutil,
+    file list is piped to 'gsutil -m cp -I'.
+        - paths - absolute local paths, file names must be unique
+        - url - storage directory
+        - manifest - temporary file for gsutil's per file log
+    Returns:
+        results - { path: (err, msg) } for every path
+        err, msg - error of the whole invocation
+    """
+    # Existing manifest makes gsutil skip files listed in it
+    if os.path.exists(manifest):
+        os.remove(manifest)
+
+    invocation = ['gsutil',
+            '-m',
+            'cp',
+            '-I',
+            '-L', manifest,
+            url.rstrip('/') + '/']
+
+    result, err, msg = exec_command(invocation, '\n'.join(paths) + '\n')
+
+    return _read_manifest(manifest, paths, err, msg)
+
+
+#-----------------------------------------------------------------------
+# Read per file results of 'gsutil cp -L'
+#-----------------------------------------------------------------------
+def _read_manifest(manifest, sources, err, msg):
+    '''
+    Returns results, err, msg of copy_*_batch()
+    '''
+    # Dry run or gsutil failed to start
+    if not os.path.exists(manifest):
+        results = {}
+        for source in sources:
+            results[source] = (err, msg)
+        return results, err, msg
+
+    # Manifest: Source,Destination,...,Result,Description
+    results = {}
+    try:
+        with open(manifest, 'rb') as fp:
+            for row in csv.DictReader(fp):
+                source = row.get('Source', '')
+                if source.startswith('file://'):
+                    source = source[len('file://'):]
+                if row.get('Result', '') == 'OK':
+                    results[source] = (0, None)
+                else:
+                    results[source] = (1, row.get('Description', '') or row.get('Result', ''))
+    finally:
+        os.remove(manifest)
+
+    # Not in manifest: gsutil gave up before it
+    for source in sources:
+        if source not in results:
+            results[source] = (1, msg or "Not copied")
+
+    return results, err, msg
+
+
+#-----------------------------------------------------------------------
+# Copy storage ---> storage
+#-----------------------------------------------------------------------
+def copy_storage_to_storage(source, url):
+    '''
+    Copied by storage itself when both URLs are of the same provider,
+    nothing passes through local host
+    '''
+    invocation = ['gsutil',
+            'cp',
+            source,
+            url]
+
+    return exec_command(invocation)
+
+
+#-----------------------------------------------------------------------
+# Copy many storage ---> storage
+#-----------------------------------------------------------------------
+def copy_storage_to_storage_batch(sources, url, manifest):
+    """
+    Copies objects into one storage directory with single gsutil,
+    source URL list is piped to 'gsutil -m cp -I'.
+    Returns:
+        results - { source: (err, msg) } for every source URL
+        err, msg - error of the whole invocation
+    """
+    if os.path.exists(manifest):
+        os.remove(manifest)
+
+    invocation = ['gsutil',
+            '-m',
+            'cp',
+            '-I',
+            '-L', manifest,
+            url.rstrip('/') + '/']
+
+    result, err, msg = exec_command(invocation, '\n'.join(sources) + '\n')
+
+    return _read_manifest(manifest, sources, err, msg)
+
+
 #-----------------------------------------------------------------------
 # Copy storage ---> local
 #-----------------------------------------------------------------------
@@ -78,6 +247,32 @@ def copy_storage_to_local(url, path):
     return exec_command(invocation)
 
 
+#-----------------------------------------------------------------------
+# Copy many storage ---> local
+#-----------------------------------------------------------------------
+def copy_storage_to_local_batch(urls, path, manifest):
+    """
+    Copies objects into local directory with single gsutil,
+    URL list is piped to 'gsutil -m cp -I'.
+    Returns:
+        results - { url: (err, msg) } for every URL
+        err, msg - error of the whole invocation
+    """
+    if os.path.exists(manifest):
+        os.remove(manifest)
+
+    invocation = ['gsutil',
+            '-m',
+            'cp',
+            '-I',
+            '-L', manifest,
+            path]
+
+    result, err, msg = exec_command(invocation, '\n'.join(urls) + '\n')
+
+    return _read_manifest(manifest, urls, err, msg)
+
+
 #-----------------------------------------------------------------------
 # Remove from storage
 #-----------------------------------------------------------------------
@@ -89,3 +284,109 @@ def remove_from_storage(url):
 
     # Execute
     return exec_command(invocation)
+
+
+#-----------------------------------------------------------------------
+# Remove many from storage
+#-----------------------------------------------------------------------
+def remove_from_storage_batch(urls):
+    """
+    Removes objects with single gsutil, URL list is piped to
+    'gsutil -m rm -I'. gsutil keeps going past failed objects and
+    names each of them in its output.
+    Returns:
+        results - { url: (err, msg) } for every URL
+        err, msg - error of the whole invocation
+    """
+    invocation = ['gsutil',
+            '-m',
+            'rm',
+            '-I']
+
+    result, err, msg = exec_command(invocation, '\n'.join(urls) + '\n')
+
+    # Dry run, success, or gsutil failed to start
+    if not err or not msg:
+        results = {}
+        for url in urls:
+            results[url] = (err, msg)
+        return results, err, msg
+
+    # Lines: 'Removing <url>...' for each attempt, errors otherwise
+    removing = set()
+    errors = {}
+    for line in msg.splitlines():
+        if line.startswith('Removing '):
+            removed = line[len('Removing '):].rstrip()
+            if removed.endswith('...'):
+                removed = removed[:-len('...')]
+            removing.add(removed)
+            continue
+        for word in line.split():
+            word = word.rstrip('.,')
+            if word.startswith(('gs://', 's3://')):
+                errors[word] = line.strip()
+
+    results = {}
+    for url in urls:
+        if url in errors:
+            results[url] = (1, errors[url])
+        elif url in removing:
+            results[url] = (0, None)
+        else:
+            results[url] = (1, "Not removed")
+
+    return results, err, msg
+
+
+#-----------------------------------------------------------------------
+# List storage
+#-----------------------------------------------------------------------
+def list_storage(url):
+    """
+    Lists all objects under storage directory, recursively.
+    Returns [(url, size), ...], err, msg
+    """
+    invocation = ['gsutil',
+            'ls',
+            '-l',
+            url.rstrip('/') + '/**']
+
+    result, err, msg = exec_command(invocation)
+    if err:
+        # Empty directory is not an error
+        if msg and 'matched no objects' in msg:
+            return [], 0, None
+        return [], err, msg
+
+    # Lines: <size>  <date>  <url>, last one is TOTAL
+    objects = []
+    for line in result.splitlines():
+        parts = line.split(None, 2)
+        if len(parts) == 3 and parts[0].isdigit():
+            objects.append((parts[2], int(parts[0])))
+
+    return objects, 0, None
+
+
+#-----------------------------------------------------------------------
+# Stat storage object
+#-----------------------------------------------------------------------
+def stat_storage(url):
+    """
+    Returns size of object, err, msg
+    """
+    invocation = ['gsutil',
+            'stat',
+            url]
+
+    result, err, msg = exec_command(invocation)
+    if err:
+        return None, err, msg
+
+    for line in result.splitlines():
+        parts = line.strip().split(':', 1)
+        if parts[0] == 'Content-Length':
+            return int(parts[1]), 0, None
+
+    return None, 0, None
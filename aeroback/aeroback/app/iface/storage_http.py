@@ -0,0 +1,804 @@
+import os
+import time
+import socket
+import urllib
+import urlparse
+import httplib
+import threading
+import xml.etree.ElementTree as ElementTree
+
+#-----------------------------------------------------------------------
+import aeroback.diagnostics.diagnostics as _D
+
+import aeroback.context.context as context
+
+#-----------------------------------------------------------------------
+# Native object storage client speaking XML API of Google Cloud
+# Storage (same verbs as S3):
+#   PUT    /bucket/object   - upload
+#   GET    /bucket/object   - download
+#   DELETE /bucket/object   - remove
+#   HEAD   /bucket/object   - stat
+#   GET    /bucket?prefix=  - list
+#   POST   /bucket/object?uploads, PUT ...?partNumber=&uploadId=,
+#   POST   /bucket/object?uploadId=
+#                           - multipart upload of parallel slices
+#   POST   /bucket/object   - with 'x-goog-resumable: start' opens
+#                             resumable upload, session URL is
+#                             returned in Location header
+#   PUT    /bucket/object   - with 'x-goog-copy-source: /bucket/object'
+#                             copies object inside storage
+#
+# Storage URLs look like http(s)://host[:port]/bucket/path/object.
+# Connections are kept alive, one per host for each thread.
+#-----------------------------------------------------------------------
+
+# Files from this size up are uploaded in resumable chunks
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+
+# Resumable chunk, must be multiple of 256 KB
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Streaming block
+BLOCK_SIZE = 64 * 1024
+
+# Smallest multipart slice, except the last one
+MIN_SLICE_SIZE = 5 * 1024 * 1024
+
+# Concurrent requests of batch remove
+REMOVE_THREADS = 8
+
+TIMEOUT = 60
+RETRIES = 3
+
+# Bearer tokens by host
+_tokens = {}
+
+# Connections by (scheme, host), per thread
+_local = threading.local()
+
+
+#-----------------------------------------------------------------------
+# Configure storage
+#-----------------------------------------------------------------------
+def configure(url, params):
+    '''
+    params:token is OAuth2 bearer token sent to host of url,
+    None for no authorization
+    '''
+    _tokens[urlparse.urlsplit(url).netloc] = params.get('token', None)
+    return 0, None
+
+
+#-----------------------------------------------------------------------
+# Connection pool
+#-----------------------------------------------------------------------
+def _get_conn(scheme, host):
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+
+    conn = conns.get((scheme, host), None)
+    if conn is None:
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout = TIMEOUT)
+        else:
+            conn = httplib.HTTPConnection(host, timeout = TIMEOUT)
+        conns[(scheme, host)] = conn
+
+    return conn
+
+
+#-----------------------------------------------------------------------
+def _drop_conn(scheme, host):
+    conns = getattr(_local, 'conns', {})
+    conn = conns.pop((scheme, host), None)
+    if conn:
+        conn.close()
+
+
+#-----------------------------------------------------------------------
+# Close connections of calling thread
+#-----------------------------------------------------------------------
+def close():
+    conns = getattr(_local, 'conns', {})
+    for key in conns.keys():
+        _drop_conn(*key)
+
+
+#-----------------------------------------------------------------------
+# Split storage URL
+#-----------------------------------------------------------------------
+def _split_url(url):
+    '''
+    Returns scheme, host, quoted request path.
+    Unicode URL (names read from DB) is sent UTF-8 encoded, request
+    line must stay str for httplib to append binary body to it
+    '''
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    parts = urlparse.urlsplit(url)
+    path = urllib.quote(parts.path)
+    if parts.query:
+        path = "{}?{}".format(path, parts.query)
+    return parts.scheme, parts.netloc, path
+
+
+#-----------------------------------------------------------------------
+# Send request, read response
+#-----------------------------------------------------------------------
+def _request(method, url, body = None, headers = None, sink = None):
+    '''
+    Sends request over kept-alive connection, reconnecting and
+    retrying on network errors.
+        - body - string or file object, file is streamed from its
+                 current position, Content-Length must be in headers
+        - sink - file object, response body is streamed into it
+    Returns status, response headers (dict, lower case), body
+    Raises socket.error / httplib.HTTPException after RETRIES attempts
+    '''
+    scheme, host, path = _split_url(url)
+
+    headers = dict(headers or {})
+    token = _tokens.get(host, None)
+    if token:
+        headers['Authorization'] = "Bearer {}".format(token)
+
+    start = body.tell() if hasattr(body, 'tell') else None
+
+    attempt = 0
+    while True:
+        attempt += 1
+        conn = _get_conn(scheme, host)
+        try:
+            if start is not None:
+                body.seek(start)
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+
+            if sink is not None and resp.status == 200:
+                while True:
+                    block = resp.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    sink.write(block)
+                data = ''
+            else:
+                data = resp.read()
+
+            return resp.status, dict(resp.getheaders()), data
+
+        except (socket.error, httplib.HTTPException):
+            _drop_conn(scheme, host)
+            if attempt >= RETRIES or sink is not None and sink.tell():
+                raise
+            time.sleep(attempt)
+
+
+#-----------------------------------------------------------------------
+# Dry run ?
+#-----------------------------------------------------------------------
+def _dry_run(action, *args):
+    dry_run, err, msg = context.get_param('-dry')
+    if err or not dry_run:
+        return False
+
+    _D.WARNING(
+            __name__,
+            "http DRY RUN",
+            'action', action,
+            'args', args
+            )
+    return True
+
+
+#-----------------------------------------------------------------------
+# Upload in one request
+#-----------------------------------------------------------------------
+def _upload_simple(fp, size, url):
+    status, headers, data = _request(
+            'PUT',
+            url,
+            fp,
+            {'Content-Length': str(size),
+                'Content-Type': 'application/octet-stream'})
+    if status not in (200, 201):
+        return "HTTP {}".format(status), 1, data
+
+    return "Stored", 0, None
+
+
+#-----------------------------------------------------------------------
+# Resumable upload
+#-----------------------------------------------------------------------
+def _uploaded_range(session, size):
+    '''
+    Asks server how many bytes of session it has.
+    Returns count of bytes, or None if upload is complete.
+    size is '*' if not known yet
+    '''
+    status, headers, data = _request(
+            'PUT',
+            session,
+            '',
+            {'Content-Length': '0',
+                'Content-Range': "bytes */{}".format(size)})
+    if status in (200, 201):
+        return None
+
+    # Range: bytes=0-N
+    rng = headers.get('range', None)
+    if not rng:
+        return 0
+    return int(rng.rsplit('-', 1)[1]) + 1
+
+
+#-----------------------------------------------------------------------
+def _upload_resumable(fp, size, url):
+    session, err, msg = _start_resumable(url)
+    if err:
+        return "Error", err, msg
+
+    offset = 0
+    failures = 0
+    while offset < size:
+        length = min(CHUNK_SIZE, size - offset)
+        fp.seek(offset)
+        chunk = fp.read(length)
+
+        try:
+            status, headers, data = _request(
+                    'PUT',
+                    session,
+                    chunk,
+                    {'Content-Length': str(length),
+                        'Content-Range': "bytes {}-{}/{}".format(
+                                offset, offset + length - 1, size)})
+        except (socket.error, httplib.HTTPException) as e:
+            # Resume from what server has
+            failures += 1
+            if failures > RETRIES:
+                return "Error", 1, "Resumable upload failed: {}".format(e)
+            offset = _uploaded_range(session, size)
+            if offset is None:
+                break
+            continue
+
+        if status in (200, 201):
+            break
+        if status != 308:
+            return "HTTP {}".format(status), 1, data
+
+        failures = 0
+        rng = headers.get('range', None)
+        if rng:
+            offset = int(rng.rsplit('-', 1)[1]) + 1
+        else:
+            offset = 0
+
+    return "Stored", 0, None
+
+
+#-----------------------------------------------------------------------
+# Start resumable upload
+#-----------------------------------------------------------------------
+def _start_resumable(url):
+    '''
+    Returns session URL, err, msg
+    '''
+    status, headers, data = _request(
+            'POST',
+            url,
+            '',
+            {'Content-Length': '0',
+                'Content-Type': 'application/octet-stream',
+                'x-goog-resumable': 'start'})
+    session = headers.get('location', None)
+    if status not in (200, 201) or not session:
+        return None, 1, "Resumable upload not started: HTTP {}: {}".format(status, data)
+
+    # Session URL may be relative
+    return urlparse.urljoin(url, session), 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy stream ---> storage
+#-----------------------------------------------------------------------
+def copy_stream_to_storage(stream, url):
+    '''
+    Uploads everything read from file object stream as resumable
+    upload of unknown size. Up to CHUNK_SIZE is buffered, total
+    size is sent with the last chunk.
+    '''
+    if _dry_run('copy_stream_to_storage', url):
+        return "Dry run", 0, None
+
+    try:
+        session, err, msg = _start_resumable(url)
+        if err:
+            return "Error", err, msg
+
+        # Bytes committed by server, buffer starts there
+        offset = 0
+        buf = ''
+        eof = False
+        failures = 0
+        while True:
+            while not eof and len(buf) < CHUNK_SIZE:
+                block = stream.read(CHUNK_SIZE - len(buf))
+                if block:
+                    buf += block
+                else:
+                    eof = True
+
+            if eof:
+                chunk = buf
+                total = str(offset + len(buf))
+            else:
+                chunk = buf[:CHUNK_SIZE]
+                total = '*'
+
+            if chunk:
+                crange = "bytes {}-{}/{}".format(offset, offset + len(chunk) - 1, total)
+            else:
+                crange = "bytes */{}".format(total)
+
+            try:
+                status, headers, data = _request(
+                        'PUT',
+                        session,
+                        chunk,
+                        {'Content-Length': str(len(chunk)),
+                            'Content-Range': crange})
+            except (socket.error, httplib.HTTPException) as e:
+                failures += 1
+                if failures > RETRIES:
+                    return "Error", 1, "Stream upload failed: {}".format(e)
+                committed = _uploaded_range(session, total)
+                if committed is None:
+                    break
+            else:
+                if status in (200, 201):
+                    break
+                if status != 308:
+                    return "HTTP {}".format(status), 1, data
+
+                failures = 0
+                rng = headers.get('range', None)
+                committed = int(rng.rsplit('-', 1)[1]) + 1 if rng else 0
+
+            # Stream cannot be rewound past start of buffer
+            if committed < offset:
+                return "Error", 1, "Stream upload failed: server has {} bytes, {} already sent".format(
+                        committed, offset)
+
+            buf = buf[committed - offset:]
+            offset = committed
+
+    except (IOError, socket.error, httplib.HTTPException) as e:
+        return "Error", 1, str(e)
+
+    return "Stored", 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy local ---> storage
+#-----------------------------------------------------------------------
+def copy_local_to_storage(path, url):
+    if _dry_run('copy_local_to_storage', path, url):
+        return "Dry run", 0, None
+
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            if size >= RESUMABLE_THRESHOLD:
+                return _upload_resumable(fp, size, url)
+            else:
+                return _upload_simple(fp, size, url)
+
+    except (IOError, OSError, socket.error, httplib.HTTPException) as e:
+        return "Error", 1, str(e)
+
+
+#-----------------------------------------------------------------------
+# Part of file as file object
+#-----------------------------------------------------------------------
+class _Slice(object):
+    '''
+    Streams length bytes of file from offset, own file handle
+    so that slices can be sent concurrently
+    '''
+
+    def __init__(self, path, offset, length):
+        self.fp = open(path, 'rb')
+        self.offset = offset
+        self.length = length
+        self.pos = 0
+        self.fp.seek(offset)
+
+    def read(self, size = -1):
+        left = self.length - self.pos
+        if size < 0 or size > left:
+            size = left
+        data = self.fp.read(size)
+        self.pos += len(data)
+        return data
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos):
+        self.pos = pos
+        self.fp.seek(self.offset + pos)
+
+    def close(self):
+        self.fp.close()
+
+
+#-----------------------------------------------------------------------
+# Upload one slice of multipart upload
+#-----------------------------------------------------------------------
+def _upload_part(path, offset, length, url, upload_id, number, etags, errors):
+    query = urllib.urlencode({'partNumber': number, 'uploadId': upload_id})
+    part = _Slice(path, offset, length)
+    try:
+        status, headers, data = _request(
+                'PUT',
+                "{}?{}".format(url, query),
+                part,
+                {'Content-Length': str(length)})
+        if status != 200:
+            errors.append("Part {}: HTTP {}: {}".format(number, status, data))
+        else:
+            etags[number] = headers.get('etag', '')
+
+    except (IOError, socket.error, httplib.HTTPException) as e:
+        errors.append("Part {}: {}".format(number, e))
+
+    finally:
+        part.close()
+        # Connections of finished thread are not reused
+        close()
+
+
+#-----------------------------------------------------------------------
+# Parallel copy local ---> storage
+#-----------------------------------------------------------------------
+def copy_local_to_storage_parallel(path, url, slices):
+    '''
+    Uploads up to slices parts of file concurrently as multipart
+    upload, storage assembles them into one object.
+    '''
+    if _dry_run('copy_local_to_storage_parallel', path, url, slices):
+        return "Dry run", 0, None
+
+    try:
+        size = os.path.getsize(path)
+    except OSError as e:
+        return "Error", 1, str(e)
+
+    slice_size = max(MIN_SLICE_SIZE, -(-size // max(slices, 1)))
+    if size <= slice_size:
+        return copy_local_to_storage(path, url)
+
+    # Start
+    try:
+        status, headers, data = _request(
+                'POST',
+                "{}?uploads".format(url),
+                '',
+                {'Content-Length': '0',
+                    'Content-Type': 'application/octet-stream'})
+        upload_id = None
+        if status == 200:
+            for element in ElementTree.fromstring(data):
+                if _tag(element) == 'UploadId':
+                    upload_id = element.text
+    except (socket.error, httplib.HTTPException, ElementTree.ParseError) as e:
+        return "Error", 1, "Multipart upload not started: {}".format(e)
+
+    if not upload_id:
+        return "HTTP {}".format(status), 1, "Multipart upload not started: {}".format(data)
+
+    # Parts
+    etags = {}
+    errors = []
+    threads = []
+    for number, offset in enumerate(range(0, size, slice_size), 1):
+        t = threading.Thread(
+                target = _upload_part,
+                args = (path, offset, min(slice_size, size - offset), url, upload_id, number, etags, errors))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    # Complete or abort
+    query = urllib.urlencode({'uploadId': upload_id})
+    try:
+        if errors:
+            _request('DELETE', "{}?{}".format(url, query), '', {'Content-Length': '0'})
+            return "Error", 1, "; ".join(errors)
+
+        body = ''.join(
+                "<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>".format(n, etags[n])
+                for n in sorted(etags))
+        body = "<CompleteMultipartUpload>{}</CompleteMultipartUpload>".format(body)
+        status, headers, data = _request(
+                'POST',
+                "{}?{}".format(url, query),
+                body,
+                {'Content-Length': str(len(body)),
+                    'Content-Type': 'application/xml'})
+    except (socket.error, httplib.HTTPException) as e:
+        return "Error", 1, str(e)
+
+    if status != 200:
+        return "HTTP {}".format(status), 1, data
+
+    return "Stored", 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy many local ---> storage
+#-----------------------------------------------------------------------
+def copy_local_to_storage_batch(paths, url, manifest):
+    """
+    Copies files into one storage directory over the same connection.
+    manifest is not used, kept for same signature as gsutil.
+    Returns:
+        results - { path: (err, msg) } for every path
+        err, msg - error of the whole batch
+    """
+    results = {}
+    failed = 0
+    for path in paths:
+        result, err, msg = copy_local_to_storage(
+                path,
+                "{}/{}".format(url.rstrip('/'), os.path.basename(path)))
+        results[path] = (err, msg)
+        if err:
+            failed += 1
+
+    if failed:
+        return results, 1, "{} of {} files failed".format(failed, len(paths))
+    return results, 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy storage ---> storage
+#-----------------------------------------------------------------------
+def copy_storage_to_storage(source, url):
+    '''
+    Server side copy, source must be on the same host as url
+    '''
+    if _dry_run('copy_storage_to_storage', source, url):
+        return "Dry run", 0, None
+
+    scheme, host, path = _split_url(source)
+    try:
+        status, headers, data = _request(
+                'PUT',
+                url,
+                '',
+                {'Content-Length': '0',
+                    'x-goog-copy-source': path})
+    except (socket.error, httplib.HTTPException) as e:
+        return "Error", 1, str(e)
+
+    if status not in (200, 201):
+        return "HTTP {}".format(status), 1, data
+
+    return "Copied", 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy many storage ---> storage
+#-----------------------------------------------------------------------
+def copy_storage_to_storage_batch(sources, url, manifest):
+    """
+    Copies objects into one storage directory over the same connection.
+    manifest is not used, kept for same signature as gsutil.
+    Returns:
+        results - { source: (err, msg) } for every source URL
+        err, msg - error of the whole batch
+    """
+    results = {}
+    failed = 0
+    for source in sources:
+        result, err, msg = copy_storage_to_storage(
+                source,
+                "{}/{}".format(url.rstrip('/'), source.rstrip('/').rsplit('/', 1)[1]))
+        results[source] = (err, msg)
+        if err:
+            failed += 1
+
+    if failed:
+        return results, 1, "{} of {} files failed".format(failed, len(sources))
+    return results, 0, None
+
+
+#-----------------------------------------------------------------------
+# Copy storage ---> local
+#-----------------------------------------------------------------------
+def copy_storage_to_local(url, path):
+    '''
+    path is a directory or target file
+    '''
+    if _dry_run('copy_storage_to_local', url, path):
+        return "Dry run", 0, None
+
+    if os.path.isdir(path):
+        path = os.path.join(path, url.rstrip('/').rsplit('/', 1)[1])
+
+    # Download next to target, so that failure leaves no partial file
+    temp = "{}.part".format(path)
+    try:
+        with open(temp, 'wb') as fp:
+            status, headers, data = _request('GET', url, sink = fp)
+
+        if status != 200:
+            os.remove(temp)
+            return "HTTP {}".format(status), 1, data
+
+        os.rename(temp, path)
+        return "Restored", 0, None
+
+    except (IOError, OSError, socket.error, httplib.HTTPException) as e:
+        if os.path.exists(temp):
+            os.remove(temp)
+        return "Error", 1, str(e)
+
+
+#-----------------------------------------------------------------------
+# Copy many storage ---> local
+#-----------------------------------------------------------------------
+def copy_storage_to_local_batch(urls, path, manifest):
+    """
+    Copies objects into local directory over the same connection.
+    manifest is not used, kept for same signature as gsutil.
+    Returns:
+        results - { url: (err, msg) } for every URL
+        err, msg - error of the whole batch
+    """
+    results = {}
+    failed = 0
+    for url in urls:
+        result, err, msg = copy_storage_to_local(url, path)
+        results[url] = (err, msg)
+        if err:
+            failed += 1
+
+    if failed:
+        return results, 1, "{} of {} files failed".format(failed, len(urls))
+    return results, 0, None
+
+
+#-----------------------------------------------------------------------
+# Remove from storage
+#-----------------------------------------------------------------------
+def remove_from_storage(url):
+    if _dry_run('remove_from_storage', url):
+        return "Dry run", 0, None
+
+    try:
+        status, headers, data = _request('DELETE', url, '', {'Content-Length': '0'})
+    except (socket.error, httplib.HTTPException) as e:
+        return "Error", 1, str(e)
+
+    if status not in (200, 202, 204):
+        return "HTTP {}".format(status), 1, data
+
+    return "Removed", 0, None
+
+
+#-----------------------------------------------------------------------
+# Remove many from storage
+#-----------------------------------------------------------------------
+def remove_from_storage_batch(urls):
+    """
+    XML API has no multi-object delete, objects are removed
+    by concurrent DELETE requests over kept-alive connections.
+    Returns:
+        results - { url: (err, msg) } for every URL
+        err, msg - error of the whole batch
+    """
+    results = {}
+    urls = list(urls)
+
+    def worker(part):
+        try:
+            for url in part:
+                result, err, msg = remove_from_storage(url)
+                results[url] = (err, msg)
+        finally:
+            close()
+
+    count = min(REMOVE_THREADS, len(urls))
+    threads = [threading.Thread(target = worker, args = (urls[i::count],))
+            for i in range(count)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    failed = 0
+    for url in urls:
+        if url not in results:
+            results[url] = (1, "Not removed")
+        if results[url][0]:
+            failed += 1
+
+    if failed:
+        return results, 1, "{} of {} files failed".format(failed, len(urls))
+    return results, 0, None
+
+
+#-----------------------------------------------------------------------
+# List storage
+#-----------------------------------------------------------------------
+def _tag(element):
+    # Strip XML namespace
+    return element.tag.rsplit('}', 1)[-1]
+
+
+#-----------------------------------------------------------------------
+def list_storage(url):
+    """
+    Lists all objects under storage directory, recursively.
+    Returns [(url, size), ...], err, msg
+    """
+    parts = urlparse.urlsplit(url)
+    bucket, _, prefix = parts.path.strip('/').partition('/')
+    if prefix:
+        prefix += '/'
+    url_bucket = "{}://{}/{}".format(parts.scheme, parts.netloc, bucket)
+
+    objects = []
+    marker = ''
+    while True:
+        query = urllib.urlencode({'prefix': prefix, 'marker': marker})
+        try:
+            status, headers, data = _request('GET', "{}?{}".format(url_bucket, query))
+            root = ElementTree.fromstring(data) if status == 200 else None
+        except (socket.error, httplib.HTTPException, ElementTree.ParseError) as e:
+            return objects, 1, str(e)
+
+        if root is None:
+            return objects, 1, "HTTP {}: {}".format(status, data)
+
+        truncated = False
+        for element in root:
+            tag = _tag(element)
+            if tag == 'Contents':
+                fields = dict((_tag(e), e.text) for e in element)
+                key = fields.get('Key', '')
+                objects.append(("{}/{}".format(url_bucket, key), int(fields.get('Size', 0))))
+                marker = key
+            elif tag == 'IsTruncated':
+                truncated = element.text == 'true'
+            elif tag == 'NextMarker' and element.text:
+                marker = element.text
+
+        if not truncated:
+            return objects, 0, None
+
+
+#-----------------------------------------------------------------------
+# Stat storage object
+#-----------------------------------------------------------------------
+def stat_storage(url):
+    """
+    Returns size of object, err, msg
+    """
+    try:
+        status, headers, data = _request('HEAD', url)
+    except (socket.error, httplib.HTTPException) as e:
+        return None, 1, str(e)
+
+    if status != 200:
+        return None, 1, "HTTP {}".format(status)
+
+    return int(headers.get('content-length', 0)), 0, None
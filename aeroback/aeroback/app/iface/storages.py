@@ -0,0 +1,50 @@
+#-----------------------------------------------------------------------
+import storage_gsutil
+import storage_http
+import storage_file
+
+#-----------------------------------------------------------------------
+# Storage backends by URL scheme.
+#
+# Every backend is a module with functions:
+#   configure(url, params)                          -> err, msg
+#   copy_local_to_storage(path, url)                -> result, err, msg
+#   copy_local_to_storage_parallel(path, url, slices)
+#                                                   -> result, err, msg
+#   copy_stream_to_storage(stream, url)             -> result, err, msg
+#   copy_local_to_storage_batch(paths, url, manifest)
+#                                                   -> results, err, msg
+#   copy_storage_to_storage(source, url)            -> result, err, msg
+#   copy_storage_to_storage_batch(sources, url, manifest)
+#                                                   -> results, err, msg
+#   copy_storage_to_local(url, path)                -> result, err, msg
+#   copy_storage_to_local_batch(urls, path, manifest)
+#                                                   -> results, err, msg
+#   remove_from_storage(url)                        -> result, err, msg
+#   remove_from_storage_batch(urls)                 -> results, err, msg
+#   list_storage(url)                               -> objects, err, msg
+#   stat_storage(url)                               -> size, err, msg
+#
+# Batch functions return results as { path or url: (err, msg) },
+# manifest is temporary file the backend may use.
+# copy_storage_to_storage* copy objects inside the storage service,
+# source URLs must be of the same backend and host.
+# list_storage returns [(url, size), ...] of all objects under url.
+#-----------------------------------------------------------------------
+BACKENDS = {
+        'gs': storage_gsutil,
+        's3': storage_gsutil,
+        'http': storage_http,
+        'https': storage_http,
+        'file': storage_file
+        }
+
+
+#-----------------------------------------------------------------------
+# Find backend
+#-----------------------------------------------------------------------
+def get(scheme):
+    '''
+    Returns backend module for scheme, None if not supported
+    '''
+    return BACKENDS.get(scheme, None)
@@ -1,5 +1,6 @@
 import os
 import re
+import urlparse
 
 #-----------------------------------------------------------------------
 #import aeroback.diagnostics.diagnostics as _D
@@ -130,13 +131,52 @@ def _add_storage(parser, params, section_key, section_type):
         storage['scheme'] = 's3'
     elif t == 'googlestorage':
         storage['scheme'] = 'gs'
+    elif t == 'http':
+        # Native client: http(s)://host[:port] of object storage
+        endpoint = ''
+        if parser.has_option(section_type, 'endpoint'):
+            endpoint = parser.get(section_type, 'endpoint')
+        parts = urlparse.urlsplit(endpoint)
+        if parts.scheme not in ('http', 'https') or not parts.netloc:
+            return 1, "Wrong endpoint supplied: '{}'. Must be http(s)://host[:port]".format(endpoint)
+        storage['scheme'] = parts.scheme
+        storage['host'] = parts.netloc
+
+        storage['token'] = None
+        if parser.has_option(section_type, 'token'):
+            storage['token'] = parser.get(section_type, 'token') or None
+    elif t == 'file':
+        # Local directory, bucket is its absolute path
+        storage['scheme'] = 'file'
+
+        err, msg = _optional_boolean(parser, section_type, None, storage, 'link', False)
+        if err:
+            return err, msg
 
     storage['type'] = t
     storage['active'] = parser.getboolean(section_type, 'active')
     storage['bucket'] = parser.get(section_type, 'bucket')
     storage['dirstorage'] = parser.get(section_type, 'dirstorage')
 
+    if t == 'file' and not os.path.isabs(storage['bucket']):
+        return 1, "Wrong bucket supplied: '{}'. Must be absolute path of directory".format(storage['bucket'])
+
+    # Optional: number of concurrent transfers
+    err, msg = _optional_positive_int(parser, section_type, None, storage, 'transfers', 1)
+    if err:
+        return err, msg
+
+    # Optional: files from this size (MB) up are uploaded in parallel slices
+    err, msg = _optional_positive_int(parser, section_type, None, storage, 'parallel_threshold', 0)
+    if err:
+        return err, msg
+
+    err, msg = _optional_positive_int(parser, section_type, None, storage, 'parallel_slices', 4)
+    if err:
+        return err, msg
+
     _add_to_list(params, 'storages', storage)
+    return 0, None
 
 
 #-------------------------------------------------------------------
@@ -189,7 +229,9 @@ def _parse_storages(parser, params):
             return 1, "Storage section name does not follow convention storage_type[_suffix]: {}".format(s)
 
         # Parse and add to params
-        _add_storage(parser, params, section_key, section_type)
+        err, msg = _add_storage(parser, params, section_key, section_type)
+        if err:
+            return 1, msg
 
     return 0, None
 
@@ -211,6 +253,58 @@ def _optional_frequency(parser, name, sid, backup):
         return 0, None
 
 
+#-------------------------------------------------------------------
+# Get optional positive integer
+#-------------------------------------------------------------------
+def _optional_positive_int(parser, name, sid, backup, option, default):
+    backup[option] = default
+    if not parser.has_option(name, option, sid):
+        return 0, None
+    value = parser.get(name, option, sid)
+    if not value:
+        return 0, None
+    if not value.isdigit() or int(value) < 1:
+        return 1, "Wrong {} supplied: '{}'. Must be a positive integer".format(option, value)
+    backup[option] = int(value)
+    return 0, None
+
+
+#-------------------------------------------------------------------
+# Get optional size in bytes
+#-------------------------------------------------------------------
+def _optional_bytesize(parser, name, sid, backup, option, default):
+    backup[option] = default
+    if not parser.has_option(name, option, sid):
+        return 0, None
+    value = parser.get(name, option, sid)
+    if not value:
+        return 0, None
+    try:
+        size = parseutil.bytesize(value)
+    except ValueError:
+        size = -1
+    if size < 1:
+        return 1, "Wrong {} supplied: '{}'. Must be a size like 100M".format(option, value)
+    backup[option] = size
+    return 0, None
+
+
+#-------------------------------------------------------------------
+# Get optional boolean
+#-------------------------------------------------------------------
+def _optional_boolean(parser, name, sid, backup, option, default):
+    backup[option] = default
+    if not parser.has_option(name, option, sid):
+        return 0, None
+    if not parser.get(name, option, sid):
+        return 0, None
+    try:
+        backup[option] = parser.getboolean(name, option, sid)
+    except ValueError:
+        return 1, "Wrong {} supplied: '{}'. Must be true or false".format(option, parser.get(name, option, sid))
+    return 0, None
+
+
 #-------------------------------------------------------------------
 # Parse backup types
 #-------------------------------------------------------------------
@@ -277,6 +371,11 @@ def _add_backup_dir_compress(parser, params, atype, name, sid):
     if err:
         return err, msg
 
+    # Optional: stream archive to storage, no local copy
+    err, msg = _optional_boolean(parser, name, sid, backup, 'stream', False)
+    if err:
+        return err, msg
+
     _add_to_list(params, 'backups', backup)
     return 0, None
 
@@ -298,6 +397,38 @@ def _add_backup_dir_increment(parser, params, atype, name, sid):
     if err:
         return err, msg
 
+    # Optional: number of directory scanning threads
+    err, msg = _optional_positive_int(parser, name, sid, backup, 'threads', 1)
+    if err:
+        return err, msg
+
+    # Optional: directory mtime cache and its full rescan period in days
+    err, msg = _optional_boolean(parser, name, sid, backup, 'dircache', False)
+    if err:
+        return err, msg
+    err, msg = _optional_positive_int(parser, name, sid, backup, 'dircache_rescan', 7)
+    if err:
+        return err, msg
+
+    # Optional: journal of changes written by aerowatch.py
+    if parser.has_option(name, 'journal', sid) and parser.get(name, 'journal', sid):
+        backup['journal'] = parser.get(name, 'journal', sid)
+
+    # Optional: compare content of changed files before upload
+    err, msg = _optional_boolean(parser, name, sid, backup, 'hash', False)
+    if err:
+        return err, msg
+
+    # Optional: files from this size up are stored in chunks
+    err, msg = _optional_bytesize(parser, name, sid, backup, 'chunked', 0)
+    if err:
+        return err, msg
+
+    # Optional: files below this size are stored in packs
+    err, msg = _optional_bytesize(parser, name, sid, backup, 'packed', 0)
+    if err:
+        return err, msg
+
     _add_to_list(params, 'backups', backup)
     return 0, None
 
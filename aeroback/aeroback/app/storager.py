@@ -1,4 +1,7 @@
 import os
+import hashlib
+import threading
+import Queue
 #import sys
 #import time
 #from datetime import datetime
@@ -10,7 +13,7 @@ from aeroback.abstractions.a_state import A_State
 import aeroback.diagnostics.diagnostics as _D
 
 import dbr_storstats as dbr
-import iface.storage_gsutil as storage_iface
+import iface.storages as storages
 
 import aeroback.util.url as urlutil
 
@@ -27,6 +30,12 @@ Children modules:
     - dbr_storstats
 '''
 
+# Files stored by one storage invocation
+STORE_BATCH_SIZE = 100
+
+# Block of stream read once and passed to every storage
+STREAM_BLOCK_SIZE = 1024 * 1024
+
 
 #-----------------------------------------------------------------------
 # States for other modules
@@ -47,13 +56,17 @@ class States(object):
 #-----------------------------------------------------------------------
 class Model(A_Model):
 
-    def __init__(self, atype, scheme, bucket, dirstorage, date_str, date_int, dir_temp, url_db):
+    def __init__(self, atype, scheme, host, bucket, dirstorage, transfers, parallel_threshold, parallel_slices, date_str, date_int, dir_temp, url_db):
         super(Model, self).__init__()
 
         self.atype = atype
         self.scheme = scheme
+        self.host = host
         self.bucket = bucket
         self.dirstorage = dirstorage
+        self.transfers = transfers
+        self.parallel_threshold = parallel_threshold
+        self.parallel_slices = parallel_slices
         self.date_str = date_str
         self.date_int = date_int
         self.dir_temp = dir_temp
@@ -63,8 +76,12 @@ class Model(A_Model):
         return [
                 'type', self.atype,
                 'scheme', self.scheme,
+                'host', self.host,
                 'bucket', self.bucket,
                 'dirstorage', self.dirstorage,
+                'transfers', self.transfers,
+                'parallel_threshold', self.parallel_threshold,
+                'parallel_slices', self.parallel_slices,
                 'date_str', self.date_str,
                 'date_int', self.date_int,
                 'dir_temp', self.dir_temp,
@@ -81,6 +98,7 @@ class State(A_State):
         super(State, self).__init__()
         self.model = model
         self.states = States()
+        self.iface = storages.get(model.scheme)
 
         self.stored_stats = {}
         self.restored_stats = {}
@@ -158,17 +176,147 @@ def get_restored_stats(state):
 #-------------------------------------------------------------------
 def build_url(state, *paths):
     '''
-    Build storage url by adding paths to scheme://bucket/dirstorage
+    Build storage url by adding paths to scheme://[host/]bucket/dirstorage
     '''
     return ''.join(
         urlutil.url_build(
                 state.model.scheme,
+                state.model.host,
                 state.model.bucket,
                 state.model.dirstorage,
                 *paths
         ))
 
 
+#-------------------------------------------------------------------
+# Size of local file for stats
+#-------------------------------------------------------------------
+def _file_size(path):
+    '''
+    Size in bytes, 0 if file is gone. Taken before storing:
+    file may be removed or renamed while it is stored
+    '''
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+#-------------------------------------------------------------------
+# Parallel upload ?
+#-------------------------------------------------------------------
+def _is_large(state, path):
+    '''
+    File big enough to be uploaded in parallel slices
+    '''
+    if not state.model.parallel_threshold:
+        return False
+
+    try:
+        return os.path.getsize(path) >= state.model.parallel_threshold
+    except OSError:
+        return False
+
+
+#-------------------------------------------------------------------
+# Copy single file: local --> storage
+#-------------------------------------------------------------------
+def _copy_to_storage(state, path, url):
+    if _is_large(state, path):
+        return state.iface.copy_local_to_storage_parallel(
+                path,
+                url,
+                state.model.parallel_slices)
+
+    return state.iface.copy_local_to_storage(path, url)
+
+
+#-------------------------------------------------------------------
+# Copy between storages possible ?
+#-------------------------------------------------------------------
+def can_replicate(source, state):
+    '''
+    Storage service copies from source itself: same backend and
+    host, different place
+    '''
+    return (source is not state
+            and source.model.scheme == state.model.scheme
+            and source.model.host == state.model.host
+            and build_url(source) != build_url(state))
+
+
+#-------------------------------------------------------------------
+# Storages receiving local data
+#-------------------------------------------------------------------
+def _replica_groups(states):
+    '''
+    Groups indexes of states, first storage of each group receives
+    local data, others copy it from the first one
+    '''
+    groups = []
+    for i, state in enumerate(states):
+        for group in groups:
+            if can_replicate(states[group[0]], state):
+                group.append(i)
+                break
+        else:
+            groups.append([i])
+
+    return groups
+
+
+#-------------------------------------------------------------------
+# Replicate: storage --> storage
+#-------------------------------------------------------------------
+def _replicate(source, state, suburl, filename, atype, size):
+    '''
+    Copy stored filename from source storage, nothing is uploaded
+    '''
+    url = build_url(state, suburl, filename)
+    result, err, msg = state.iface.copy_storage_to_storage(
+            build_url(source, suburl, filename),
+            url)
+    if err:
+        msg = "Error copying to {} from storage {}: {}".format(url, source.model.atype, msg)
+    else:
+        _increment_stored_stats(state, atype, size)
+
+    return err, msg
+
+
+#-------------------------------------------------------------------
+# Copy many: storage --> same storage, concurrently
+#-------------------------------------------------------------------
+def copy_many(state, jobs):
+    '''
+    Copy objects already in storage to other names, by storage
+    service itself, using state.model.transfers workers.
+        - jobs - list of (source suburl, source filename,
+          suburl, filename, data)
+    Returns list of (data, err, msg) in order of jobs
+    '''
+    results = [None] * len(jobs)
+
+    def worker(n, part):
+        for i in part:
+            fromsub, fromname, suburl, filename, data = jobs[i]
+            url = build_url(state, suburl, filename)
+            try:
+                result, err, msg = state.iface.copy_storage_to_storage(
+                        build_url(state, fromsub, fromname),
+                        url)
+                if err:
+                    msg = "Error copying to {}: {}".format(url, msg)
+            except Exception as e:
+                err, msg = 1, "Error copying to {}: {}".format(url, e)
+            results[i] = (data, err, msg)
+
+    count = max(1, min(state.model.transfers, len(jobs)))
+    _run_all([range(n, len(jobs), count) for n in range(count)], worker)
+
+    return results
+
+
 #-------------------------------------------------------------------
 # Store: local --> storage
 #-------------------------------------------------------------------
@@ -178,17 +326,467 @@ def store(state, path, suburl, atype):
     '''
     filename = os.path.basename(path)
     url = build_url(state, suburl, filename)
-    result, err, msg = storage_iface.copy_local_to_storage(path, url)
+    size = _file_size(path)
+    result, err, msg = _copy_to_storage(state, path, url)
     if err:
         msg = "Error storing from {}, to {}: {}".format(path, url, msg)
 
     else:
         # Add size to stats
-        _increment_stored_stats(state, atype, os.stat(path).st_size)
+        _increment_stored_stats(state, atype, size)
+
+    return err, msg
+
+
+#-------------------------------------------------------------------
+# Stream reader counting size and MD5
+#-------------------------------------------------------------------
+class _Digest(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+        self.md5 = hashlib.md5()
+
+    def read(self, size = -1):
+        data = self.stream.read(size)
+        self.size += len(data)
+        self.md5.update(data)
+        return data
+
+
+#-------------------------------------------------------------------
+# Store stream: local --> storage
+#-------------------------------------------------------------------
+def store_stream(state, stream, suburl, filename, atype):
+    '''
+    Store everything read from file object stream as filename.
+    Size and MD5 are computed as data passes through.
+    Returns (size, md5 hex), err, msg
+    '''
+    digest = _Digest(stream)
+    err, msg = _store_stream(state, digest, suburl, filename)
+
+    if not err:
+        # Read to the end, e.g. on dry run, so that size is complete
+        while digest.read(STREAM_BLOCK_SIZE):
+            pass
+        _increment_stored_stats(state, atype, digest.size)
+
+    return (digest.size, digest.md5.hexdigest()), err, msg
+
+
+#-------------------------------------------------------------------
+def _store_stream(state, stream, suburl, filename):
+    url = build_url(state, suburl, filename)
+    result, err, msg = state.iface.copy_stream_to_storage(stream, url)
+    if err:
+        msg = "Error storing stream to {}: {}".format(url, msg)
 
     return err, msg
 
 
+#-------------------------------------------------------------------
+# One storage's end of stream read once for all storages
+#-------------------------------------------------------------------
+class _Pipe(object):
+
+    def __init__(self):
+        # Bounded, so that fastest storage is ahead by few blocks only
+        self.queue = Queue.Queue(4)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.closed = False
+
+    def put(self, block):
+        '''Producer side, '' is end of stream'''
+        if not self.closed:
+            self.queue.put(block)
+
+    def read(self, size = -1):
+        while not self.eof and (size < 0 or len(self.buf) - self.pos < size):
+            block = self.queue.get()
+            if block:
+                self.buf = self.buf[self.pos:] + block
+                self.pos = 0
+            else:
+                self.eof = True
+
+        if size < 0:
+            size = len(self.buf) - self.pos
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        '''Consumer is done, producer must not block on it'''
+        self.closed = True
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+
+
+#-------------------------------------------------------------------
+# Run function for each storage concurrently
+#-------------------------------------------------------------------
+def _run_all(items, func):
+    '''
+    Calls func(i, item) in own thread for each item, waits for all
+    '''
+    threads = [threading.Thread(target = func, args = (i, item))
+            for i, item in enumerate(items)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+
+#-------------------------------------------------------------------
+# Store stream to all storages: local --> storages, concurrently
+#-------------------------------------------------------------------
+def store_stream_all(states, stream, suburl, filename, atype):
+    '''
+    Store stream as filename to every storage at the same time,
+    stream is read once. Storages that can copy from another one
+    get the copy made by the storage service afterwards.
+    Returns (size, md5 hex), [(err, msg), ...] in order of states
+    '''
+    groups = _replica_groups(states)
+
+    (size, md5), stored = _store_stream_each(
+            [states[group[0]] for group in groups],
+            stream,
+            suburl,
+            filename,
+            atype)
+
+    results = [(1, "Not stored")] * len(states)
+    for group, result in zip(groups, stored):
+        results[group[0]] = result
+
+    def worker(n, group):
+        source = states[group[0]]
+        for i in group[1:]:
+            if results[group[0]][0]:
+                results[i] = (1, "Error storing stream {}: storage {} to copy from failed".format(
+                        filename, source.model.atype))
+                continue
+            try:
+                results[i] = _replicate(source, states[i], suburl, filename, atype, size)
+            except Exception as e:
+                results[i] = (1, "Error copying {}: {}".format(filename, e))
+
+    _run_all(groups, worker)
+
+    return (size, md5), results
+
+
+#-------------------------------------------------------------------
+def _store_stream_each(states, stream, suburl, filename, atype):
+    '''
+    Stream goes to each of states
+    '''
+    if len(states) == 1:
+        result, err, msg = store_stream(states[0], stream, suburl, filename, atype)
+        return result, [(err, msg)]
+
+    digest = _Digest(stream)
+    pipes = [_Pipe() for state in states]
+    results = [(1, "Not stored")] * len(states)
+
+    def worker(i, state):
+        try:
+            results[i] = _store_stream(state, pipes[i], suburl, filename)
+        except Exception as e:
+            results[i] = (1, "Error storing stream {}: {}".format(filename, e))
+        finally:
+            pipes[i].close()
+
+    threads = [threading.Thread(target = worker, args = (i, state))
+            for i, state in enumerate(states)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    while True:
+        block = digest.read(STREAM_BLOCK_SIZE)
+        for pipe in pipes:
+            pipe.put(block)
+        if not block:
+            break
+        # Every storage failed, no reason to read on
+        if all(pipe.closed for pipe in pipes):
+            break
+
+    for t in threads:
+        t.join()
+
+    for state, (err, msg) in zip(states, results):
+        if not err:
+            _increment_stored_stats(state, atype, digest.size)
+
+    return (digest.size, digest.md5.hexdigest()), results
+
+
+#-------------------------------------------------------------------
+# Store to all storages: local --> storages, concurrently
+#-------------------------------------------------------------------
+def store_all(states, path, suburl, atype):
+    '''
+    Store local file to every storage at the same time. Storages
+    that can copy from another one get the copy made by the storage
+    service, the file is uploaded if copy fails.
+    Returns [(err, msg), ...] in order of states
+    '''
+    results = [(1, "Not stored")] * len(states)
+    filename = os.path.basename(path)
+    size = _file_size(path)
+
+    def worker(n, group):
+        source = states[group[0]]
+        for i in group:
+            try:
+                if i != group[0] and not results[group[0]][0]:
+                    err, msg = _replicate(source, states[i], suburl, filename,
+                            atype, size)
+                    if not err:
+                        results[i] = (0, None)
+                        continue
+
+                    _D.WARNING(
+                            __name__,
+                            "Copy between storages failed, uploading",
+                            'msg', msg
+                            )
+
+                results[i] = store(states[i], path, suburl, atype)
+
+            except Exception as e:
+                results[i] = (1, "Error storing from {}: {}".format(path, e))
+
+    _run_all(_replica_groups(states), worker)
+
+    return results
+
+
+#-------------------------------------------------------------------
+# Group store jobs by storage directory
+#-------------------------------------------------------------------
+def _group_jobs(jobs, size):
+    '''
+    Yields lists of up to size consecutive jobs with the same suburl
+    '''
+    batch = []
+    for job in jobs:
+        if batch and (job[1] != batch[0][1] or len(batch) == size):
+            yield batch
+            batch = []
+        batch.append(job)
+
+    if batch:
+        yield batch
+
+
+#-------------------------------------------------------------------
+# Replicate batch: storage --> storage
+#-------------------------------------------------------------------
+def _replicate_batch(source, state, batch, manifest):
+    '''
+    Copies jobs sharing suburl from source storage.
+    Returns list of (path, data, err, msg) of copied jobs,
+    list of jobs failed to copy
+    '''
+    suburl = batch[0][1]
+    sources = [build_url(source, suburl, os.path.basename(job[0])) for job in batch]
+
+    results, err, msg = state.iface.copy_storage_to_storage_batch(
+            sources,
+            build_url(state, suburl),
+            manifest)
+
+    out = []
+    rest = []
+    for url, job in zip(sources, batch):
+        if results[url][0]:
+            rest.append(job)
+        else:
+            out.append((job[0], job[2], 0, None))
+
+    if rest:
+        _D.WARNING(
+                __name__,
+                "Copy between storages failed, uploading",
+                'from', build_url(source, suburl),
+                'count', len(rest),
+                'msg', msg
+                )
+
+    return out, rest
+
+
+#-------------------------------------------------------------------
+# Store batch: local --> storage
+#-------------------------------------------------------------------
+def _store_batch(state, batch, manifest, source = None):
+    '''
+    Stores jobs sharing suburl with single storage invocation.
+    Returns list of (path, data, err, msg)
+    '''
+    out = []
+
+    # Copied by storage service, failed ones are uploaded
+    if source:
+        out, batch = _replicate_batch(source, state, batch, manifest)
+        if not batch:
+            return out
+
+    # Single and large files: copied one by one
+    singles = []
+    if len(batch) == 1:
+        singles, batch = batch, []
+    else:
+        rest = []
+        for job in batch:
+            if _is_large(state, job[0]):
+                singles.append(job)
+            else:
+                rest.append(job)
+        batch = rest
+
+    for path, suburl, data in singles:
+        url = build_url(state, suburl, os.path.basename(path))
+        result, err, msg = _copy_to_storage(state, path, url)
+        if err:
+            msg = "Error storing from {}, to {}: {}".format(path, url, msg)
+        out.append((path, data, err, msg))
+
+    if not batch:
+        return out
+
+    url = build_url(state, batch[0][1])
+    results, err, msg = state.iface.copy_local_to_storage_batch(
+            [job[0] for job in batch],
+            url,
+            manifest)
+
+    for path, suburl, data in batch:
+        err, msg = results[path]
+        if err:
+            msg = "Error storing from {}, to {}: {}".format(path, url, msg)
+        out.append((path, data, err, msg))
+
+    return out
+
+
+#-------------------------------------------------------------------
+# Store many: local --> storage, concurrently
+#-------------------------------------------------------------------
+def store_many(state, jobs, atype, on_done, max_fails = 0, source = None):
+    '''
+    Store local files to remote storage using pool of
+    state.model.transfers workers. Consecutive jobs with the same
+    suburl are stored by one storage invocation, up to STORE_BATCH_SIZE.
+        - jobs - iterable of (path, suburl, data), read lazily
+        - on_done(data, err, msg) - called as each job finishes,
+          always from the calling thread
+        - max_fails - if > 0, no new batches are started after that
+          many failures, batches already started still report
+        - source - storager state of storage already holding the
+          same files under the same suburls, see can_replicate().
+          Files are copied from it, uploaded if copy fails
+    Returns count of failures
+    '''
+    fails = 0
+
+    if source and not can_replicate(source, state):
+        source = None
+
+    def finished(path, data, err, msg, size):
+        # Stats and callback in calling thread only
+        if not err:
+            _increment_stored_stats(state, atype, size)
+        on_done(data, err, msg)
+        return 1 if err else 0
+
+    def store_batch(batch, manifest):
+        # Sizes before storing, files may go while stored
+        sizes = dict((job[0], _file_size(job[0])) for job in batch)
+        try:
+            results = _store_batch(state, batch, manifest, source)
+        except Exception as e:
+            results = [(path, data, 1, "Error storing from {}: {}".format(path, e))
+                    for path, suburl, data in batch]
+        return [result + (sizes[result[0]],) for result in results]
+
+    def manifest(i):
+        return os.path.join(state.model.dir_temp, "_manifest_{}.csv".format(i))
+
+    batches = _group_jobs(jobs, STORE_BATCH_SIZE)
+
+    # Single transfer: no threads
+    if state.model.transfers <= 1:
+        for batch in batches:
+            for result in store_batch(batch, manifest(0)):
+                fails += finished(*result)
+            if max_fails and fails >= max_fails:
+                break
+        return fails
+
+    # Bounded, so that jobs iterable is not read ahead too far
+    work = Queue.Queue(state.model.transfers)
+    results = Queue.Queue()
+
+    def worker(i):
+        while True:
+            batch = work.get()
+            if batch is None:
+                return
+            results.put(store_batch(batch, manifest(i)))
+
+    pool = [threading.Thread(target = worker, args = (i,))
+            for i in range(state.model.transfers)]
+    for t in pool:
+        t.daemon = True
+        t.start()
+
+    pending = 0
+    try:
+        for batch in batches:
+            if max_fails and fails >= max_fails:
+                break
+
+            work.put(batch)
+            pending += 1
+
+            # Report finished ones without waiting
+            while True:
+                try:
+                    done = results.get_nowait()
+                except Queue.Empty:
+                    break
+                pending -= 1
+                for result in done:
+                    fails += finished(*result)
+
+        # Wait for batches in flight
+        while pending:
+            pending -= 1
+            for result in results.get():
+                fails += finished(*result)
+
+    finally:
+        for t in pool:
+            work.put(None)
+        for t in pool:
+            t.join()
+
+    return fails
+
+
 #-------------------------------------------------------------------
 # Restore: local <--- storage
 #-------------------------------------------------------------------
@@ -197,7 +795,7 @@ def restore(state, suburl, path, filename, atype):
     Restore file from storage to local disk
     '''
     url = build_url(state, suburl, filename)
-    result, err, msg = storage_iface.copy_storage_to_local(url, path)
+    result, err, msg = state.iface.copy_storage_to_local(url, path)
     if err:
         msg = "Error restoring from {}, to {}: {}".format(url, path, msg)
 
@@ -218,7 +816,7 @@ def unstore(state, suburl, filename):
     Delete file from storage
     '''
     url = build_url(state, suburl, filename)
-    result, err, msg = storage_iface.remove_from_storage(url)
+    result, err, msg = state.iface.remove_from_storage(url)
     if err:
         _D.ERROR(
                 __name__,
@@ -231,16 +829,81 @@ def unstore(state, suburl, filename):
     return result, err, msg
 
 
+#-------------------------------------------------------------------
+# Unstore many: delete files from storage
+#-------------------------------------------------------------------
+def unstore_many(state, suburl, filenames):
+    '''
+    Delete files from storage with single storage invocation.
+    Returns { filename: (err, msg) }, count of failures
+    '''
+    if not filenames:
+        return {}, 0
+
+    urls = {}
+    for filename in filenames:
+        urls[build_url(state, suburl, filename)] = filename
+
+    results, err, msg = state.iface.remove_from_storage_batch(urls.keys())
+
+    out = {}
+    fails = 0
+    for url, filename in urls.items():
+        err, msg = results[url]
+        if err:
+            fails += 1
+            _D.ERROR(
+                    __name__,
+                    "Error unstoring file",
+                    'url', url,
+                    'msg', msg
+                    )
+        out[filename] = (err, msg)
+
+    return out, fails
+
+
+#-------------------------------------------------------------------
+# List: files in storage
+#-------------------------------------------------------------------
+def list_stored(state, suburl):
+    '''
+    List files stored under suburl, recursively.
+    Returns [(url, size), ...], err, msg
+    '''
+    url = build_url(state, suburl)
+    objects, err, msg = state.iface.list_storage(url)
+    if err:
+        msg = "Error listing {}: {}".format(url, msg)
+
+    return objects, err, msg
+
+
+#-------------------------------------------------------------------
+# Stat: file in storage
+#-------------------------------------------------------------------
+def stat_stored(state, suburl, filename):
+    '''
+    Size of stored file, err, msg
+    '''
+    url = build_url(state, suburl, filename)
+    size, err, msg = state.iface.stat_storage(url)
+    if err:
+        msg = "Error getting info of {}: {}".format(url, msg)
+
+    return size, err, msg
+
+
 #-------------------------------------------------------------------
 # Store DB: local ---> storage
 #-------------------------------------------------------------------
-def _store_db(path, url, filename):
+def _store_db(state, path, url, filename):
     '''
     Special case of store. DB files need to be handled differently
     '''
     path = os.path.join(path, filename)
     url = "{}/{}".format(url, filename)
-    res, err, msg = storage_iface.copy_local_to_storage(path, url)
+    res, err, msg = _copy_to_storage(state, path, url)
     if err:
         msg = "Error storing DB from {}, to {}, file {}: {}".format(url, path, filename, res)
 
@@ -250,12 +913,12 @@ def _store_db(path, url, filename):
 #-------------------------------------------------------------------
 # Restore DB: local <--- storage
 #-------------------------------------------------------------------
-def _restore_db(url, path, filename):
+def _restore_db(state, url, path, filename):
     '''
     Special case of restore. DB files need to be handled differently
     '''
     url = "{}/{}".format(url, filename)
-    res, err, msg = storage_iface.copy_storage_to_local(url, path)
+    res, err, msg = state.iface.copy_storage_to_local(url, path)
     if err:
         msg = "Error restoring DB from {}, to {}, file {}: {}".format(url, path, filename, res)
 
@@ -281,6 +944,8 @@ def _init_model(date_str, date_int, dir_temp, params):
         return None, 1, "params:type must be provided"
     if not params.get('scheme', None):
         return None, 1, "params:scheme must be provided"
+    if not storages.get(params['scheme']):
+        return None, 1, "params:scheme not supported: {}".format(params['scheme'])
     if not params.get('bucket', None):
         return None, 1, "params:bucket must be provided"
     if not params.get('dirstorage', None):
@@ -290,6 +955,7 @@ def _init_model(date_str, date_int, dir_temp, params):
     url_db = ''.join(
                 urlutil.url_build(
                         params['scheme'],
+                        params.get('host', None),
                         params['bucket'],
                         params['dirstorage'],
                         '_aeroback'
@@ -298,8 +964,12 @@ def _init_model(date_str, date_int, dir_temp, params):
     model = Model(
                 atype = params['type'],
                 scheme = params['scheme'],
+                host = params.get('host', None),
                 bucket = params['bucket'],
                 dirstorage = params['dirstorage'],
+                transfers = params.get('transfers', 1),
+                parallel_threshold = params.get('parallel_threshold', 0) * 1024 * 1024,
+                parallel_slices = params.get('parallel_slices', 4),
                 date_str = date_str,
                 date_int = date_int,
                 dir_temp = dir_temp,
@@ -339,6 +1009,11 @@ def init(date_str, date_int, dir_temp, params):
     if err:
         return None, err, msg
 
+    # Backend settings of this storage
+    err, msg = state.iface.configure(build_url(state), params)
+    if err:
+        return None, err, msg
+
     # Init storage stats manager
     dbrstate, err, msg = dbr.init(
             date_str,
@@ -360,6 +1035,7 @@ def execute(state):
 
     # Restore DB from storage
     err, msg = _restore_db(
+            state,
             state.model.url_db,
             state.model.dir_temp,
             state.states.dbr.model.filename
@@ -407,6 +1083,7 @@ def cleanup(state):
 
     # Store DB, report exception
     err, msg = _store_db(
+            state,
             state.model.dir_temp,
             state.model.url_db,
             state.states.dbr.model.filename
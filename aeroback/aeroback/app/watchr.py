@@ -0,0 +1,164 @@
+import os
+import time
+import errno
+import select
+
+#-----------------------------------------------------------------------
+import aeroback.diagnostics.diagnostics as _D
+
+import iface.fs_inotify as inotify_iface
+
+'''
+Directory watcher module:
+    - watches directory tree with inotify
+    - appends changed paths to journal consumed by dir_increment backup
+
+Runs as long-lived process, see aerowatch.py
+'''
+
+
+#-----------------------------------------------------------------------
+# Event to journal record
+#-----------------------------------------------------------------------
+def _event_record(mask):
+    if mask & inotify_iface.IN_CREATE:
+        return inotify_iface.JOURNAL_CREATED
+    if mask & (inotify_iface.IN_DELETE | inotify_iface.IN_DELETE_SELF):
+        return inotify_iface.JOURNAL_DELETED
+    if mask & inotify_iface.IN_MOVED_FROM:
+        return inotify_iface.JOURNAL_MOVED_FROM
+    if mask & inotify_iface.IN_MOVED_TO:
+        return inotify_iface.JOURNAL_MOVED_TO
+    return inotify_iface.JOURNAL_MODIFIED
+
+
+#-----------------------------------------------------------------------
+# Watch directory tree
+#-----------------------------------------------------------------------
+def _add_tree(fd, directory, watches, top):
+    """
+    Adds watch to top and all its subdirectories.
+    Re-adding directory moved within tree returns the same
+    watch descriptor, its relative path is updated.
+    """
+    for path, dirs, files in os.walk(os.path.join(directory, top)):
+        try:
+            wd = inotify_iface.add_watch(fd, path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                # Out of watches: changes below would go unnoticed
+                raise
+            # Vanished meanwhile
+            continue
+
+        watches[wd] = os.path.normpath(os.path.relpath(path, directory))
+        if watches[wd] == '.':
+            watches[wd] = ''
+
+
+#-----------------------------------------------------------------------
+# Convert events to journal records
+#-----------------------------------------------------------------------
+def _process_events(fd, directory, watches, events):
+    records = []
+    seen = set()
+
+    for wd, mask, cookie, name in events:
+        if mask & inotify_iface.IN_Q_OVERFLOW:
+            _D.WARNING(
+                    __name__,
+                    "inotify queue overflow, changes lost"
+                    )
+            records.append((inotify_iface.JOURNAL_OVERFLOW, str(time.time())))
+            continue
+
+        if mask & inotify_iface.IN_IGNORED:
+            watches.pop(wd, None)
+            continue
+
+        if wd not in watches:
+            continue
+
+        relpath = os.path.join(watches[wd], name)
+        record = (_event_record(mask), relpath)
+        if record not in seen:
+            seen.add(record)
+            records.append(record)
+
+        # New directory: watch it with its subtree
+        if mask & inotify_iface.IN_ISDIR \
+                and mask & (inotify_iface.IN_CREATE | inotify_iface.IN_MOVED_TO):
+            _add_tree(fd, directory, watches, relpath)
+
+    return records
+
+
+#-----------------------------------------------------------------------
+# Run watcher
+#-----------------------------------------------------------------------
+def run(directory, journal):
+    """
+    Watches directory until interrupted.
+    Returns:
+        err - 0 = OK, 1 = ERROR
+        msg - error details
+    """
+    directory = os.path.normpath(directory)
+    if not os.path.isdir(directory):
+        return 1, "Directory not found: {}".format(directory)
+
+    try:
+        fd = inotify_iface.inotify_init()
+    except OSError as e:
+        return 1, "Error initializing inotify: {}".format(e)
+
+    try:
+        # Anything changed before watches were added is unknown
+        inotify_iface.journal_write(
+                journal,
+                [(inotify_iface.JOURNAL_START, str(time.time()))])
+
+        watches = {}
+        try:
+            _add_tree(fd, directory, watches, '')
+        except OSError as e:
+            return 1, "Error adding watches, raise fs.inotify.max_user_watches: {}".format(e)
+
+        _D.DEBUG(
+                __name__,
+                "Watching directory",
+                'dir', directory,
+                'journal', journal,
+                'watches', len(watches)
+                )
+
+        next_beat = time.time()
+        while True:
+            now = time.time()
+            if now >= next_beat:
+                inotify_iface.journal_write(
+                        journal,
+                        [(inotify_iface.JOURNAL_HEARTBEAT, str(now))])
+                next_beat = now + inotify_iface.HEARTBEAT_PERIOD
+
+            ready, _, _ = select.select([fd], [], [], next_beat - now)
+            if not ready:
+                continue
+
+            events = inotify_iface.read_events(fd)
+            try:
+                records = _process_events(fd, directory, watches, events)
+            except OSError as e:
+                inotify_iface.journal_write(
+                        journal,
+                        [(inotify_iface.JOURNAL_OVERFLOW, str(time.time()))])
+                return 1, "Error adding watches, raise fs.inotify.max_user_watches: {}".format(e)
+
+            if records:
+                inotify_iface.journal_write(journal, records)
+
+    except KeyboardInterrupt:
+        return 0, None
+
+    finally:
+        os.close(fd)
@@ -1,4 +1,5 @@
 import sys
+import tempfile
 import subprocess
 
 #-----------------------------------------------------------------------
@@ -46,6 +47,40 @@ def call_cmd(args, shell = False):
         return "Exception invoking cmd", 1, "{}: {}".format(exc_type, exc_value)
 
 
+#-----------------------------------------------------------------------
+# Call subprocess, feed data to its stdin
+#-----------------------------------------------------------------------
+def call_cmd_input(args, data):
+    """
+    Invokes process, writes data to its standard input.
+    Returns same as call_cmd():
+        result - string returned from command, or error
+        err - 0 = OK, 1 = ERROR, 2 = WARNING
+        msg - error details
+    """
+    print 'CMD:', args, '<', len(data), 'bytes'
+
+    try:
+        proc = subprocess.Popen(
+                args,
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE,
+                stderr = subprocess.STDOUT)
+        output, _ = proc.communicate(data)
+
+        if proc.returncode:
+            return proc.returncode, 1, output
+
+        return output, 0, None
+
+    except (OSError, ValueError, RuntimeError) as e:
+        return "Exception invoking cmd", 1, str(e)
+
+    except:
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        return "Exception invoking cmd", 1, "{}: {}".format(exc_type, exc_value)
+
+
 #-----------------------------------------------------------------------
 # Call subprocess and raise if exception
 #-----------------------------------------------------------------------
@@ -112,3 +147,103 @@ class A:
     #-------------------------------------------------------------------
     def on_err(self, a, b, c):
         self.hx.warn_add("Can't '{}'".format(a), "exc", c)
+
+
+#-----------------------------------------------------------------------
+# Call subprocess, stream data to its stdin
+#-----------------------------------------------------------------------
+def call_cmd_stream(args, stream, block_size = 1024 * 1024):
+    """
+    Invokes process, copies file object stream to its standard input
+    until end of stream. Output is collected in temporary file, so
+    that process never blocks on it.
+    Returns same as call_cmd()
+    """
+    print 'CMD:', args, '< stream'
+
+    try:
+        output = tempfile.TemporaryFile()
+        proc = subprocess.Popen(
+                args,
+                stdin = subprocess.PIPE,
+                stdout = output,
+                stderr = subprocess.STDOUT)
+
+        try:
+            while True:
+                block = stream.read(block_size)
+                if not block:
+                    break
+                proc.stdin.write(block)
+        except IOError:
+            # Process quit early, its output tells why
+            pass
+        finally:
+            proc.stdin.close()
+
+        proc.wait()
+        output.seek(0)
+        result = output.read()
+        output.close()
+
+        if proc.returncode:
+            return proc.returncode, 1, result
+
+        return result, 0, None
+
+    except (OSError, ValueError, RuntimeError) as e:
+        return "Exception invoking cmd", 1, str(e)
+
+    except:
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        return "Exception invoking cmd", 1, "{}: {}".format(exc_type, exc_value)
+
+
+#-----------------------------------------------------------------------
+# Start subprocess, its output is read as stream
+#-----------------------------------------------------------------------
+def open_cmd(args):
+    """
+    Starts process, caller reads its standard output from
+    proc.stdout and must call close_cmd(proc).
+    Returns:
+        proc - process, None on error
+        err, msg
+    """
+    print 'CMD:', args, '> stream'
+
+    try:
+        errors = tempfile.TemporaryFile()
+        proc = subprocess.Popen(
+                args,
+                stdout = subprocess.PIPE,
+                stderr = errors)
+        proc.errors = errors
+        return proc, 0, None
+
+    except (OSError, ValueError, RuntimeError) as e:
+        return None, 1, str(e)
+
+
+#-----------------------------------------------------------------------
+# Finish subprocess started by open_cmd()
+#-----------------------------------------------------------------------
+def close_cmd(proc, kill = False):
+    """
+    Waits for process to exit, or kills it first.
+    Returns same as call_cmd(), result is error output
+    """
+    if kill and proc.poll() is None:
+        proc.kill()
+
+    proc.stdout.close()
+    proc.wait()
+
+    proc.errors.seek(0)
+    result = proc.errors.read()
+    proc.errors.close()
+
+    if proc.returncode:
+        return proc.returncode, 1, result
+
+    return result, 0, None
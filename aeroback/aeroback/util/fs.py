@@ -165,6 +165,57 @@ def find_files_grouped(path, file_template, date_sort=1, head_count=5):
     return FileFinder(file_template).find_into_groups(path, date_sort, head_count)
 
 
+#-----------------------------------------------------------------------
+# Class: Path Trie
+#-----------------------------------------------------------------------
+class PathTrie:
+    """
+    Set of relative paths compiled into a trie of path components.
+    Tells whether a path lies under one of paths, or leads to one,
+    in a single pass over the path's components.
+    """
+
+    # Marks end of a path, never equal to a folder name
+    _END = os.sep
+
+    #-------------------------------------------------------------------
+    def __init__(self, paths):
+        # Node is a dict of children
+        self.root = {}
+        for p in paths:
+            node = self.root
+            for folder in path_to_list(os.path.normpath(p))[1]:
+                node = node.setdefault(folder, {})
+            node[PathTrie._END] = True
+
+    #-------------------------------------------------------------------
+    def __len__(self):
+        return len(self.root)
+
+    #-------------------------------------------------------------------
+    def lookup(self, relpath):
+        """
+        Returns tuple:
+            [0] - True if relpath is one of paths or lies under one
+            [1] - True if relpath is a parent of one of paths
+        a/b, paths = a ---> True, False
+        a, paths = a/b ---> False, True
+        a/c, paths = a/b ---> False, False
+        """
+        node = self.root
+        if PathTrie._END in node:
+            return True, False
+
+        for folder in relpath.split(os.sep):
+            node = node.get(folder, None)
+            if node is None:
+                return False, False
+            if PathTrie._END in node:
+                return True, False
+
+        return False, True
+
+
 #-----------------------------------------------------------------------
 # Error handler: Directory tree remover
 #-----------------------------------------------------------------------
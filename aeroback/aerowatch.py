@@ -0,0 +1,34 @@
+#!/usr/bin/python
+
+import sys
+
+#-----------------------------------------------------------------------
+import aeroback.diagnostics.diagnostics as _D
+import aeroback.app.watchr as watchr
+
+
+#-----------------------------------------------------------------------
+# Watch directory, write changes journal for dir_increment backup
+#
+# Usage: aerowatch.py <directory> <journal>
+#-----------------------------------------------------------------------
+def watch_run(argv):
+    if len(argv) != 3:
+        print "Usage: {} <directory> <journal>".format(argv[0])
+        return 1
+
+    _D.configure_for_tests()
+
+    err, msg = watchr.run(argv[1], argv[2])
+    if err:
+        print "[Watcher]: {}".format(msg)
+        return err
+
+    return 0
+
+
+#-----------------------------------------------------------------------
+# MAIN
+#
+if __name__ == '__main__':
+    sys.exit(watch_run(sys.argv))
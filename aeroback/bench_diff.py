@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+#-----------------------------------------------------------------------
+import aeroback.app.dbr_fileincr as dbr
+
+
+#-----------------------------------------------------------------------
+# Benchmark of local vs storage diff in File Incremental Tracking DB
+#
+# Usage: bench_diff.py [rows ...]
+#
+# For each row count builds synthetic files_storage and files_local
+# (10% of local files new, 10% modified) and times find_local_storage_diff.
+# Query used before anti-join is timed too, up to OLD_QUERY_MAX_ROWS.
+#-----------------------------------------------------------------------
+DEFAULT_ROWS = [100000, 1000000, 5000000]
+
+# Former query is quadratic, don't wait for it on big tables
+OLD_QUERY_MAX_ROWS = 10000
+
+OLD_QUERY = "SELECT DISTINCT a.* \
+        FROM files_local a \
+        INNER JOIN files_storage b \
+        ON \
+        a.name NOT IN (SELECT name FROM files_storage) \
+        OR \
+        a.name=b.name AND (a.modified!=b.modified OR a.size!=b.size)"
+
+
+#-----------------------------------------------------------------------
+# Synthetic rows
+#-----------------------------------------------------------------------
+def _rows(count):
+    rnd = random.Random(count)
+    for i in xrange(count):
+        name = "dir{}/sub{}/file{}.dat".format(i % 1000, i % 37, i)
+        yield name, 1400000000 + rnd.randint(0, 10000000), rnd.randint(0, 1 << 24)
+
+
+#-----------------------------------------------------------------------
+# Fill DB
+#-----------------------------------------------------------------------
+def _fill(state, count):
+    c = state.db_conn.cursor()
+
+    local = []
+    storage = []
+    expected = 0
+    for i, row in enumerate(_rows(count)):
+        local.append(row)
+        if i % 10 == 0:
+            # New file, not in storage yet
+            expected += 1
+        elif i % 10 == 1:
+            # Modified since stored
+            storage.append((row[0], row[1] - 1, row[2]))
+            expected += 1
+        else:
+            storage.append(row)
+
+        if len(local) == 100000:
+            c.executemany("INSERT INTO files_local VALUES (?, ?, ?)", local)
+            c.executemany("INSERT INTO files_storage (name, modified, size) VALUES (?, ?, ?)", storage)
+            local = []
+            storage = []
+
+    c.executemany("INSERT INTO files_local VALUES (?, ?, ?)", local)
+    c.executemany("INSERT INTO files_storage (name, modified, size) VALUES (?, ?, ?)", storage)
+    state.db_conn.commit()
+
+    return expected
+
+
+#-----------------------------------------------------------------------
+# Run benchmark for one row count
+#-----------------------------------------------------------------------
+def _bench(dir_db, count):
+    state, err, msg = dbr.init('bench', int(time.time()), dir_db, "bench_{}.db".format(count))
+    if err:
+        print msg
+        return
+
+    dbr.execute(state)
+
+    start = time.time()
+    expected = _fill(state, count)
+    fill_time = time.time() - start
+
+    c = state.db_conn.cursor()
+
+    if count <= OLD_QUERY_MAX_ROWS:
+        start = time.time()
+        c.execute(OLD_QUERY)
+        old_count = len(c.fetchall())
+        old_time = "{:.2f}s ({} rows)".format(time.time() - start, old_count)
+    else:
+        old_time = "skipped"
+
+    start = time.time()
+    dbr.find_local_storage_diff(state, 0)
+    new_time = time.time() - start
+
+    c.execute("SELECT COUNT(*) FROM files_upload")
+    found = c.fetchone()[0]
+
+    print "{:>9} rows: fill {:.2f}s, diff {:.2f}s ({} rows, expected {}), former query {}".format(
+            count, fill_time, new_time, found, expected, old_time)
+
+    state.db_conn.close()
+    os.remove(state.model.filepath)
+
+
+#-----------------------------------------------------------------------
+# MAIN
+#
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        counts = [int(a) for a in sys.argv[1:]]
+    else:
+        counts = DEFAULT_ROWS
+
+    dir_db = tempfile.mkdtemp(prefix = 'aeroback_bench_')
+    try:
+        for count in counts:
+            _bench(dir_db, count)
+    finally:
+        shutil.rmtree(dir_db)
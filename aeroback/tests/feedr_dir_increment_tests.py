@@ -0,0 +1,272 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import aeroback.context.context as context
+import aeroback.app.storager as storager
+import aeroback.app.dbr_fileincr as dbr
+import aeroback.app.feedr_dir_increment as feedr
+import aeroback.app.iface.fs_hash as hash_iface
+import aeroback.app.iface.fs_chunk as chunk_iface
+
+
+#-----------------------------------------------------------------------
+# Tests of incremental backup to local directory storage:
+# store, change, store again, restore
+#-----------------------------------------------------------------------
+class FeedrDirIncrementTests(unittest.TestCase):
+
+    def setUp(self):
+        context.init({'-dry': False})
+
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src')
+        self.bucket = os.path.join(self.dir, 'storage')
+        self.stored = os.path.join(self.bucket, 'home', 'inc')
+        os.makedirs(self.src)
+
+        self.run_n = 0
+        self.storstate = None
+        self.dbrstate = None
+
+        # Files hashed, not taken from hash cache
+        self.hashed = []
+        self.saved = (hash_iface.hash_many, feedr.PACK_SIZE)
+
+        def hash_many(pool, jobs):
+            def counted():
+                for data, path, key in jobs:
+                    if path:
+                        self.hashed.append(path)
+                    yield data, path, key
+            return self.saved[0](pool, counted())
+
+        hash_iface.hash_many = hash_many
+
+    def tearDown(self):
+        self._close()
+        hash_iface.hash_many, feedr.PACK_SIZE = self.saved
+        shutil.rmtree(self.dir)
+
+    #-------------------------------------------------------------------
+    def _write(self, relpath, data, mtime = None):
+        path = os.path.join(self.src, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        # Change shows up even within the same second
+        mtime = mtime or time.time() + self.run_n
+        os.utime(path, (mtime, mtime))
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _close(self):
+        if self.dbrstate:
+            dbr.cleanup(self.dbrstate)
+            self.dbrstate = None
+        if self.storstate:
+            storager.cleanup(self.storstate)
+            self.storstate = None
+
+    #-------------------------------------------------------------------
+    def _backup(self, **params):
+        '''
+        Runs backup, returns its session stats, keeps storage and
+        tracking DB open for restore
+        '''
+        self._close()
+        self.run_n += 1
+        del self.hashed[:]
+
+        dir_temp = os.path.join(self.dir, "temp{}".format(self.run_n))
+        os.makedirs(os.path.join(dir_temp, 'storage'))
+        os.makedirs(os.path.join(dir_temp, 'feedr'))
+
+        storstate, err, msg = storager.init(
+                '2026_01',
+                1700000000,
+                os.path.join(dir_temp, 'storage'),
+                {'type': 'file', 'scheme': 'file', 'bucket': self.bucket, 'dirstorage': 'home'})
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(storager.execute(storstate), (0, None))
+        self.storstate = storstate
+
+        backup = {'type': 'dir_increment', 'dir': self.src, 'dirstorage': 'inc',
+                'maxupload': 10 ** 9, 'includes': [], 'excludes': [], 'description': 'Test'}
+        backup.update(params)
+        state, err, msg = feedr.init(
+                "2026_{:02d}".format(self.run_n),
+                1700000000 + self.run_n,
+                os.path.join(dir_temp, 'feedr'),
+                [storstate],
+                backup)
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(feedr.execute(state), (0, None))
+        feedr.cleanup(state)
+        self.assertEqual(state.get_msgs_error(), [])
+
+        # Tracking DB as stored
+        dbrstate = state.states.dbr
+        self.dbrstate, err, msg = dbr.init('restore', 1, dbrstate.model.dir_db, dbrstate.model.filename)
+        self.assertEqual(err, 0, msg)
+        dbr.execute(self.dbrstate)
+
+        return dict(state.get_stats()['Session Uploaded file'])
+
+    def _assert_restored(self, relpath):
+        target = os.path.join(self.dir, 'restored')
+        self.assertEqual(
+                feedr.restore_file(self.storstate, self.dbrstate, 'inc', relpath, target),
+                (0, None))
+        self.assertEqual(self._read(target), self._read(os.path.join(self.src, relpath)))
+        os.remove(target)
+
+    def _stored_chunks(self):
+        return set(os.listdir(os.path.join(self.stored, feedr.CHUNKS_DIR)))
+
+    #-------------------------------------------------------------------
+    def test_chunked(self):
+        data = os.urandom(4 * 1024 * 1024)
+        self._write('big.img', data)
+        self._write('small', 'small')
+
+        stats = self._backup(chunked = 1024 * 1024)
+        first = self._stored_chunks()
+        chunks = dbr.get_file_chunks(self.dbrstate, 'big.img')
+
+        self.assertEqual(stats['Files chunked'], 1)
+        self.assertEqual(stats['Files count'], 2)
+        self.assertTrue(len(first) > 1)
+        self.assertEqual(set(h for h, size in chunks), first)
+        self.assertEqual(sum(size for h, size in chunks), len(data))
+        self.assertEqual(dbr.get_file_chunks(self.dbrstate, 'small'), None)
+        self._assert_restored('big.img')
+        self._assert_restored('small')
+
+        # Insert in the middle: only chunks around it are new
+        data = data[:2000000] + 'INSERTED' + data[2000000:]
+        self._write('big.img', data)
+
+        stats = self._backup(chunked = 1024 * 1024)
+        new = self._stored_chunks() - first
+
+        self.assertEqual(stats['Files chunked'], 1)
+        self.assertEqual(stats['Files count'], 1)
+        self.assertTrue(1 <= len(new) <= 2, new)
+        self.assertEqual(
+                [h for h, size in dbr.get_file_chunks(self.dbrstate, 'big.img')],
+                [h for h, d in chunk_iface.chunks(open(os.path.join(self.src, 'big.img'), 'rb'))])
+        self._assert_restored('big.img')
+
+        # Chunking off: stored whole again
+        data += 'tail'
+        self._write('big.img', data)
+
+        self._backup()
+
+        self.assertEqual(dbr.get_file_chunks(self.dbrstate, 'big.img'), None)
+        self._assert_restored('big.img')
+
+    #-------------------------------------------------------------------
+    def test_packed(self):
+        feedr.PACK_SIZE = 4000
+        for i in range(30):
+            self._write("a/f{:02d}".format(i), "file {} ".format(i) * 40)
+        self._write('whole', 'W' * 5000)
+
+        stats = self._backup(packed = 1024, hash = True)
+        packs = os.listdir(os.path.join(self.stored, feedr.PACKS_DIR))
+
+        self.assertEqual(stats['Files packed'], 30)
+        self.assertEqual(stats['Files count'], 31)
+        self.assertEqual(stats['Packs stored'], len(packs))
+        self.assertTrue(len(packs) > 1)
+        self.assertTrue(os.path.exists(os.path.join(self.stored, 'whole')))
+        self.assertFalse(os.path.exists(os.path.join(self.stored, 'a', 'f00')))
+        for i in range(30):
+            self._assert_restored("a/f{:02d}".format(i))
+        self._assert_restored('whole')
+
+        # Most files changed, old packs are repacked
+        for i in range(20):
+            self._write("a/f{:02d}".format(i), "changed {} ".format(i) * 30)
+        # Touched only, keeps its place in pack
+        os.utime(os.path.join(self.src, 'a', 'f25'), (time.time() + 100, time.time() + 100))
+
+        stats = self._backup(packed = 1024, hash = True)
+        c = self.dbrstate.db_conn.cursor()
+        c.execute("SELECT name FROM packs")
+        recorded = set(row[0] for row in c.fetchall())
+
+        self.assertEqual(stats['Files packed'], 20)
+        self.assertEqual(stats['Files unchanged'], 1)
+        self.assertTrue(stats['Packs repacked'] > 0)
+        self.assertEqual(recorded, set(os.listdir(os.path.join(self.stored, feedr.PACKS_DIR))))
+        self.assertNotEqual(dbr.get_file_packed(self.dbrstate, 'a/f25'), None)
+        for i in range(30):
+            self._assert_restored("a/f{:02d}".format(i))
+
+    #-------------------------------------------------------------------
+    def test_hash_unchanged(self):
+        for i in range(10):
+            self._write("d/f{}".format(i), "content {}".format(i))
+
+        stats = self._backup(hash = True)
+        self.assertEqual(stats['Files count'], 10)
+        self.assertEqual(len(self.hashed), 10)
+
+        # Touched: hashed again, not uploaded
+        for i in range(10):
+            os.utime(os.path.join(self.src, 'd', "f{}".format(i)), (time.time() + 100, time.time() + 100))
+
+        stats = self._backup(hash = True)
+        self.assertEqual(stats['Files count'], 0)
+        self.assertEqual(stats['Files unchanged'], 10)
+        self.assertEqual(len(self.hashed), 10)
+
+        # Changed content is uploaded
+        self._write('d/f3', 'new content')
+
+        stats = self._backup(hash = True)
+        self.assertEqual(stats['Files count'], 1)
+        self.assertEqual(stats['Files unchanged'], 0)
+        self.assertEqual(self.hashed, [os.path.join(self.src, 'd', 'f3')])
+        self.assertEqual(self._read(os.path.join(self.stored, 'd', 'f3')), 'new content')
+        self._assert_restored('d/f3')
+
+    #-------------------------------------------------------------------
+    def test_moved(self):
+        for i in range(10):
+            self._write("big/sub/f{}".format(i), "content {}".format(i))
+
+        self._backup(hash = True)
+
+        # Renamed directory, and a copy of stored content
+        os.rename(os.path.join(self.src, 'big'), os.path.join(self.src, 'moved'))
+        self._write('copy_of_3', 'content 3')
+
+        stats = self._backup(hash = True)
+
+        # Renamed files keep cached hashes, copy is hashed
+        self.assertEqual(self.hashed, [os.path.join(self.src, 'copy_of_3')])
+        self.assertEqual(stats['Files moved'], 11)
+        self.assertEqual(stats['Files count'], 0)
+        for i in range(10):
+            relpath = "moved/sub/f{}".format(i)
+            self.assertEqual(
+                    self._read(os.path.join(self.stored, relpath)),
+                    "content {}".format(i))
+            self._assert_restored(relpath)
+        self._assert_restored('copy_of_3')
+
+        # Old place is kept
+        self.assertTrue(os.path.exists(os.path.join(self.stored, 'big', 'sub', 'f0')))
+
+
+if __name__ == '__main__':
+    unittest.main()
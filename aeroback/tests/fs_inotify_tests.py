@@ -0,0 +1,84 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import aeroback.app.iface.fs_inotify as inotify_iface
+
+
+#-----------------------------------------------------------------------
+# Tests of changes journal
+#-----------------------------------------------------------------------
+class JournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.dir, 'data.journal')
+        inotify_iface.journal_write(self.journal, [
+                (inotify_iface.JOURNAL_HEARTBEAT, str(time.time())),
+                (inotify_iface.JOURNAL_MODIFIED, 'a/b.txt'),
+                (inotify_iface.JOURNAL_CREATED, 'tab\there')])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    #-------------------------------------------------------------------
+    def test_consume(self):
+        paths, gap = inotify_iface.journal_consume(self.journal, 60)
+
+        self.assertEqual(gap, None)
+        self.assertEqual(paths, set(['a/b.txt', 'tab\there']))
+
+    def test_uncommitted_read_again(self):
+        inotify_iface.journal_consume(self.journal, 60)
+        inotify_iface.journal_write(self.journal, [(inotify_iface.JOURNAL_DELETED, 'c')])
+
+        # Run did not store its DB: changes are read again
+        paths, gap = inotify_iface.journal_consume(self.journal, 60)
+
+        self.assertEqual(gap, None)
+        self.assertEqual(paths, set(['a/b.txt', 'tab\there', 'c']))
+
+    def test_committed_not_read_again(self):
+        inotify_iface.journal_consume(self.journal, 60)
+        inotify_iface.journal_commit(self.journal)
+        inotify_iface.journal_write(self.journal, [(inotify_iface.JOURNAL_DELETED, 'c')])
+
+        paths, gap = inotify_iface.journal_consume(self.journal, 60)
+
+        self.assertEqual(gap, None)
+        self.assertEqual(paths, set(['c']))
+        self.assertFalse(os.path.exists(self.journal + '.pending.tmp'))
+
+    def test_uncommitted_gap_kept(self):
+        inotify_iface.journal_write(self.journal, [(inotify_iface.JOURNAL_OVERFLOW, str(time.time()))])
+        paths, gap = inotify_iface.journal_consume(self.journal, 60)
+        self.assertNotEqual(gap, None)
+
+        # Full scan of previous run did not finish either
+        paths, gap = inotify_iface.journal_consume(self.journal, 60)
+        self.assertNotEqual(gap, None)
+
+        inotify_iface.journal_commit(self.journal)
+        paths, gap = inotify_iface.journal_consume(self.journal, 60)
+        self.assertEqual((paths, gap), (set(), None))
+
+    def test_silent_watcher(self):
+        inotify_iface.journal_consume(self.journal, 60)
+        inotify_iface.journal_commit(self.journal)
+
+        paths, gap = inotify_iface.journal_consume(self.journal, -1)
+
+        self.assertEqual(paths, set())
+        self.assertNotEqual(gap, None)
+
+    def test_no_journal(self):
+        paths, gap = inotify_iface.journal_consume(os.path.join(self.dir, 'nope'), 60)
+
+        self.assertEqual(paths, set())
+        self.assertNotEqual(gap, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import re
+import stat
+import shutil
+import tempfile
+import unittest
+
+import aeroback.app.iface.fs_scandir as fs_iface
+
+
+#-----------------------------------------------------------------------
+# Tests of parallel walker against serial one
+#-----------------------------------------------------------------------
+class WalkFilesParallelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.unreadable = os.path.join(self.dir, 'a', 'locked')
+
+        # Nested directories
+        for i in range(5):
+            for j in range(4):
+                self._file(os.path.join('a', "d{}".format(i), "e{}".format(j), 'f.txt'))
+                self._file(os.path.join('a', "d{}".format(i), "e{}".format(j), 'g.tmp'))
+            self._file(os.path.join('a', "d{}".format(i), "f{}.txt".format(i)))
+        self._file(os.path.join('b', 'c', 'd', 'e', 'deep.txt'))
+        self._file('top.txt')
+        self._file('top.tmp')
+
+        # Ignored and partly collected directories
+        self._file(os.path.join('.git', 'config'))
+        self._file(os.path.join('skip', 'f.txt'))
+        self._file(os.path.join('skip', 'keep', 'f.txt'))
+
+        # Symlinks: to file, to directory, dangling
+        os.symlink(os.path.join(self.dir, 'top.txt'), os.path.join(self.dir, 'a', 'link.txt'))
+        os.symlink(os.path.join(self.dir, 'b'), os.path.join(self.dir, 'a', 'linkdir'))
+        os.symlink(os.path.join(self.dir, 'nowhere'), os.path.join(self.dir, 'a', 'dangling'))
+
+        # Unreadable directory
+        self._file(os.path.join('a', 'locked', 'secret.txt'))
+        os.chmod(self.unreadable, 0)
+
+        patterns = re.compile(r'^\.git$|\.tmp$')
+
+        def dir_filter(relpath, name):
+            if patterns.search(name):
+                return fs_iface.DIR_PRUNE
+            if name == 'skip':
+                return fs_iface.DIR_TRAVERSE
+            return fs_iface.DIR_COLLECT
+
+        def file_filter(name):
+            return not patterns.search(name)
+
+        self.dir_filter = dir_filter
+        self.file_filter = file_filter
+
+    def tearDown(self):
+        os.chmod(self.unreadable, stat.S_IRWXU)
+        shutil.rmtree(self.dir)
+
+    #-------------------------------------------------------------------
+    def _file(self, relpath):
+        path = os.path.join(self.dir, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(relpath)
+
+    #-------------------------------------------------------------------
+    def test_same_files_as_serial(self):
+        serial = list(fs_iface.walk_files(self.dir, self.dir_filter, self.file_filter))
+        expected = set(serial)
+
+        # Filters, symlinks and nesting took effect
+        names = set(f[0] for f in serial)
+        self.assertIn(os.path.join('a', 'link.txt'), names)
+        self.assertIn(os.path.join('skip', 'keep', 'f.txt'), names)
+        self.assertNotIn(os.path.join('skip', 'f.txt'), names)
+        self.assertNotIn('top.tmp', names)
+        self.assertNotIn(os.path.join('.git', 'config'), names)
+        self.assertFalse([n for n in names if n.startswith(os.path.join('a', 'linkdir'))])
+        self.assertFalse([n for n in names if n.startswith(os.path.join('a', 'dangling'))])
+        self.assertEqual(len(serial), len(expected))
+
+        for threads in (1, 2, 8):
+            parallel = list(fs_iface.walk_files_parallel(
+                    self.dir, threads, self.dir_filter, self.file_filter))
+            self.assertEqual(set(parallel), expected)
+            self.assertEqual(len(parallel), len(expected))
+
+    def test_same_files_without_filters(self):
+        self.assertEqual(
+                set(fs_iface.walk_files(self.dir)),
+                set(fs_iface.walk_files_parallel(self.dir, 4)))
+
+    def test_consumer_stops_early(self):
+        walker = fs_iface.walk_files_parallel(self.dir, 4, self.dir_filter, self.file_filter)
+        first = next(walker)
+        walker.close()
+
+        self.assertIn(first, set(fs_iface.walk_files(self.dir, self.dir_filter, self.file_filter)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+import re
+import urllib
+import urlparse
+import itertools
+import threading
+import SocketServer
+import BaseHTTPServer
+
+#-----------------------------------------------------------------------
+# Stand-in object storage server for tests of iface/storage_http.py.
+# Speaks the subset of XML API the client uses:
+#   PUT, GET, HEAD, DELETE of objects, GET /bucket?prefix=&marker=,
+#   resumable upload sessions, multipart upload, server side copy.
+#
+# Objects are kept in memory, keyed by unquoted path '/bucket/key'.
+#-----------------------------------------------------------------------
+
+# Objects listed per page
+LIST_PAGE = 7
+
+# Prefix of resumable session URLs
+SESSION_PATH = '/_session/'
+
+
+#-----------------------------------------------------------------------
+# Request handler
+#-----------------------------------------------------------------------
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('conns')
+
+    def log_message(self, *args):
+        pass
+
+    #-------------------------------------------------------------------
+    def _send(self, status, body = '', headers = None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    #-------------------------------------------------------------------
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', '0')))
+
+    #-------------------------------------------------------------------
+    def _parse(self):
+        '''
+        Returns unquoted path, query dict
+        '''
+        parts = urlparse.urlsplit(self.path)
+        query = dict((k, v[0]) for k, v in
+                urlparse.parse_qs(parts.query, keep_blank_values = True).items())
+        return urllib.unquote(parts.path), query
+
+    #-------------------------------------------------------------------
+    def _failed(self, path):
+        '''
+        Sends injected error status for path, if any
+        '''
+        status = self.server.fail.get(path, None)
+        if status is None:
+            return False
+        self._body()
+        self._send(status, "Injected {}".format(status))
+        return True
+
+    #-------------------------------------------------------------------
+    def do_PUT(self):
+        path, query = self._parse()
+        if self._failed(path):
+            return
+
+        if path.startswith(SESSION_PATH):
+            return self._put_session(path[len(SESSION_PATH):])
+
+        if 'uploadId' in query:
+            upload = self.server.uploads[query['uploadId']]
+            number = int(query['partNumber'])
+            upload['parts'][number] = self._body()
+            return self._send(200, '', {'ETag': '"part{}"'.format(number)})
+
+        source = self.headers.get('x-goog-copy-source', None)
+        if source:
+            self._body()
+            self.server.count('copies')
+            source = urllib.unquote(source)
+            if source not in self.server.objects:
+                return self._send(404, 'NoSuchKey')
+            self.server.objects[path] = self.server.objects[source]
+            return self._send(200, '<CopyObjectResult/>')
+
+        self.server.objects[path] = self._body()
+        self._send(200)
+
+    #-------------------------------------------------------------------
+    def _put_session(self, sid):
+        session = self.server.sessions[sid]
+        crange = self.headers['Content-Range']
+        length = int(self.headers.get('Content-Length', '0'))
+
+        # Status query: bytes */total
+        if crange.startswith('bytes */'):
+            total = crange.split('/')[1]
+            if total != '*':
+                session['total'] = int(total)
+            return self._session_status(sid)
+
+        span, total = crange[len('bytes '):].split('/')
+        first, last = [int(x) for x in span.split('-')]
+
+        # Connection dropped halfway through chunk
+        drop = self.server.drop_at
+        if drop is not None and first >= drop:
+            self.server.drop_at = None
+            self.server.count('drops')
+            self.rfile.read(length // 2)
+            self.close_connection = 1
+            self.connection.close()
+            return
+
+        data = self.rfile.read(length)
+
+        # Session data lost, client is told to start over
+        reset = self.server.reset_at
+        if reset is not None and first >= reset:
+            self.server.reset_at = None
+            session['data'] = ''
+            return self._session_status(sid)
+
+        if first != len(session['data']):
+            return self._send(400, 'Bad range')
+        session['data'] += data
+        if total != '*':
+            session['total'] = int(total)
+        self._session_status(sid)
+
+    #-------------------------------------------------------------------
+    def _session_status(self, sid):
+        session = self.server.sessions[sid]
+        if session['total'] is not None and len(session['data']) == session['total']:
+            self.server.objects[session['path']] = session['data']
+            return self._send(200)
+
+        headers = {}
+        if session['data']:
+            headers['Range'] = "bytes=0-{}".format(len(session['data']) - 1)
+        self._send(308, '', headers)
+
+    #-------------------------------------------------------------------
+    def do_POST(self):
+        path, query = self._parse()
+        body = self._body()
+        if self._failed(path):
+            return
+
+        if 'uploads' in query:
+            uid = self.server.next_id()
+            self.server.uploads[uid] = {'path': path, 'parts': {}}
+            return self._send(200,
+                    "<InitiateMultipartUploadResult><UploadId>{}</UploadId>"
+                    "</InitiateMultipartUploadResult>".format(uid))
+
+        if 'uploadId' in query:
+            upload = self.server.uploads.pop(query['uploadId'])
+            numbers = [int(n) for n in re.findall(r'<PartNumber>(\d+)</PartNumber>', body)]
+            self.server.objects[upload['path']] = ''.join(upload['parts'][n] for n in numbers)
+            self.server.count('multipart')
+            return self._send(200, '<CompleteMultipartUploadResult/>')
+
+        if self.headers.get('x-goog-resumable', None) != 'start':
+            return self._send(400, 'Not resumable')
+
+        sid = self.server.next_id()
+        self.server.sessions[sid] = {'path': path, 'data': '', 'total': None}
+        self._send(201, '', {'Location': SESSION_PATH + sid})
+
+    #-------------------------------------------------------------------
+    def do_GET(self):
+        path, query = self._parse()
+        if self._failed(path):
+            return
+
+        if self.path.find('?') >= 0:
+            return self._list(path.strip('/'), query)
+
+        if path not in self.server.objects:
+            return self._send(404, 'NoSuchKey')
+        self._send(200, self.server.objects[path])
+
+    #-------------------------------------------------------------------
+    def do_HEAD(self):
+        path, query = self._parse()
+        if path not in self.server.objects:
+            return self._send(404)
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.objects[path])))
+        self.end_headers()
+
+    #-------------------------------------------------------------------
+    def do_DELETE(self):
+        path, query = self._parse()
+        self._body()
+        if self._failed(path):
+            return
+
+        if self.server.objects.pop(path, None) is None:
+            return self._send(404, 'NoSuchKey')
+        self._send(204)
+
+    #-------------------------------------------------------------------
+    def _list(self, bucket, query):
+        prefix = query.get('prefix', '')
+        marker = query.get('marker', '')
+        start = "/{}/".format(bucket)
+
+        keys = sorted(
+                k[len(start):] for k in self.server.objects.keys()
+                if k.startswith(start + prefix) and k[len(start):] > marker)
+        page = keys[:LIST_PAGE]
+
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+                '<ListBucketResult xmlns="http://doc.s3.amazonaws.com/2006-03-01">',
+                "<Name>{}</Name>".format(bucket),
+                "<IsTruncated>{}</IsTruncated>".format(
+                        'true' if len(keys) > LIST_PAGE else 'false')]
+        for key in page:
+            xml.append("<Contents><Key>{}</Key><Size>{}</Size></Contents>".format(
+                    key, len(self.server.objects[start + key])))
+        xml.append('</ListBucketResult>')
+        self._send(200, ''.join(xml))
+
+
+#-----------------------------------------------------------------------
+# Server
+#-----------------------------------------------------------------------
+class ObjectServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Serves on localhost, in background thread after start().
+        - objects - { '/bucket/key': data }
+        - fail - { '/bucket/key': status } answered instead of request
+        - drop_at - offset of resumable chunk at which connection
+                    is dropped once
+        - reset_at - offset of resumable chunk at which session
+                     data is lost once
+        - stats - counts of conns, drops, copies, multipart
+    '''
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.objects = {}
+        self.sessions = {}
+        self.uploads = {}
+        self.fail = {}
+        self.drop_at = None
+        self.reset_at = None
+        self.stats = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            return str(next(self._ids))
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path = ''):
+        return "http://{}:{}{}".format(
+                self.server_address[0], self.server_address[1], path)
@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+import aeroback.context.context as context
+import aeroback.app.iface.storage_file as file_iface
+
+
+#-----------------------------------------------------------------------
+# Tests of local directory storage
+#-----------------------------------------------------------------------
+class StorageFileTests(unittest.TestCase):
+
+    def setUp(self):
+        context.init({'-dry': False})
+
+        self.dir = tempfile.mkdtemp()
+        self.local = os.path.join(self.dir, 'local')
+        self.restored = os.path.join(self.dir, 'restored')
+        os.makedirs(self.local)
+        os.makedirs(self.restored)
+
+        self.root = os.path.join(self.dir, 'storage')
+        self.url = "file://{}".format(self.root)
+        file_iface.configure(self.url, {})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    #-------------------------------------------------------------------
+    def _file(self, name, size):
+        path = os.path.join(self.local, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    #-------------------------------------------------------------------
+    def test_store_restore_unstore(self):
+        path = self._file('a b.txt', 1000)
+        url = "{}/dir/a b.txt".format(self.url)
+
+        self.assertEqual(file_iface.copy_local_to_storage(path, url)[1:], (0, None))
+        self.assertEqual(self._read(os.path.join(self.root, 'dir', 'a b.txt')), self._read(path))
+        self.assertEqual(file_iface.stat_storage(url), (1000, 0, None))
+
+        self.assertEqual(file_iface.copy_storage_to_local(url, self.restored)[1:], (0, None))
+        self.assertEqual(self._read(os.path.join(self.restored, 'a b.txt')), self._read(path))
+
+        self.assertEqual(file_iface.remove_from_storage(url)[1:], (0, None))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'dir', 'a b.txt')))
+        self.assertEqual(file_iface.remove_from_storage(url)[1], 1)
+        self.assertEqual(file_iface.stat_storage(url)[:2], (None, 1))
+
+    def test_store_stream(self):
+        data = os.urandom(3 * file_iface.BLOCK_SIZE + 7)
+        url = "{}/s/stream.bin".format(self.url)
+
+        self.assertEqual(file_iface.copy_stream_to_storage(StringIO.StringIO(data), url)[1:], (0, None))
+        self.assertEqual(self._read(os.path.join(self.root, 's', 'stream.bin')), data)
+
+    def test_store_linked(self):
+        file_iface.configure(self.url, {'link': True})
+        path = self._file('f', 10)
+        file_iface.copy_local_to_storage(path, "{}/f".format(self.url))
+
+        self.assertEqual(os.stat(path).st_ino, os.stat(os.path.join(self.root, 'f')).st_ino)
+
+    #-------------------------------------------------------------------
+    def test_batches(self):
+        paths = [self._file("f{}".format(i), 100 + i) for i in range(5)]
+        dir_url = "{}/batch".format(self.url)
+
+        results, err, msg = file_iface.copy_local_to_storage_batch(paths, dir_url, None)
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(sorted(results.keys()), sorted(paths))
+
+        urls = ["{}/{}".format(dir_url, os.path.basename(p)) for p in paths]
+        results, err, msg = file_iface.copy_storage_to_storage_batch(urls, "{}/copy".format(self.url), None)
+        self.assertEqual(err, 0, msg)
+
+        results, err, msg = file_iface.copy_storage_to_local_batch(urls, self.restored, None)
+        self.assertEqual(err, 0, msg)
+        for path in paths:
+            self.assertEqual(self._read(os.path.join(self.restored, os.path.basename(path))), self._read(path))
+            self.assertEqual(self._read(os.path.join(self.root, 'copy', os.path.basename(path))), self._read(path))
+
+        missing = "{}/nope".format(dir_url)
+        results, err, msg = file_iface.remove_from_storage_batch(urls + [missing])
+        self.assertEqual(err, 1)
+        self.assertEqual(results[missing][0], 1)
+        self.assertTrue(all(results[url] == (0, None) for url in urls))
+        self.assertEqual(os.listdir(os.path.join(self.root, 'batch')), [])
+
+    #-------------------------------------------------------------------
+    def test_list(self):
+        for name in ('a', 'video.part.1.mkv', os.path.join('sub', 'b'), os.path.join('sub', 'deep', 'c')):
+            path = self._file(os.path.basename(name), len(name))
+            file_iface.copy_local_to_storage(path, "{}/{}".format(self.url, name))
+
+        # Transfer in progress
+        with open(os.path.join(self.root, "{}123.x".format(file_iface.TEMP_PREFIX)), 'wb') as f:
+            f.write('partial')
+
+        objects, err, msg = file_iface.list_storage(self.url)
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(sorted(objects), sorted([
+                ("{}/a".format(self.url), 1),
+                ("{}/video.part.1.mkv".format(self.url), 16),
+                ("{}/sub/b".format(self.url), 5),
+                ("{}/sub/deep/c".format(self.url), 10)]))
+
+        self.assertEqual(file_iface.list_storage("{}/nope".format(self.url)), ([], 0, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
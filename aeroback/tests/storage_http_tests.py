@@ -0,0 +1,269 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import aeroback.context.context as context
+import aeroback.app.iface.storage_http as http_iface
+
+import objserver
+
+
+#-----------------------------------------------------------------------
+# Tests of native object storage client against stand-in server
+#-----------------------------------------------------------------------
+class StorageHttpTests(unittest.TestCase):
+
+    def setUp(self):
+        context.init({'-dry': False})
+
+        self.server = objserver.ObjectServer()
+        self.server.start()
+        self.dir = tempfile.mkdtemp()
+
+        # Small sizes, so that resumable path is taken for small files
+        self.saved = (http_iface.RESUMABLE_THRESHOLD, http_iface.CHUNK_SIZE,
+                http_iface.MIN_SLICE_SIZE, http_iface.RETRIES)
+        http_iface.RESUMABLE_THRESHOLD = 1024 * 1024
+        http_iface.CHUNK_SIZE = 256 * 1024
+        http_iface.MIN_SLICE_SIZE = 256 * 1024
+        http_iface.RETRIES = 2
+
+        http_iface.configure(self.server.url(), {'token': None})
+
+    def tearDown(self):
+        (http_iface.RESUMABLE_THRESHOLD, http_iface.CHUNK_SIZE,
+                http_iface.MIN_SLICE_SIZE, http_iface.RETRIES) = self.saved
+        http_iface.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    #-------------------------------------------------------------------
+    def _file(self, name, size):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    #-------------------------------------------------------------------
+    def test_upload_simple(self):
+        path = self._file('small file.txt', 1000)
+        result, err, msg = http_iface.copy_local_to_storage(
+                path, self.server.url('/bk/dir/small file.txt'))
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(self.server.objects['/bk/dir/small file.txt'], self._read(path))
+        self.assertEqual(self.server.sessions, {})
+
+    def test_upload_resumable(self):
+        path = self._file('big.bin', 3 * 1024 * 1024 + 17)
+        result, err, msg = http_iface.copy_local_to_storage(
+                path, self.server.url('/bk/big.bin'))
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(self.server.objects['/bk/big.bin'], self._read(path))
+        self.assertEqual(len(self.server.sessions), 1)
+
+    def test_upload_resumable_resumes_after_drop(self):
+        path = self._file('big.bin', 3 * 1024 * 1024 + 17)
+        self.server.drop_at = 1024 * 1024
+        result, err, msg = http_iface.copy_local_to_storage(
+                path, self.server.url('/bk/big.bin'))
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(self.server.stats.get('drops'), 1)
+        self.assertEqual(self.server.objects['/bk/big.bin'], self._read(path))
+
+    def test_upload_unicode_url(self):
+        # Names read from tracking DB are unicode
+        for size in (1000, 2 * 1024 * 1024):
+            path = self._file('bin', size)
+            url = unicode(self.server.url('/bk/')) + u'caf\xe9 {}'.format(size)
+            result, err, msg = http_iface.copy_local_to_storage(path, url)
+
+            self.assertEqual(err, 0, msg)
+            self.assertEqual(
+                    self.server.objects["/bk/caf\xc3\xa9 {}".format(size)], self._read(path))
+
+    def test_upload_stream(self):
+        path = self._file('stream.bin', 600 * 1024)
+        with open(path, 'rb') as stream:
+            result, err, msg = http_iface.copy_stream_to_storage(
+                    stream, self.server.url('/bk/stream.bin'))
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(self.server.objects['/bk/stream.bin'], self._read(path))
+
+    def test_upload_stream_resumes_after_drop(self):
+        path = self._file('stream.bin', 1024 * 1024 + 3)
+        self.server.drop_at = 512 * 1024
+        with open(path, 'rb') as stream:
+            result, err, msg = http_iface.copy_stream_to_storage(
+                    stream, self.server.url('/bk/stream.bin'))
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(self.server.stats.get('drops'), 1)
+        self.assertEqual(self.server.objects['/bk/stream.bin'], self._read(path))
+
+    def test_upload_stream_fails_on_lost_data(self):
+        path = self._file('stream.bin', 1024 * 1024 + 3)
+        self.server.reset_at = 512 * 1024
+        with open(path, 'rb') as stream:
+            result, err, msg = http_iface.copy_stream_to_storage(
+                    stream, self.server.url('/bk/stream.bin'))
+
+        self.assertEqual((result, err), ('Error', 1))
+        self.assertNotIn('/bk/stream.bin', self.server.objects)
+
+    def test_upload_resumable_restarts_on_lost_data(self):
+        path = self._file('big.bin', 2 * 1024 * 1024 + 5)
+        self.server.reset_at = 512 * 1024
+        result, err, msg = http_iface.copy_local_to_storage(
+                path, self.server.url('/bk/big.bin'))
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(self.server.objects['/bk/big.bin'], self._read(path))
+
+    def test_upload_parallel(self):
+        path = self._file('sliced.bin', 1024 * 1024 + 5)
+        result, err, msg = http_iface.copy_local_to_storage_parallel(
+                path, self.server.url('/bk/sliced.bin'), 4)
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(self.server.stats.get('multipart'), 1)
+        self.assertEqual(self.server.objects['/bk/sliced.bin'], self._read(path))
+
+    #-------------------------------------------------------------------
+    def test_download(self):
+        self.server.objects['/bk/dir/a b.txt'] = 'content'
+        result, err, msg = http_iface.copy_storage_to_local(
+                self.server.url('/bk/dir/a b.txt'), self.dir)
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(self._read(os.path.join(self.dir, 'a b.txt')), 'content')
+
+    def test_download_name_with_percent(self):
+        self.server.objects['/bk/dir/100%41.txt'] = 'content'
+        result, err, msg = http_iface.copy_storage_to_local(
+                self.server.url('/bk/dir/100%41.txt'), self.dir)
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(os.listdir(self.dir), ['100%41.txt'])
+
+    def test_download_missing(self):
+        result, err, msg = http_iface.copy_storage_to_local(
+                self.server.url('/bk/nope'), self.dir)
+
+        self.assertEqual(err, 1)
+        self.assertEqual(result, 'HTTP 404')
+        self.assertEqual(os.listdir(self.dir), [])
+
+    #-------------------------------------------------------------------
+    def test_list(self):
+        for i in range(20):
+            self.server.objects["/bk/dir/f{:02d}".format(i)] = 'x' * i
+        self.server.objects['/bk/other/f'] = 'x'
+        self.server.objects['/bk2/dir/f'] = 'x'
+
+        objects, err, msg = http_iface.list_storage(self.server.url('/bk/dir'))
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(objects,
+                [(self.server.url("/bk/dir/f{:02d}".format(i)), i) for i in range(20)])
+
+    def test_stat(self):
+        self.server.objects['/bk/f'] = 'x' * 42
+
+        self.assertEqual(http_iface.stat_storage(self.server.url('/bk/f')), (42, 0, None))
+        size, err, msg = http_iface.stat_storage(self.server.url('/bk/nope'))
+        self.assertEqual((size, err), (None, 1))
+
+    #-------------------------------------------------------------------
+    def test_remove(self):
+        self.server.objects['/bk/f'] = 'x'
+        result, err, msg = http_iface.remove_from_storage(self.server.url('/bk/f'))
+
+        self.assertEqual(err, 0, msg)
+        self.assertNotIn('/bk/f', self.server.objects)
+
+    def test_remove_batch(self):
+        urls = []
+        for i in range(20):
+            self.server.objects["/bk/f{}".format(i)] = 'x'
+            urls.append(self.server.url("/bk/f{}".format(i)))
+        missing = self.server.url('/bk/nope')
+
+        results, err, msg = http_iface.remove_from_storage_batch(urls + [missing])
+
+        self.assertEqual(err, 1)
+        self.assertEqual(self.server.objects, {})
+        self.assertEqual(results[missing][0], 1)
+        self.assertTrue(all(results[url] == (0, None) for url in urls))
+
+    #-------------------------------------------------------------------
+    def test_copy(self):
+        self.server.objects['/bk/a/f'] = 'content'
+        result, err, msg = http_iface.copy_storage_to_storage(
+                self.server.url('/bk/a/f'), self.server.url('/bk/b/f'))
+
+        self.assertEqual(err, 0, msg)
+        self.assertEqual(self.server.objects['/bk/b/f'], 'content')
+        self.assertEqual(self.server.objects['/bk/a/f'], 'content')
+
+    def test_copy_missing(self):
+        result, err, msg = http_iface.copy_storage_to_storage(
+                self.server.url('/bk/a/nope'), self.server.url('/bk/b/nope'))
+
+        self.assertEqual((result, err), ('HTTP 404', 1))
+        self.assertNotIn('/bk/b/nope', self.server.objects)
+
+    #-------------------------------------------------------------------
+    def test_error_status_upload(self):
+        self.server.fail['/bk/f'] = 403
+        path = self._file('f', 100)
+        result, err, msg = http_iface.copy_local_to_storage(path, self.server.url('/bk/f'))
+
+        self.assertEqual((result, err), ('HTTP 403', 1))
+        self.assertNotIn('/bk/f', self.server.objects)
+
+    def test_error_status_resumable_start(self):
+        self.server.fail['/bk/big.bin'] = 500
+        path = self._file('big.bin', 2 * 1024 * 1024)
+        result, err, msg = http_iface.copy_local_to_storage(path, self.server.url('/bk/big.bin'))
+
+        self.assertEqual(err, 1)
+        self.assertIn('HTTP 500', msg)
+
+    def test_error_status_list(self):
+        self.server.fail['/bk'] = 503
+        objects, err, msg = http_iface.list_storage(self.server.url('/bk/dir'))
+
+        self.assertEqual((objects, err), ([], 1))
+        self.assertIn('503', msg)
+
+    def test_error_status_remove(self):
+        self.server.objects['/bk/f'] = 'x'
+        self.server.fail['/bk/f'] = 500
+        result, err, msg = http_iface.remove_from_storage(self.server.url('/bk/f'))
+
+        self.assertEqual((result, err), ('HTTP 500', 1))
+        self.assertIn('/bk/f', self.server.objects)
+
+    def test_connection_refused(self):
+        self.server.shutdown()
+        self.server.server_close()
+        http_iface.close()
+        result, err, msg = http_iface.copy_storage_to_local(
+                self.server.url('/bk/f'), self.dir)
+
+        self.assertEqual((result, err), ('Error', 1))
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()